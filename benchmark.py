@@ -0,0 +1,320 @@
+from card import Card, CARD_TABLE
+from cardgame import CardGame
+from cardpile import CardPile, MaskedCardPile, MultisetCardPile, standard_deck
+from crazyeights import CrazyEights, DecisionCache
+from simulation import make_players
+import argparse
+import json
+import platform
+import sys
+import time
+
+
+# Registered benchmarks: name -> (unit, setup).  setup() returns (fn, ops) where
+# fn() does ops operations of the thing being measured.  Every metric is a rate,
+# so higher is better.
+BENCHMARKS = {}
+
+HAND = [Card.from_label(label) for label in ['3c', '9s', 'Jh', '8d', 'As', 'Jc', 'Th']]
+PILE_CLASSES = [CardPile, MaskedCardPile, MultisetCardPile]
+
+
+def benchmark(name: str, unit: str = 'ops/sec'):
+    def register(setup):
+        BENCHMARKS[name] = (unit, setup)
+        return setup
+    return register
+
+
+def _pile_benchmarks(pile_class):
+    prefix = pile_class.__name__ + '.'
+
+    @benchmark(prefix + 'add_card')
+    def add_card():
+        pile = pile_class()
+        def fn():
+            pile.clear()
+            for c in HAND:
+                pile.add_card(c)
+        return fn, len(HAND)
+
+    @benchmark(prefix + 'remove_card')
+    def remove_card():
+        # Includes refilling the pile with add_cards
+        pile = pile_class()
+        def fn():
+            pile.add_cards(HAND)
+            for c in HAND:
+                pile.remove_card(c)
+        return fn, len(HAND)
+
+    @benchmark(prefix + 'contains_card')
+    def contains_card():
+        pile = pile_class()
+        pile.add_cards(HAND)
+        probes = HAND + [Card('2', 'h'), Card('K', 'd'), Card('5', 's')]
+        def fn():
+            for c in probes:
+                pile.contains_card(c)
+        return fn, len(probes)
+
+    @benchmark(prefix + 'extract_cards')
+    def extract_cards():
+        pile = pile_class()
+        pile.add_cards(HAND)
+        def fn():
+            pile.extract_cards(['8'])
+        return fn, 1
+
+    @benchmark(prefix + 'count_by_suit')
+    def count_by_suit():
+        pile = pile_class()
+        pile.add_cards(HAND)
+        def fn():
+            pile.count_by_suit()
+        return fn, 1
+
+
+for _pile_class in PILE_CLASSES:
+    _pile_benchmarks(_pile_class)
+
+
+@benchmark('standard_deck')
+def bench_standard_deck():
+    return standard_deck, 1
+
+
+@benchmark('standard_deck.6_decks')
+def bench_standard_deck_6():
+    return (lambda: standard_deck(6)), 1
+
+
+def eights_position(pile_class = MaskedCardPile):
+    # A 2-player CrazyEights game with HAND to play on the 7 of hearts
+    game = CrazyEights(make_players(2), 7)
+    game.pile_class = pile_class
+    game.setup_game()
+    player = game.curr_player
+    player.hand.cards = list(HAND)
+    game.discard_pile.cards = [Card('7', 'h')]
+    game.current_suit = 'h'
+    return game, player
+
+
+def _eights_benchmarks(pile_class):
+    prefix = 'CrazyEights.' + pile_class.__name__ + '.'
+
+    @benchmark(prefix + 'find_playable_cards')
+    def find_playable_cards():
+        game, player = eights_position(pile_class)
+        return (lambda: game.find_playable_cards(player)), 1
+
+    @benchmark(prefix + 'select_card_to_play')
+    def select_card_to_play():
+        game, player = eights_position(pile_class)
+        playable = game.find_playable_cards(player)
+        return (lambda: game.select_card_to_play(player, playable)), 1
+
+
+for _pile_class in [MaskedCardPile, MultisetCardPile]:
+    _eights_benchmarks(_pile_class)
+
+
+@benchmark('CrazyEights.select_card_from_mask')
+def bench_select_card_from_mask():
+    game, player = eights_position()
+    mask = game.find_playable_mask(player)
+    return (lambda: game.select_card_from_mask(player, mask)), 1
+
+
+@benchmark('CrazyEights.cached_card_from_mask')
+def bench_cached_card_from_mask():
+    # Every call after the first is a cache hit
+    game, player = eights_position()
+    game.decision_cache = DecisionCache()
+    mask = game.find_playable_mask(player)
+    return (lambda: game.cached_card_from_mask(player, mask)), 1
+
+
+@benchmark('CardGame.recycle_discard_pile')
+def bench_recycle():
+    # Recycle a 40-card discard pile into the empty deck
+    game = CardGame(make_players(2), 5)
+    game.setup_game()
+    discard = list(CARD_TABLE[:40])
+    def fn():
+        game.deck.clear()
+        game.discard_pile.cards = list(discard)
+        game.recycle_discard_pile()
+    return fn, 1
+
+
+def _game_benchmarks(game_class, num_players: int, num_cards: int, num_decks: int = 1):
+    label = game_class.__name__ + '.' + str(num_players) + 'p'
+    if num_decks > 1:
+        label += '.' + str(num_decks) + 'd'
+
+    # The same 20 seeded deals are played on every call, so runs are comparable
+    n_games = 20
+
+    def setup():
+        game = game_class(make_players(num_players), num_cards, num_decks=num_decks)
+        game.setup_game()
+        def play():
+            turns = 0
+            for i in range(n_games):
+                game.reset(i)
+                game.play_game()
+                turns += game.num_turns
+            return turns
+        return play
+
+    @benchmark(label + '.games', 'games/sec')
+    def games():
+        return setup(), n_games
+
+    @benchmark(label + '.turns', 'turns/sec')
+    def turns():
+        play = setup()
+        return play, play()
+
+
+for _args in [(CrazyEights, 2, 5), (CrazyEights, 4, 5), (CrazyEights, 8, 5), (CardGame, 4, 5),
+              (CrazyEights, 50, 5, 6)]:
+    _game_benchmarks(*_args)
+
+
+def measure(fn, ops: int, min_time: float = 0.2, repeat: int = 3):
+    # Best rate over repeat runs, each calling fn for at least min_time seconds
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed * 1.2) + 1))
+    best = elapsed
+    for r in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(loops):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return loops * ops / best
+
+
+def run_benchmarks(names = None, min_time: float = 0.2, repeat: int = 3, progress = None):
+    # Run the named benchmarks (all by default) and return a JSON-ready dict
+    metrics = {}
+    units = {}
+    for name in names or list(BENCHMARKS):
+        unit, setup = BENCHMARKS[name]
+        fn, ops = setup()
+        metrics[name] = round(measure(fn, ops, min_time, repeat), 1)
+        units[name] = unit
+        if progress:
+            progress(name, metrics[name], unit)
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'machine': platform.machine(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'metrics': metrics, 'units': units}
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.1):
+    # Metrics present in both runs as (name, baseline, current, relative change), the
+    # names of those that fell by more than tolerance (0.1 = 10% slower), and the names
+    # of baseline metrics the current run does not have
+    rows = []
+    regressions = []
+    missing = []
+    for name, base in baseline['metrics'].items():
+        if name not in current['metrics']:
+            missing.append(name)
+            continue
+        if base <= 0:
+            continue
+        value = current['metrics'][name]
+        change = value / base - 1
+        rows.append((name, base, value, change))
+        if change < -tolerance:
+            regressions.append(name)
+    return rows, regressions, missing
+
+
+def test_benchmark():
+    import copy
+    names = [n for n in BENCHMARKS if n.startswith('MaskedCardPile.') or n.endswith('.2p.games')]
+    first = run_benchmarks(names, min_time=0.02, repeat=2)
+    for name in names:
+        print('  %-50s %14.1f %s' % (name, first['metrics'][name], first['units'][name]))
+    slower = copy.deepcopy(first)
+    slower['metrics']['MaskedCardPile.add_card'] *= 0.5
+    rows, regressions, missing = compare(first, slower, tolerance=0.2)
+    print('halved add_card flagged: ' + str(regressions == ['MaskedCardPile.add_card']))
+    del slower['metrics'][names[0]]
+    rows, regressions, missing = compare(first, slower, tolerance=0.2)
+    print('dropped metric reported missing: ' + str(missing == [names[0]]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Card game benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='run the benchmarks')
+    run.add_argument('-o', '--output', help='write the results to this JSON file')
+    run.add_argument('-k', '--filter', default='', help='only run benchmarks whose name contains this')
+    run.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run')
+    run.add_argument('--repeat', type=int, default=3, help='timing runs per benchmark (best is kept)')
+    run.add_argument('--baseline', help='compare against this JSON file when done')
+    run.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown (0.1 = 10%%)')
+    cmp = sub.add_parser('compare', help='compare two result files')
+    cmp.add_argument('baseline')
+    cmp.add_argument('current')
+    cmp.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown (0.1 = 10%%)')
+    sub.add_parser('list', help='list the benchmarks')
+    sub.add_parser('test', help='run a quick self-test')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for name, (unit, setup) in BENCHMARKS.items():
+            print(name + ' (' + unit + ')')
+        return 0
+    if args.command == 'test':
+        test_benchmark()
+        return 0
+    if args.command == 'run':
+        names = [n for n in BENCHMARKS if args.filter in n]
+        current = run_benchmarks(names, args.min_time, args.repeat,
+                                 progress=lambda name, value, unit: print('%-50s %14.1f %s' % (name, value, unit)))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(current, f, indent=2)
+        if not args.baseline:
+            return 0
+        baseline_path = args.baseline
+        # Only the benchmarks that were run are expected to be there
+        metrics_filter = args.filter
+    else:
+        baseline_path = args.baseline
+        metrics_filter = ''
+        with open(args.current) as f:
+            current = json.load(f)
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    baseline['metrics'] = {name: value for name, value in baseline['metrics'].items() if metrics_filter in name}
+    rows, regressions, missing = compare(baseline, current, args.tolerance)
+    for name, base, value, change in rows:
+        flag = '  REGRESSION' if name in regressions else ''
+        print('%-50s %14.1f -> %14.1f  %+6.1f%%%s' % (name, base, value, change * 100, flag))
+    for name in missing:
+        print('%-50s %14.1f -> %14s  MISSING' % (name, baseline['metrics'][name], '-'))
+    if regressions:
+        print(str(len(regressions)) + ' regression(s) beyond ' + str(round(args.tolerance * 100, 1)) + '%')
+    if missing:
+        print(str(len(missing)) + ' baseline metric(s) missing from the current run')
+    if regressions or missing:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,9 +21,18 @@ CARD_DICT = {
     "A": {"name": "Ace", "rank": 14}
 }
 
+# Suits and faces in ordinal order (clubs..spades, 2..A)
+SUITS = tuple(SUIT_DICT.keys())
+FACES = tuple(CARD_DICT.keys())
+SUIT_INDEX = {s: i for i, s in enumerate(SUITS)}
+
 class Card:
     """ A standard playing card
 
+    Cards are immutable flyweights: there is exactly one Card object for each
+    face/suit combination, so Card('7','d') is Card('7','d') and piles can share
+    cards freely.
+
     Attributes:
         face:  
             A,2,3,4,5,6,7,8,9,T,J,Q,K
@@ -33,63 +42,117 @@ class Card:
             h = hearts
             s = spades
         rank: rank of card
-            A-9 = 1..9
-            T-K = 10..13
+            2-9 = 2..9
+            T-A = 10..14
+        suit_index: position of suit in SUITS (0..3)
+        ordinal: position of card in a standard deck (0..51), suit_index * 13 + rank - 2
+        bit: 1 << ordinal, the card's bit in a 52-bit pile mask
         label: short name of card
             Examples: Ad = ace of diamonds, 7c = seven of clubs
 
     """
-     
-    @property
-    def face(self):
-        return self._face
-    
-    @face.setter
-    def face(self, value):
-        if value.capitalize() not in CARD_DICT.keys():
-            raise ValueError('Card not allowed: ' + face)
-        self._face = value.capitalize()
-
-    @property
-    def suit(self):
-        return self._suit
-    
-    @suit.setter
-    def suit(self, value):
-        if value.lower() not in SUIT_DICT.keys():
-            raise ValueError('Suit not allowed: ' + suit)
-        self._suit = value.lower()
-
-    @property
-    def rank(self):
-        return CARD_DICT[self.face]['rank']
-
-    @property
-    def label(self):
-        return self.face + self.suit
-
-    def __init__(self, face: str, suit: str):
-        self.face = face
-        self.suit = suit
+    __slots__ = ('face', 'suit', 'rank', 'suit_index', 'ordinal', 'bit', 'label')
+
+    def __new__(cls, face: str, suit: str):
+        card = _CARDS_BY_LABEL.get(face + suit)
+        if card is None:
+            card = cls.from_label(face.capitalize() + suit.lower())
+        return card
+
+    @classmethod
+    def from_label(cls, label: str):
+        # Look up the card for a label such as 'Kc'
+        card = _CARDS_BY_LABEL.get(label)
+        if card is None:
+            if len(label) != 2:
+                raise ValueError('Card not allowed: ' + label)
+            face = label[0].capitalize()
+            suit = label[1].lower()
+            if face not in CARD_DICT:
+                raise ValueError('Card not allowed: ' + face)
+            if suit not in SUIT_DICT:
+                raise ValueError('Suit not allowed: ' + suit)
+            card = _CARDS_BY_LABEL[face + suit]
+        return card
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Card is immutable')
 
     def __eq__(self, other):
-        return (self.face == other.face and self.suit == other.suit)
+        return self is other
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        return self is not other
+
+    def __hash__(self):
+        return self.ordinal
+
+    def __reduce__(self):
+        # Unpickle to the canonical instance
+        return (Card.from_label, (self.label,))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return 'Card(' + repr(self.face) + ', ' + repr(self.suit) + ')'
+
+
+def _make_card(face: str, suit: str):
+    card = object.__new__(Card)
+    rank = CARD_DICT[face]['rank']
+    suit_index = SUITS.index(suit)
+    object.__setattr__(card, 'face', face)
+    object.__setattr__(card, 'suit', suit)
+    object.__setattr__(card, 'rank', rank)
+    object.__setattr__(card, 'suit_index', suit_index)
+    object.__setattr__(card, 'ordinal', suit_index * 13 + rank - 2)
+    object.__setattr__(card, 'bit', 1 << card.ordinal)
+    object.__setattr__(card, 'label', face + suit)
+    return card
+
+
+# Canonical table of the 52 cards, indexed by ordinal
+CARD_TABLE = tuple(_make_card(f, s) for s in SUITS for f in FACES)
+_CARDS_BY_LABEL = {c.label: c for c in CARD_TABLE}
+
+# Masks over the 52-bit card encoding: 13 bits per suit, lowest bit = rank 2
+SUIT_BITS = 0x1FFF
+SUIT_MASKS = {s: SUIT_BITS << (13 * i) for i, s in enumerate(SUITS)}
+FACE_MASKS = {f: sum(1 << (13 * i + r) for i in range(4)) for r, f in enumerate(FACES)}
+FULL_MASK = (1 << 52) - 1
+
+
+def cards_from_mask(mask: int):
+    # Cards whose bits are set in mask, in ordinal order
+    cards = []
+    while mask:
+        low = mask & -mask
+        cards.append(CARD_TABLE[low.bit_length() - 1])
+        mask ^= low
+    return cards
 
 
 def test_Card():
     c1 = Card('7','d')
     c2 = Card('7','d')
     c3 = Card('7','c')
+    c4 = Card.from_label('7d')
 
     print('c1 = ' + c1.label + ' c2 = ' + c2.label + ' c3 = ' + c3.label)
     print('c1 is c2: ' + str(c1 is c2))
+    print('c1 is from_label(7d): ' + str(c1 is c4))
     print('c1 == c2: ' + str(c1 == c2))
     print('c1 != c2: ' + str(c1 != c2))
     print('c2 == c3: ' + str(c2 == c3))
+    print('c1 rank/suit_index/ordinal: ', c1.rank, c1.suit_index, c1.ordinal)
+    print('CARD_TABLE[c1.ordinal] is c1: ' + str(CARD_TABLE[c1.ordinal] is c1))
+    sevens = [c.label for c in cards_from_mask(FACE_MASKS['7'])]
+    print('sevens from mask: ' + ' '.join(sevens))
 
 
 if __name__ == '__main__':
-    test_Card()
\ No newline at end of file
+    test_Card()
@@ -1,9 +1,50 @@
-from card import Card
+from card import Card, CARD_TABLE
 from cardplayer import CardPlayer
-from cardpile import CardPile, standard_deck
+from cardpile import CardPile, DrawPile, MultisetCardPile, standard_deck
+from gameevents import NULL_SINK, ConsoleSink, DRAW, PLAY, TURN, WIN, RECYCLE, RECYCLE_CAP, NO_CARDS, GAME_OVER
+from collections import namedtuple
+import copy
 import random
 
 
+GameState = namedtuple('GameState', ['deck', 'hands', 'discard', 'curr_player', 'recycles',
+                                     'completed', 'winner', 'num_turns', 'num_draws', 'current_suit'],
+                       defaults=[None])
+GameState.__doc__ = """ Compact, immutable copy of a game's state (see CardGame.snapshot)
+
+    Piles are stored as bytes of card ordinals, and players by seat index.
+
+    Attributes:
+        deck: bytes
+            deck order, top card first
+        hands: tuple of bytes
+            each player's hand, in seat order
+        discard: bytes
+            discard pile, top card last
+        curr_player: int
+            seat of the player with the current turn
+        recycles: int
+            number of times the discard pile has been recycled
+        completed: bool
+            if true, the game is over
+        winner: int
+            seat of the winner, None if there is no winner yet
+        num_turns, num_draws: int
+            turn and draw counters
+        current_suit: str
+            current suit in games that have one (Crazy Eights), otherwise None
+"""
+
+
+def _ordinals(cards):
+    return bytes([c.ordinal for c in cards])
+
+
+def _cards(ordinals):
+    return list(map(CARD_TABLE.__getitem__, ordinals))
+
+
+
 class CardGame:
     """ A turn-based card game
 
@@ -16,29 +57,84 @@ class CardGame:
             player with current turn
         deck: CardPile
             collection of Cards
+        deck_class: type
+            DrawPile class used for the deck (LazyDrawPile shuffles as cards are drawn)
         name: str
             name of the game being played
+        next_player: dict
+            player whose turn comes after each player (see update_turn_order)
         num_cards: int
             number of cards to be dealt to each player
+        num_decks: int
+            number of standard decks shuffled together
+        num_draws: int
+            number of cards drawn from the deck during the game
+        num_turns: int
+            number of turns played
         players: CardPlayer[]
             collection of CardPlayers
+        rng: random.Random
+            source of randomness for shuffling and automated play (defaults to the random module)
+        sink: NullSink
+            receives game events (draws, plays, turns, winner); the default NullSink
+            ignores them, and interactive games default to a ConsoleSink
+        winner: CardPlayer
+            player who emptied their hand first, None until there is one
+        pile_class: type
+            CardPile class used for player hands and the discard pile
+            (MultisetCardPile when there is more than one deck)
     """
     name = 'Basic Card Game'
+    pile_class = CardPile
+    deck_class = DrawPile
     turn_over_first_card = True
     max_times_recycling_discard_pile = 5
     times_recycling_discard_pile = 0
 
-    def __init__(self, players, num_cards, is_interactive = False):
+    def __init__(self, players, num_cards, is_interactive = False, sink = None, num_decks = 1):
         self.completed = False
         self.curr_player = None
         self.num_cards = num_cards
+        self.num_decks = num_decks
+        if num_decks > 1:
+            # Masked piles hold at most one copy of each card
+            self.pile_class = MultisetCardPile
         self.players = players
+        self.next_player = {}
         self.is_interactive = is_interactive
+        self.rng = random
+        if sink is None:
+            sink = ConsoleSink() if is_interactive else NULL_SINK
+        self.sink = sink
+        self.winner = None
+        self.num_turns = 0
+        self.num_draws = 0
         if is_interactive:
             self.players[0].isManual = True
             self.players[0].name = input('Enter player name: ')
             
 
+    def clone(self, rng = None):
+        # Independent copy of the game for lookahead, with its own players, piles and
+        # random state.  The clone does not send events to any sink.
+        game = copy.copy(self)
+        game.sink = NULL_SINK
+        # Snapshot first: reading a lazily shuffled deck draws from the rng
+        state = self.snapshot()
+        if rng is None:
+            rng = random.Random()
+            rng.setstate(self.rng.getstate())
+        game.rng = rng
+        game.players = []
+        for p in self.players:
+            player = copy.copy(p)
+            player.hand = self.pile_class()
+            game.players.append(player)
+        game.deck = self.deck_class()
+        game.discard_pile = self.pile_class(visible = True)
+        game.restore(state)
+        return game
+
     def deal_cards(self, num_cards: int):
         i = 0
         while i < num_cards:
@@ -46,37 +142,57 @@ class CardGame:
                 p.hand.add_card(self.deck.pop_card(0))
             i = i + 1
 
-    def display_game(self):
-        print('')
-        print(self.name)
+    def describe_game(self):
+        # Lines describing the table, as shown after every turn
+        lines = [self.name]
         for p in self.players:
             if self.is_interactive and p.isManual == False:
-                print(p.name + ': ' + str(len(p.hand.cards)) + ' cards')
+                lines.append(p.name + ': ' + str(len(p.hand)) + ' cards')
             else: 
-                print(p.name + ': ' + p.hand.display_cards())
-        if len(self.discard_pile.cards) == 0:
-            print('Discard pile: ')
+                lines.append(p.name + ': ' + p.hand.display_cards())
+        if len(self.discard_pile) == 0:
+            lines.append('Discard pile: ')
         else:
-            print('Discard pile: ' + self.discard_pile.cards[-1].label)
-        print('Current turn: ' + self.curr_player.name)
+            lines.append('Discard pile: ' + self.discard_pile.cards[-1].label)
+        lines.append('Current turn: ' + self.curr_player.name)
+        return lines
+
+    def display_game(self):
+        print('\n' + '\n'.join(self.describe_game()))
 
     def draw_card(self, player: CardPlayer):
 
         card = self.deck.pop_card(0)
         player.hand.add_card(card)
-        if self.is_interactive and player.isManual == False:
-            print(player.name + ' draws a card')
-        else:
-            print(player.name + ' draws ' + card.label)
-        if len(self.deck.cards) == 0:
+        self.num_draws += 1
+        if self.sink.active:
+            self.sink.emit(self, DRAW, player, card)
+        if len(self.deck) == 0:
             if self.times_recycling_discard_pile < self.max_times_recycling_discard_pile:
                 self.recycle_discard_pile()
                 self.times_recycling_discard_pile += 1
+                if self.sink.active:
+                    self.sink.emit(self, RECYCLE, None, self.times_recycling_discard_pile)
+                if len(self.deck) == 0:
+                    # Every other card is in a player's hand, so nothing is left to draw
+                    self.completed = True
+                    if self.sink.active:
+                        self.sink.emit(self, NO_CARDS)
             else:
                 self.completed = True
-                print('Recycled discard pile ' + str(self.times_recycling_discard_pile) + ' times.  Game over.')
+                if self.sink.active:
+                    self.sink.emit(self, RECYCLE_CAP, None, self.times_recycling_discard_pile)
         return card
 
+    def end_turn(self):
+        # Pass the turn to the next player and check whether the game is over
+        self.num_turns += 1
+        self.curr_player = self.get_next_player()
+        if self.sink.active:
+            top = self.discard_pile.cards[-1] if len(self.discard_pile) else None
+            self.sink.emit(self, TURN, self.curr_player, top)
+        self.update_status()
+
     def find_playable_cards(self, player: CardPlayer):
         # For this basic card game, all cards in the player's hand can be played
         return player.hand
@@ -87,34 +203,56 @@ class CardGame:
         if self.curr_player is None:
             return self.players[0]
         else: 
-            curr_pos = self.players.index(self.curr_player)
-            next_pos = curr_pos + 1
-            if next_pos == len(self.players):
-                next_pos = 0
-            return self.players[next_pos]
+            player = self.next_player.get(self.curr_player)
+            if player is None:
+                # Players were replaced since the ring was built
+                self.update_turn_order()
+                player = self.next_player[self.curr_player]
+            return player
+
+    def legal_moves(self, player: CardPlayer):
+        # Moves open to the player: any card from the hand, or 'd' to draw
+        return list(self.find_playable_cards(player).cards) + ['d']
 
     def play_card(self, card: Card, player: CardPlayer):
         self.discard_pile.add_card(card, source_pile=player.hand)
-        print(player.name + ' plays ' + card.label)
+        if self.sink.active:
+            self.sink.emit(self, PLAY, player, card)
+        if len(player.hand) == 0:
+            # Only a play can empty a hand, so the winner is found here rather than
+            # by checking every hand after every turn
+            self.winner = player
 
     def play_game(self):
         while not self.completed:
             self.play_turn()
-            self.curr_player = self.get_next_player()
-            self.display_game()
-            self.update_status()
-        print('Game over')
+            self.end_turn()
+        if self.sink.active:
+            self.sink.emit(self, GAME_OVER)
+            self.sink.flush()
+
+    def play_move(self, move):
+        # Make a move for the current player: 'd' to draw, or a Card to play
+        if move == 'd':
+            self.draw_card(self.curr_player)
+        else:
+            self.play_card(move, self.curr_player)
 
     def play_turn(self):
         if self.curr_player.isManual:
             self.play_turn_manual()
         else:
-            self.play_turn_auto()
+            # Players with their own strategy choose the move, otherwise the game's strategy is used
+            move = self.curr_player.choose_move(self)
+            if move is None:
+                self.play_turn_auto()
+            else:
+                self.play_move(move)
 
     def play_turn_auto(self):
         # Strategy - Here the random strategy is play a card from the hand 80% of the time, and draw the other 20%
         choices = [1,2,3,4,5]
-        random.shuffle(choices)
+        self.rng.shuffle(choices)
         choice = choices[0]
         # Draw a card from the deck
         if choice == 1:
@@ -151,14 +289,59 @@ class CardGame:
     
     def recycle_discard_pile(self):
         # Move all cards from discard pile to deck except for top card
-        topcard = self.discard_pile.pop_card(0)
-        for c in self.discard_pile.cards:
-            self.discard_pile.remove_card(c, target_pile=self.deck)
-        self.discard_pile.add_card(topcard)
+        cards = self.discard_pile.cards
+        if len(cards) > 1:
+            self.deck.add_cards(cards[:-1])
+            self.discard_pile.cards = cards[-1:]
         # Shuffle the deck
-        random.shuffle(self.deck.cards)
+        self.deck.shuffle_cards(self.rng)
         return
 
+    def reset(self, seed = None, deck_order = None):
+        # Rewind the game in place for a new deal, reusing the deck, piles and players
+        # setup_game must have been called once before
+        # deck_order (Cards, top first) deals a known deck instead of shuffling
+        if seed is not None:
+            if self.rng is random:
+                self.rng = random.Random(seed)
+            else:
+                self.rng.seed(seed)
+        self.completed = False
+        self.winner = None
+        self.num_turns = 0
+        self.num_draws = 0
+        self.times_recycling_discard_pile = 0
+        # Gather all cards back into the deck and shuffle
+        self.discard_pile.clear()
+        for p in self.players:
+            p.hand.clear()
+        self.deck.clear()
+        if deck_order is None:
+            self.deck.add_cards(CARD_TABLE * self.num_decks)
+            self.deck.shuffle_cards(self.rng)
+        else:
+            self.deck.cards = list(deck_order)
+        # Deal cards and determine first player
+        self.deal_cards(self.num_cards)
+        if self.turn_over_first_card:
+            card = self.deck.pop_card(0)
+            self.discard_pile.add_card(card)
+        self.curr_player = self.players[0]
+
+    def restore(self, state: GameState):
+        # Put the game back into a state taken with snapshot().  The players must be
+        # seated in the same order as when the snapshot was taken.
+        self.deck.cards = _cards(state.deck)
+        for p, hand in zip(self.players, state.hands):
+            p.hand.cards = _cards(hand)
+        self.discard_pile.cards = _cards(state.discard)
+        self.curr_player = self.players[state.curr_player]
+        self.times_recycling_discard_pile = state.recycles
+        self.completed = state.completed
+        self.winner = None if state.winner is None else self.players[state.winner]
+        self.num_turns = state.num_turns
+        self.num_draws = state.num_draws
+
     def select_card_to_play(self, player: CardPlayer, playable_cards: CardPile):
         # For this basic card game, just select the first one
         if len(playable_cards.cards) > 0:
@@ -169,29 +352,44 @@ class CardGame:
             return None
 
     def setup_game(self):
-        # Create a new deck
-        self.deck = standard_deck()
-        self.deck.shuffle_cards()
-        # Make sure discard pile and player hands are cleared
-        self.discard_pile = CardPile(visible = True)
+        # Create a new deck, discard pile and player hands, then deal
+        self.deck = standard_deck(self.num_decks, self.deck_class)
+        self.discard_pile = self.pile_class(visible = True)
         for p in self.players:
-            p.hand = CardPile()
-        # Deal cards and determine first player
-        self.deal_cards(self.num_cards)
-        if self.turn_over_first_card:
-            card = self.deck.pop_card(0)
-            self.discard_pile.add_card(card)
-        self.curr_player = self.players[0]
+            p.hand = self.pile_class()
+        self.update_turn_order()
+        self.reset()
         # self.display_game()
 
+    def snapshot(self):
+        # Compact copy of the game state that can be given to restore().  Snapshots are
+        # immutable, so any number of clones can share one.
+        winner = None
+        if self.winner is not None:
+            winner = self.players.index(self.winner)
+        return GameState(_ordinals(self.deck.cards),
+                         tuple([_ordinals(p.hand.cards) for p in self.players]),
+                         _ordinals(self.discard_pile.cards),
+                         self.players.index(self.curr_player),
+                         self.times_recycling_discard_pile,
+                         self.completed,
+                         winner,
+                         self.num_turns,
+                         self.num_draws)
+
     def update_status(self):
-        # Check to see if game is complete - here the check is for which player has no cards left
-        for p in self.players:
-            if len(p.hand.cards) == 0:
-                print(p.name + ' has no cards left. ' + p.name + ' is the winner!')
-                self.completed = True
-                return
+        # Check to see if game is complete - here the check is whether play_card emptied a hand
+        if self.winner is not None and not self.completed:
+            if self.sink.active:
+                self.sink.emit(self, WIN, self.winner)
+            self.completed = True
         return
+
+    def update_turn_order(self):
+        # Build the ring of players so that get_next_player is a single lookup.
+        # Call again after changing self.players.
+        n = len(self.players)
+        self.next_player = {p: self.players[(i + 1) % n] for i, p in enumerate(self.players)}
         
 
 def test_CardGame():
@@ -201,7 +399,7 @@ def test_CardGame():
     players = [p1,p2]
 
     # game = CardGame(players, num_cards=5, is_interactive=True)
-    game = CardGame(players, num_cards=5)
+    game = CardGame(players, num_cards=5, sink=ConsoleSink())
     game.setup_game()
     game.display_game()
     game.play_game()
@@ -1,6 +1,20 @@
-from card import Card, SUIT_DICT, CARD_DICT
+from card import Card, CARD_TABLE, SUIT_DICT, CARD_DICT, SUIT_BITS, SUIT_INDEX, FACE_MASKS
 import random
 
+def face_mask(faces):
+    # Mask of every card with one of the given faces
+    mask = 0
+    for f in faces:
+        mask |= FACE_MASKS[f]
+    return mask
+
+
+# Zero counts used to clear a MultisetCardPile in place
+_NO_CARDS = (0,) * 52
+_NO_SUITS = (0,) * 4
+_NO_FACES = (0,) * 13
+
+
 class CardPile:
     """ Pile of cards
 
@@ -34,6 +48,9 @@ class CardPile:
         self.cards = []
         self.visible = visible
 
+    def __len__(self):
+        return len(self._cards)
+
     def add_card(self, card: Card, source_pile = None):
         c = card
         if source_pile:
@@ -48,6 +65,14 @@ class CardPile:
         self.cards.append(c)
         return c
 
+    def add_cards(self, cards):
+        # Add a batch of cards to the end of the pile in one step
+        self.cards.extend(cards)
+
+    def clear(self):
+        # Remove all cards, keeping the same list
+        self._cards.clear()
+
     def contains_card(self, card: Card):
         # Check if any card in the pile matches a particular card value (e.g. '7c')
         # If so, return a reference to the matching card in the pile
@@ -56,21 +81,23 @@ class CardPile:
                 return c
         return None
 
-    def count_by_suit(self, suits = ['c','d','h','s']):
-        # Returns a dictionary with suit and count of cards
+    def content_key(self):
+        # Hashable key that is the same for any two piles holding the same cards, in any order
+        return tuple(sorted([c.ordinal for c in self.cards]))
+
+    def count_by_suit(self, suits = ['c','d','h','s'], exclude_faces = ()):
+        # Returns a dictionary with suit and count of cards, ignoring cards in exclude_faces
         # Example: count_by_suit(['c','d','h','s']) 
         suit_count = dict()
         for s in suits:
             suit_count[s] = 0
         for c in self.cards:
-            suit_count[c.suit] = suit_count.get(c.suit,0) + 1 
+            if c.face not in exclude_faces:
+                suit_count[c.suit] = suit_count.get(c.suit,0) + 1 
         return suit_count
 
     def display_cards(self):
-        s = ''
-        for c in self.cards:
-            s = s + c.label + ' '
-        return s
+        return ''.join([c.label + ' ' for c in self.cards])
 
     def extract_cards(self, faces):
         # Get cards that match a set of faces - also returns the remaining cards
@@ -79,20 +106,20 @@ class CardPile:
         match = CardPile()
         remainder = CardPile()
         for c in self.cards:
-            for f in faces:
-                if c.face == f:
-                    match.add_card(c)
-                else:
-                    remainder.add_card(c)
+            if c.face in faces:
+                match.add_card(c)
+            else:
+                remainder.add_card(c)
         return (match, remainder)
 
-    def get_highest_card_by_suit(self, suits = ['c','d','h','s']):
-        # Returns dictionary with highest ranking card in each suit
+    def get_highest_card_by_suit(self, suits = ['c','d','h','s'], exclude_faces = ()):
+        # Returns dictionary with highest ranking card in each suit, ignoring cards in exclude_faces
+        # and cards of suits not in suits
         suit_rank = dict()
         for s in suits:
             suit_rank[s] = 0
         for c in self.cards:
-            if c.rank > suit_rank[c.suit]:
+            if c.suit in suit_rank and c.rank > suit_rank[c.suit] and c.face not in exclude_faces:
                 suit_rank[c.suit] = c.rank
         return suit_rank
 
@@ -112,17 +139,405 @@ class CardPile:
             return None
         return c
 
-    def shuffle_cards(self):
-        random.shuffle(self.cards)
+    def shuffle_cards(self, rng = random):
+        # rng is the random module or a random.Random instance
+        rng.shuffle(self.cards)
+
+
+class MaskedCardPile(CardPile):
+    """ Pile of distinct cards that also tracks its contents as a 52-bit mask
+
+    Keeps the order of the cards (so display and iteration are unchanged) and
+    answers membership, suit counts, highest rank by suit and face extraction
+    with bit operations on the mask instead of scanning the cards.
+    Only suitable for piles drawn from a single deck, where no card can appear twice.
+
+    Attributes:
+        cards:  
+            collection of Card objects
+        mask:
+            bit card.ordinal is set for every card in the pile
+        visible:
+            if true, each Card is visible to all players
+
+    """
+
+    @property
+    def cards(self):
+        return self._cards
+
+    @cards.setter
+    def cards(self, value):
+        mask = 0
+        for c in value:
+            mask |= c.bit
+        self._cards = value
+        self._mask = mask
+
+    @property
+    def mask(self):
+        return self._mask
+
+    def add_card(self, card: Card, source_pile = None):
+        if source_pile:
+            # Cards are interned, so the matching card in the source pile is the card itself
+            if not source_pile.remove_card(card):
+                return None
+        self._cards.append(card)
+        self._mask |= card.bit
+        return card
+
+    def add_cards(self, cards):
+        mask = self._mask
+        for c in cards:
+            mask |= c.bit
+        self._cards.extend(cards)
+        self._mask = mask
+
+    def clear(self):
+        self._cards.clear()
+        self._mask = 0
+
+    def contains_card(self, card: Card):
+        if self._mask & card.bit:
+            return card
+        return None
+
+    def content_key(self):
+        return self._mask
+
+    def count_by_suit(self, suits = ['c','d','h','s'], exclude_faces = ()):
+        mask = self._mask & ~face_mask(exclude_faces)
+        suit_count = dict()
+        for s in suits:
+            suit_count[s] = ((mask >> (13 * SUIT_INDEX[s])) & SUIT_BITS).bit_count()
+        return suit_count
+
+    def extract_cards(self, faces):
+        # Same result as CardPile.extract_cards, with the face test done on the mask
+        match_mask, remainder_mask = self.extract_mask(faces)
+        match = MaskedCardPile()
+        remainder = MaskedCardPile()
+        if match_mask == 0:
+            remainder.cards = list(self._cards)
+        elif remainder_mask == 0:
+            match.cards = list(self._cards)
+        else:
+            match.cards = [c for c in self._cards if c.bit & match_mask]
+            remainder.cards = [c for c in self._cards if c.bit & remainder_mask]
+        return (match, remainder)
+
+    def extract_mask(self, faces):
+        # Masks of the cards matching a set of faces and of the remaining cards
+        match_mask = self._mask & face_mask(faces)
+        return (match_mask, self._mask ^ match_mask)
+
+    def get_highest_card_by_suit(self, suits = ['c','d','h','s'], exclude_faces = ()):
+        mask = self._mask & ~face_mask(exclude_faces)
+        suit_rank = dict()
+        for s in suits:
+            bits = (mask >> (13 * SUIT_INDEX[s])) & SUIT_BITS
+            # Bit 0 is rank 2, so the highest set bit gives the highest rank
+            suit_rank[s] = bits.bit_length() + 1 if bits else 0
+        return suit_rank
+
+    def pop_card(self, pos: int):
+        if len(self._cards) >= pos + 1:
+            c = self._cards.pop(pos)
+            self._mask ^= c.bit
+            return c
+        else:
+            return None
+
+    def remove_card(self, card: Card, target_pile = None):
+        if not self._mask & card.bit:
+            return None
+        self._cards.remove(card)
+        self._mask ^= card.bit
+        if target_pile:
+            target_pile.add_card(card)
+        return card
+
+
+class MultisetCardPile(CardPile):
+    """ Pile that may hold several copies of a card, with counts kept up to date
+
+    Used for hands in multi-deck games.  The counts per card, per suit and per
+    face, and a mask of the cards present, are updated as cards are added and
+    removed, so contains_card, count_by_suit, get_highest_card_by_suit and
+    finding the cards of a face do not scan the pile.  The cards stay in order.
+
+    Attributes:
+        cards:  
+            collection of Card objects
+        mask:
+            bit card.ordinal is set for every card with at least one copy in the pile
+        visible:
+            if true, each Card is visible to all players
+
+    """
+
+    @property
+    def cards(self):
+        return self._cards
+
+    @cards.setter
+    def cards(self, value):
+        self._cards = value
+        self._counts = [0] * 52
+        self._suit_counts = [0] * 4
+        self._face_counts = [0] * 13
+        self._mask = 0
+        for c in value:
+            self._count_in(c)
+
+    @property
+    def mask(self):
+        return self._mask
+
+    def _count_in(self, c: Card):
+        n = self._counts[c.ordinal]
+        if n == 0:
+            self._mask |= c.bit
+        self._counts[c.ordinal] = n + 1
+        self._suit_counts[c.suit_index] += 1
+        self._face_counts[c.rank - 2] += 1
+
+    def _count_out(self, c: Card):
+        n = self._counts[c.ordinal] - 1
+        if n == 0:
+            self._mask ^= c.bit
+        self._counts[c.ordinal] = n
+        self._suit_counts[c.suit_index] -= 1
+        self._face_counts[c.rank - 2] -= 1
+
+    def add_card(self, card: Card, source_pile = None):
+        if source_pile:
+            if not source_pile.remove_card(card):
+                return None
+        self._cards.append(card)
+        self._count_in(card)
+        return card
+
+    def add_cards(self, cards):
+        self._cards.extend(cards)
+        for c in cards:
+            self._count_in(c)
+
+    def clear(self):
+        self._cards.clear()
+        self._counts[:] = _NO_CARDS
+        self._suit_counts[:] = _NO_SUITS
+        self._face_counts[:] = _NO_FACES
+        self._mask = 0
+
+    def contains_card(self, card: Card):
+        if self._counts[card.ordinal]:
+            return card
+        return None
+
+    def content_key(self):
+        # Copies are counted, so the mask alone would not do
+        return bytes(self._counts)
+
+    def count_card(self, card: Card):
+        # Number of copies of a card in the pile
+        return self._counts[card.ordinal]
+
+    def count_by_suit(self, suits = ['c','d','h','s'], exclude_faces = ()):
+        suit_count = dict()
+        for s in suits:
+            i = SUIT_INDEX[s]
+            n = self._suit_counts[i]
+            for f in exclude_faces:
+                n -= self._counts[13 * i + CARD_DICT[f]['rank'] - 2]
+            suit_count[s] = n
+        return suit_count
+
+    def extract_cards(self, faces):
+        match = MultisetCardPile()
+        remainder = MultisetCardPile()
+        if not any(self._face_counts[CARD_DICT[f]['rank'] - 2] for f in faces):
+            remainder.cards = list(self._cards)
+            return (match, remainder)
+        match_mask = self._mask & face_mask(faces)
+        match.cards = [c for c in self._cards if c.bit & match_mask]
+        remainder.cards = [c for c in self._cards if not c.bit & match_mask]
+        return (match, remainder)
+
+    def get_highest_card_by_suit(self, suits = ['c','d','h','s'], exclude_faces = ()):
+        mask = self._mask & ~face_mask(exclude_faces)
+        suit_rank = dict()
+        for s in suits:
+            bits = (mask >> (13 * SUIT_INDEX[s])) & SUIT_BITS
+            suit_rank[s] = bits.bit_length() + 1 if bits else 0
+        return suit_rank
+
+    def pop_card(self, pos: int):
+        if len(self._cards) >= pos + 1:
+            c = self._cards.pop(pos)
+            self._count_out(c)
+            return c
+        else:
+            return None
+
+    def remove_card(self, card: Card, target_pile = None):
+        if not self._counts[card.ordinal]:
+            return None
+        self._cards.remove(card)
+        self._count_out(card)
+        if target_pile:
+            target_pile.add_card(card)
+        return card
+
+
+class DrawPile(CardPile):
+    """ Pile of cards that is drawn from the top, such as the deck
+
+    cards[0] is the top of the pile, as for CardPile, but the cards are stored
+    bottom to top so that drawing the top card with pop_card(0) is O(1).
+    Reading cards returns a new top-first list; use add_card, add_cards,
+    pop_card, remove_card and shuffle_cards to change the pile.
+
+    Attributes:
+        cards:  
+            collection of Card objects, top card first
+        visible:
+            if true, each Card is visible to all players
+
+    """
+
+    @property
+    def cards(self):
+        return self._cards[::-1]
+
+    @cards.setter
+    def cards(self, value):
+        self._cards = value[::-1]
+
+    def add_card(self, card: Card, source_pile = None):
+        c = card
+        if source_pile:
+            c = source_pile.contains_card(card)
+            if c:
+                source_pile.remove_card(c)
+            else:
+                return None
+        # Added cards go to the bottom of the pile
+        self._cards.insert(0, c)
+        return c
+
+    def add_cards(self, cards):
+        self._cards[0:0] = cards[::-1]
+
+    def contains_card(self, card: Card):
+        for c in self._cards:
+            if c == card:
+                return c
+        return None
+
+    def pop_card(self, pos: int):
+        if len(self._cards) >= pos + 1:
+            return self._cards.pop(-1 - pos)
+        else:
+            return None
+
+    def remove_card(self, card: Card, target_pile = None):
+        c = self.contains_card(card)
+        if c:
+            self._cards.remove(c)
+            if target_pile:
+                target_pile.add_card(c)
+        else:
+            return None
+        return c
+
+    def shuffle_cards(self, rng = random):
+        rng.shuffle(self._cards)
+
+
+class LazyDrawPile(DrawPile):
+    """ Draw pile that is shuffled one card at a time, as cards are drawn
+
+    shuffle_cards only marks the pile as shuffled.  Each draw from the top then
+    takes a card uniformly at random from the rest of the pile, which is one
+    step of a Fisher-Yates shuffle, so the cost of shuffling grows with the
+    number of cards drawn rather than the size of the pile.  Every order of
+    draws is as likely as after a full shuffle, and the same rng state gives
+    the same draws (though not the same draws as DrawPile).  Anything that
+    needs the order of the rest of the pile - reading cards, adding cards to
+    the bottom, popping below the top - first finishes the shuffle with the
+    same rng.
+
+    Attributes:
+        cards:  
+            collection of Card objects, top card first
+        visible:
+            if true, each Card is visible to all players
+
+    """
+
+    @property
+    def cards(self):
+        if self._rng is not None:
+            self._finish_shuffle()
+        return self._cards[::-1]
+
+    @cards.setter
+    def cards(self, value):
+        self._cards = value[::-1]
+        self._rng = None
+
+    def _finish_shuffle(self):
+        self._rng.shuffle(self._cards)
+        self._rng = None
+
+    def add_card(self, card: Card, source_pile = None):
+        if self._rng is not None:
+            self._finish_shuffle()
+        return super().add_card(card, source_pile)
+
+    def add_cards(self, cards):
+        if self._rng is not None:
+            self._finish_shuffle()
+        self._cards[0:0] = cards[::-1]
+
+    def clear(self):
+        self._cards.clear()
+        self._rng = None
+
+    def pop_card(self, pos: int):
+        cards = self._cards
+        if self._rng is None or pos != 0:
+            if self._rng is not None:
+                self._finish_shuffle()
+            if len(cards) >= pos + 1:
+                return cards.pop(-1 - pos)
+            return None
+        if not cards:
+            return None
+        # Draw a card uniformly at random (rejection sampling on random bits, as
+        # random.shuffle does) and fill its place with the card stored last
+        n = len(cards)
+        k = n.bit_length()
+        getrandbits = self._rng.getrandbits
+        i = getrandbits(k)
+        while i >= n:
+            i = getrandbits(k)
+        c = cards[i]
+        cards[i] = cards[-1]
+        cards.pop()
+        return c
+
+    def shuffle_cards(self, rng = random):
+        self._rng = rng
 
 
-def standard_deck():
-    # Create standard deck
-    deck = CardPile()
-    for s in SUIT_DICT.keys():
-        for c in CARD_DICT.keys():
-            card = Card(c,s)
-            deck.add_card(card)
+def standard_deck(num_decks: int = 1, pile_class = DrawPile):
+    # Create a deck of num_decks standard decks from the canonical cards (no new Card objects)
+    # pile_class is DrawPile, or LazyDrawPile to shuffle as cards are drawn
+    deck = pile_class()
+    deck.cards = list(CARD_TABLE) * num_decks
     return deck
 
 
@@ -175,6 +590,67 @@ def test_CardPile():
     ranks = pile.get_highest_card_by_suit()
     print('ranks ', ranks)
 
-    
+    mpile = MaskedCardPile()
+    mpile.cards = list(pile.cards)
+    print('masked pile: ' + mpile.display_cards() + ' mask: ' + hex(mpile.mask))
+    print('masked contains 7c: ' + str(mpile.contains_card(c4) is c4))
+    sevens, non_sevens = mpile.extract_cards(['7'])
+    print('masked sevens: ' + sevens.display_cards())
+    print('masked suits: ', mpile.count_by_suit())
+    print('masked ranks: ', mpile.get_highest_card_by_suit())
+    print('ranks of clubs and hearts agree: '
+          + str(pile.get_highest_card_by_suit(['c', 'h']) == mpile.get_highest_card_by_suit(['c', 'h'])))
+    mpile.remove_card(c4, cp)
+    print('masked pile after removing 7c: ' + mpile.display_cards() + ' mask: ' + hex(mpile.mask))
+
+    two_decks = MultisetCardPile()
+    two_decks.add_cards([c1, c3, c3, Card('8','s'), c2])
+    print('multiset pile: ' + two_decks.display_cards())
+    print('copies of 7s: ' + str(two_decks.count_card(c3)))
+    print('multiset suits without eights: ', two_decks.count_by_suit(exclude_faces=['8']))
+    print('multiset ranks without eights: ', two_decks.get_highest_card_by_suit(exclude_faces=['8']))
+    two_decks.remove_card(c3)
+    print('after removing one 7s: ' + two_decks.display_cards() + ' copies of 7s: ' + str(two_decks.count_card(c3)))
+
+
+
+def test_LazyDrawPile():
+    import time
+    # The same seed draws the same cards
+    draws = []
+    for i in range(2):
+        deck = standard_deck(pile_class=LazyDrawPile)
+        deck.shuffle_cards(random.Random(5))
+        draws.append([deck.pop_card(0).label for i in range(5)] + [c.label for c in deck.cards[:3]])
+    print('lazy draws: ' + ' '.join(draws[0]) + ', repeatable: ' + str(draws[0] == draws[1]))
+    # Every card is equally likely at every position: chi-square over the first three draws
+    rng = random.Random(1)
+    trials = 26000
+    counts = [[0] * 52 for i in range(3)]
+    deck = standard_deck(pile_class=LazyDrawPile)
+    for t in range(trials):
+        deck.clear()
+        deck.add_cards(CARD_TABLE)
+        deck.shuffle_cards(rng)
+        for pos in range(3):
+            counts[pos][deck.pop_card(0).ordinal] += 1
+    expected = trials / 52
+    chi2 = [round(sum((n - expected) ** 2 / expected for n in row), 1) for row in counts]
+    print('chi-square by draw (51 d.o.f., 99% point 77.4): ', chi2)
+    # Shuffle and draw 15 cards: full shuffle against lazy shuffle
+    for pile_class in (DrawPile, LazyDrawPile):
+        deck = standard_deck(pile_class=pile_class)
+        start = time.perf_counter()
+        for t in range(20000):
+            deck.clear()
+            deck.add_cards(CARD_TABLE)
+            deck.shuffle_cards(rng)
+            for i in range(15):
+                deck.pop_card(0)
+        print(pile_class.__name__ + ': ' + str(round((time.perf_counter() - start) / 20000 * 1e6, 2))
+              + ' us to shuffle and draw 15')
+
+
 if __name__ == '__main__':
-    test_CardPile()
\ No newline at end of file
+    test_CardPile()
+    test_LazyDrawPile()
\ No newline at end of file
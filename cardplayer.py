@@ -23,6 +23,15 @@ class CardPlayer:
         self.hand = CardPile()
         # self.drawn = CardPile()
     
+    def choose_move(self, game):
+        # Move for an automated player: a Card to play, 'd' to draw, or None to
+        # let the game's own strategy decide.  Subclasses implement other strategies.
+        return None
+
+    def choose_suit(self, game):
+        # Suit to call after playing a crazy eight, or None to let the game decide
+        return None
+
     @property
     def isManual(self):
         return self._isManual
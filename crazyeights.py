@@ -1,7 +1,76 @@
-from card import Card
-from cardpile import CardPile
+from card import Card, CARD_TABLE, SUITS, SUIT_INDEX, SUIT_BITS, SUIT_MASKS, FACE_MASKS
+from cardpile import CardPile, MaskedCardPile
 from cardgame import CardGame, test_CardGame
 from cardplayer import CardPlayer
+from gameevents import SUIT
+from collections import OrderedDict
+
+
+EIGHTS_MASK = FACE_MASKS['8']
+
+# PLAYABLE_MASKS[top.ordinal][suit index]: mask of every card that may be played on
+# top when that suit is current - same rank as the top card, the current suit, or an eight
+PLAYABLE_MASKS = [[FACE_MASKS[top.face] | SUIT_MASKS[s] | EIGHTS_MASK for s in SUITS] for top in CARD_TABLE]
+
+
+class DecisionCache:
+    """ Bounded least-recently-used cache of CrazyEights decisions
+
+    One cache can be shared by any number of games: set it as a game's
+    decision_cache, or on a CrazyEights subclass for all of its games.  Keys
+    start with the game class, so a subclass that overrides the heuristics
+    never gets answers worked out by another class.
+
+    Attributes:
+        evictions: int
+            entries dropped to stay within maxsize
+        hits: int
+            lookups answered from the cache
+        maxsize: int
+            largest number of entries kept
+        misses: int
+            lookups that had to be worked out
+    """
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # Cached value, or None (values are never None)
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        entries = self.entries
+        entries[key] = value
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
 
 
 class CrazyEights(CardGame):
@@ -14,6 +83,8 @@ class CrazyEights(CardGame):
             if true, then game is completed and no more turns are necessary
         curr_player: CardPlayer
             player with current turn
+        decision_cache: DecisionCache
+            if set, card and suit choices of automated turns are looked up here first
         deck: CardPile
             collection of Cards
         name: str
@@ -24,37 +95,162 @@ class CrazyEights(CardGame):
             collection of CardPlayers
     """
     name = 'Crazy Eights'
+    pile_class = MaskedCardPile
     current_suit = None
+    decision_cache = None
 
-    def display_game(self):
-        super().display_game()
-        print('Current suit: ' + self.current_suit)
+    def describe_game(self):
+        lines = super().describe_game()
+        lines.append('Current suit: ' + self.current_suit)
+        return lines
 
     def find_playable_cards(self, player):
+        if isinstance(player.hand, MaskedCardPile):
+            # Look up the legal cards and keep them in hand order
+            mask = self.find_playable_mask(player)
+            playable_cards = MaskedCardPile()
+            playable_cards.cards = [c for c in player.hand.cards if c.bit & mask]
+            return playable_cards
         # Find cards with same rank
-        playable_cards = CardPile()
+        playable_cards = type(player.hand)()
         current_rank = self.discard_pile.cards[-1].rank
         for card in player.hand.cards:
             if (card.rank == current_rank) or (card.suit == self.current_suit) or (card.rank == 8):
                 playable_cards.add_card(card) 
         return playable_cards
 
+    def find_playable_mask(self, player):
+        # Mask of the cards in a MaskedCardPile hand that can be played
+        top = self.discard_pile.cards[-1]
+        return player.hand.mask & PLAYABLE_MASKS[top.ordinal][SUIT_INDEX[self.current_suit]]
+
+    def uses_mask_heuristics(self):
+        # The mask path makes the same choices as find_playable_cards and select_card_to_play,
+        # so it is only taken when neither is overridden and the hand keeps a mask
+        cls = type(self)
+        return (cls.find_playable_cards is CrazyEights.find_playable_cards
+                and cls.select_card_to_play is CrazyEights.select_card_to_play
+                and isinstance(self.curr_player.hand, MaskedCardPile))
+
+    def cached_card_from_mask(self, player, mask: int):
+        # select_card_from_mask through the decision cache.  The best cards depend only on
+        # the playable cards (the hand, top card and current suit are all folded into the
+        # mask), and the cache holds all of the equally good ones: a tie is still broken by
+        # the order of this hand.
+        key = ('card', type(self), mask)
+        choices = self.decision_cache.get(key)
+        if choices is None:
+            choices = self.card_choices_from_mask(mask)
+            self.decision_cache.put(key, choices)
+        return self.first_card_in_hand(player, choices)
+
+    def cached_card_to_play(self, player, playable_cards):
+        # select_card_to_play through the decision cache, for overridden heuristics and hands
+        # without a mask.  An override may look at the whole hand as well as the playable
+        # cards and the table, so all of them are in the key; the playable cards are keyed
+        # in order, since a tie may go to the card that comes first.
+        key = ('play', type(self), player.hand.content_key(), tuple([c.ordinal for c in playable_cards.cards]),
+               self.discard_pile.cards[-1].ordinal, self.current_suit)
+        card = self.decision_cache.get(key)
+        if card is None:
+            card = self.select_card_to_play(player, playable_cards)
+            self.decision_cache.put(key, card)
+        return card
+
+    def cached_crazy_eight_suit(self, player: CardPlayer):
+        # select_crazy_eight_suit through the decision cache.  The built-in choice depends
+        # only on the hand's contents; an override may also use the order and the table.
+        if type(self).select_crazy_eight_suit is CrazyEights.select_crazy_eight_suit:
+            key = ('suit', type(self), player.hand.content_key())
+        else:
+            key = ('suit', type(self), tuple([c.ordinal for c in player.hand.cards]),
+                   self.discard_pile.cards[-1].ordinal, self.current_suit)
+        suit = self.decision_cache.get(key)
+        if suit is None:
+            suit = self.select_crazy_eight_suit(player)
+            self.decision_cache.put(key, suit)
+        return suit
+
+    def card_choices_from_mask(self, mask: int):
+        # Mask of the best cards in a mask of playable cards, by the rules of
+        # select_card_to_play; more than one bit when hand order has to break the tie
+        if mask & (mask - 1) == 0:
+            return mask
+        non_eights = mask & ~EIGHTS_MASK
+        if non_eights == 0:
+            # Only eights: the first one in the hand
+            return mask
+        # Most playable cards in the suit, then highest rank
+        best_key = 0
+        best = 0
+        for i in range(4):
+            bits = (non_eights >> (13 * i)) & SUIT_BITS
+            if bits:
+                key = bits.bit_count() * 16 + bits.bit_length()
+                top_bit = 1 << (13 * i + bits.bit_length() - 1)
+                if key > best_key:
+                    best_key = key
+                    best = top_bit
+                elif key == best_key:
+                    best |= top_bit
+        return best
+
+    def first_card_in_hand(self, player, choices: int):
+        # The card in a mask of choices that comes first in the player's hand
+        if choices & (choices - 1) == 0:
+            return CARD_TABLE[choices.bit_length() - 1]
+        for c in player.hand.cards:
+            if c.bit & choices:
+                return c
+
+    def legal_moves(self, player):
+        # Moves open to the player: a playable card, or 'd' to draw when nothing can be played
+        cards = self.find_playable_cards(player).cards
+        if len(cards) == 0:
+            return ['d']
+        return list(cards)
+
     def play_card(self, card: Card, player: CardPlayer):
         super().play_card(card, player)
         if card.rank == 8:
-            self.current_suit = self.select_crazy_eight_suit(self.curr_player)
-            print(player.name + ' sets current suit to ' + self.current_suit)
+            suit = player.choose_suit(self)
+            if suit is None:
+                if self.decision_cache is None:
+                    suit = self.select_crazy_eight_suit(self.curr_player)
+                else:
+                    suit = self.cached_crazy_eight_suit(self.curr_player)
+            self.current_suit = suit
+            if self.sink.active:
+                self.sink.emit(self, SUIT, player, self.current_suit)
         else:
             self.current_suit = self.discard_pile.cards[-1].suit
 
     def play_turn_auto(self):
+        if self.uses_mask_heuristics():
+            mask = self.find_playable_mask(self.curr_player)
+            if mask == 0:
+                self.draw_card(self.curr_player)
+            else:
+                if self.decision_cache is None:
+                    card = self.select_card_from_mask(self.curr_player, mask)
+                else:
+                    card = self.cached_card_from_mask(self.curr_player, mask)
+                self.play_card(card, self.curr_player)
+            return
         playable_cards = self.find_playable_cards(self.curr_player)
         if len(playable_cards.cards) == 0:
             self.draw_card(self.curr_player)
         else:
-            card = self.select_card_to_play(self.curr_player, playable_cards)
+            if self.decision_cache is None:
+                card = self.select_card_to_play(self.curr_player, playable_cards)
+            else:
+                card = self.cached_card_to_play(self.curr_player, playable_cards)
             self.play_card(card, self.curr_player)
 
+    def restore(self, state):
+        super().restore(state)
+        self.current_suit = state.current_suit
+
     def select_card_to_play(self, player, playable_cards):
         if len(playable_cards.cards) == 1:
             return playable_cards.cards[0]
@@ -79,12 +275,19 @@ class CrazyEights(CardGame):
                             card = c
                 return card
 
+    def select_card_from_mask(self, player, mask: int):
+        # select_card_to_play for a mask of playable cards, without building any piles
+        if mask & (mask - 1) == 0:
+            return CARD_TABLE[mask.bit_length() - 1]
+        return self.first_card_in_hand(player, self.card_choices_from_mask(mask))
+
     def select_crazy_eight_suit(self, player:CardPlayer):
         # Select the right suit to call when playing a 'crazy eight'
+        if isinstance(player.hand, MaskedCardPile):
+            return self.select_suit_from_mask(player.hand.mask)
         # Ignore the eights in the hand
-        eights, non_eights = player.hand.extract_cards(['8'])
-        suits = non_eights.count_by_suit()
-        ranks = non_eights.get_highest_card_by_suit()
+        suits = player.hand.count_by_suit(exclude_faces=['8'])
+        ranks = player.hand.get_highest_card_by_suit(exclude_faces=['8'])
         suit = 'c'
         # print('Select suit - suits: ' + str(suits) + ' ranks: ' + str(ranks))
         for s in ['d','h','s']:
@@ -95,10 +298,27 @@ class CrazyEights(CardGame):
                     suit = s
         return suit
 
-    def setup_game(self):
-        super().setup_game()
+    def select_suit_from_mask(self, mask: int):
+        # select_crazy_eight_suit for a hand mask: most non-eight cards in the suit, then
+        # highest rank, with earlier suits winning ties
+        mask &= ~EIGHTS_MASK
+        suit = 0
+        best_key = -1
+        for i in range(4):
+            bits = (mask >> (13 * i)) & SUIT_BITS
+            key = bits.bit_count() * 16 + bits.bit_length()
+            if key > best_key:
+                best_key = key
+                suit = i
+        return SUITS[suit]
+
+    def reset(self, seed = None, deck_order = None):
+        super().reset(seed, deck_order)
         self.current_suit = self.discard_pile.cards[-1].suit
 
+    def snapshot(self):
+        return super().snapshot()._replace(current_suit=self.current_suit)
+
 
 def test_CrazyEights():
     p1 = CardPlayer('p1')
@@ -113,5 +333,88 @@ def test_CrazyEights():
     game.play_game()
 
 
+def test_clone():
+    import random
+    import time
+    game = CrazyEights([CardPlayer('p1'), CardPlayer('p2'), CardPlayer('p3')], num_cards=5)
+    game.rng = random.Random(3)
+    game.setup_game()
+    for i in range(6):
+        game.play_turn()
+        game.curr_player = game.get_next_player()
+    state = game.snapshot()
+    print('snapshot: ', state)
+    start = time.perf_counter()
+    for i in range(2000):
+        copy = game.clone()
+    print('clones/sec: ' + str(round(2000 / (time.perf_counter() - start))))
+    # A clone with the same random state plays out exactly like the original
+    game.play_game()
+    copy.play_game()
+    print('clone finishes the same way: ' + str(copy.snapshot() == game.snapshot()))
+    game.restore(state)
+    print('restore matches snapshot: ' + str(game.snapshot() == state))
+
+
+def test_party():
+    import random
+    import time
+    from simulation import make_players
+    # Time per turn should not grow with the number of players
+    for num_players, num_decks in [(6, 1), (60, 6), (120, 12)]:
+        game = CrazyEights(make_players(num_players), num_cards=5, num_decks=num_decks)
+        game.rng = random.Random(1)
+        game.setup_game()
+        turns = 0
+        start = time.perf_counter()
+        for i in range(20):
+            game.reset(i)
+            game.play_game()
+            turns += game.num_turns
+        elapsed = time.perf_counter() - start
+        print(str(num_players) + ' players, ' + str(num_decks) + ' decks: '
+              + str(round(elapsed / turns * 1e6, 1)) + ' us/turn over ' + str(turns) + ' turns')
+
+
+def test_decision_cache():
+    import random
+    import time
+    from simulation import make_players, play_silent_game, game_seed
+
+    class HighCard(CrazyEights):
+        def select_card_to_play(self, player, playable_cards):
+            return max(playable_cards.cards, key=lambda c: c.rank)
+
+    class LongSuit(CrazyEights):
+        # Looks at the whole hand, not only the playable cards
+        def select_card_to_play(self, player, playable_cards):
+            counts = player.hand.count_by_suit()
+            return max(playable_cards.cards, key=lambda c: (counts[c.suit], c.rank))
+
+    # The cache must not change a single game, with the built-in heuristics or an override
+    for game_class, num_decks in [(CrazyEights, 1), (HighCard, 1), (LongSuit, 1), (CrazyEights, 2)]:
+        cache = DecisionCache(4096)
+        rates = []
+        results = []
+        for decision_cache in (None, cache):
+            game = game_class(make_players(4), num_cards=5, num_decks=num_decks)
+            game.rng = random.Random()
+            game.setup_game()
+            game.decision_cache = decision_cache
+            start = time.perf_counter()
+            results.append([])
+            for i in range(2000):
+                game.reset(game_seed(1, i))
+                results[-1].append(play_silent_game(game))
+            rates.append(2000 / (time.perf_counter() - start))
+        print(game_class.__name__ + ', ' + str(num_decks) + ' deck(s): same games ' + str(results[0] == results[1])
+              + ', games/sec ' + str(round(rates[0])) + ' -> ' + str(round(rates[1]))
+              + ', hits ' + str(cache.hits) + ', misses ' + str(cache.misses) + ', evictions ' + str(cache.evictions)
+              + ', hit rate ' + str(round(cache.hit_rate, 3)))
+
+
 if __name__ == '__main__':
+    test_clone()
+    test_party()
+    test_decision_cache()
     test_CrazyEights()
\ No newline at end of file
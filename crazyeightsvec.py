@@ -0,0 +1,217 @@
+from card import CARD_TABLE
+from crazyeights import CrazyEights
+from simulation import GameResult, SimulationStats, simulate
+import math
+import numpy as np
+import time
+
+
+# Per-ordinal card properties
+CARD_RANK = np.array([c.rank for c in CARD_TABLE], dtype=np.int16)
+CARD_SUIT = np.array([c.suit_index for c in CARD_TABLE], dtype=np.int16)
+IS_EIGHT = CARD_RANK == 8
+
+# LEGAL[top, suit] is the set of cards that may be played on top when suit is current:
+# same rank as the top card, the current suit, or an eight
+LEGAL = ((CARD_RANK[:, None, None] == CARD_RANK[None, None, :])
+         | (np.arange(4)[None, :, None] == CARD_SUIT[None, None, :])
+         | IS_EIGHT[None, None, :])
+
+
+class VectorCrazyEights:
+    """ Many games of Crazy Eights played in lockstep with NumPy arrays
+
+    Follows the rules and automated strategy of crazyeights.CrazyEights, but
+    advances every unfinished game by one turn with whole-array operations.
+    Ties between equally good cards go to the lowest card ordinal rather than
+    to the first card in the hand, so single games differ from the scalar
+    engine but the statistics match.
+
+    Attributes:
+        num_games: int
+            number of games (B)
+        num_players: int
+            number of players (P) at every table
+        num_cards: int
+            number of cards dealt to each player
+        hands: bool[B, P, 52]
+            hand membership by card ordinal
+        deck: int16[B, 52]
+            deck order; the cards still in the deck are deck[b, deck_top[b]:deck_end[b]]
+        deck_top, deck_end: int[B]
+            position of the top card and end of the deck
+        discard: bool[B, 52]
+            discard pile membership, including the top card
+        top_card: int[B]
+            ordinal of the top card of the discard pile
+        current_suit: int[B]
+            index of the current suit
+        curr_player: int[B]
+            seat of the player with the current turn
+        completed: bool[B]
+            if true, the game is over
+        winner: int[B]
+            seat of the winner, -1 if nobody has emptied their hand
+        turns, draws, recycles: int[B]
+            per-game counters, as in CardGame
+    """
+    max_times_recycling_discard_pile = CrazyEights.max_times_recycling_discard_pile
+
+    def __init__(self, num_games: int, num_players: int, num_cards: int, seed = None):
+        if num_players * num_cards + 1 >= 52:
+            raise ValueError('Not enough cards for ' + str(num_players) + ' players')
+        self.num_games = num_games
+        self.num_players = num_players
+        self.num_cards = num_cards
+        self.rng = np.random.default_rng(seed)
+        self.setup_games()
+
+    def setup_games(self):
+        B, P = self.num_games, self.num_players
+        games = np.arange(B)
+        self.deck = np.argsort(self.rng.random((B, 52)), axis=1).astype(np.int16)
+        # Deal one card at a time to each player in turn, as CardGame.deal_cards does
+        dealt = P * self.num_cards
+        self.hands = np.zeros((B, P, 52), dtype=bool)
+        seats = np.arange(dealt) % P
+        self.hands[games[:, None], seats[None, :], self.deck[:, :dealt]] = True
+        # Turn over the first card
+        self.top_card = self.deck[:, dealt].astype(np.int64)
+        self.discard = np.zeros((B, 52), dtype=bool)
+        self.discard[games, self.top_card] = True
+        self.current_suit = CARD_SUIT[self.top_card].astype(np.int64)
+        self.deck_top = np.full(B, dealt + 1, dtype=np.int64)
+        self.deck_end = np.full(B, 52, dtype=np.int64)
+        self.curr_player = np.zeros(B, dtype=np.int64)
+        self.completed = np.zeros(B, dtype=bool)
+        self.winner = np.full(B, -1, dtype=np.int64)
+        self.turns = np.zeros(B, dtype=np.int64)
+        self.draws = np.zeros(B, dtype=np.int64)
+        self.recycles = np.zeros(B, dtype=np.int64)
+
+    def play_games(self):
+        while not self.completed.all():
+            self.play_turn()
+
+    def play_turn(self):
+        # Advance every unfinished game by one turn
+        active = np.flatnonzero(~self.completed)
+        if len(active) == 0:
+            return
+        seats = self.curr_player[active]
+        playable = LEGAL[self.top_card[active], self.current_suit[active]] & self.hands[active, seats]
+        can_play = playable.any(axis=1)
+        if not can_play.all():
+            self.draw_cards(active[~can_play])
+        if can_play.any():
+            self.play_cards(active[can_play], playable[can_play])
+        self.turns[active] += 1
+        self.curr_player[active] = (seats + 1) % self.num_players
+
+    def draw_cards(self, games):
+        seats = self.curr_player[games]
+        cards = self.deck[games, self.deck_top[games]]
+        self.hands[games, seats, cards] = True
+        self.deck_top[games] += 1
+        self.draws[games] += 1
+        empty = games[self.deck_top[games] == self.deck_end[games]]
+        if len(empty):
+            can_recycle = self.recycles[empty] < self.max_times_recycling_discard_pile
+            self.completed[empty[~can_recycle]] = True
+            recycle = empty[can_recycle]
+            if len(recycle):
+                self.recycle_discard_piles(recycle)
+                self.recycles[recycle] += 1
+                # Nothing left to draw once recycled
+                self.completed[recycle[self.deck_end[recycle] == 0]] = True
+
+    def play_cards(self, games, playable):
+        # Greedy choice from CrazyEights.select_card_to_play: among non-eights, the card
+        # whose suit has the most playable cards, then the highest rank; eights only
+        # when nothing else can be played
+        n = len(games)
+        non_eights = playable & ~IS_EIGHT
+        suit_counts = non_eights.reshape(n, 4, 13).sum(axis=2)
+        score = np.where(non_eights, suit_counts[:, CARD_SUIT] * 16 + CARD_RANK, -1)
+        choice = np.where(non_eights.any(axis=1), score.argmax(axis=1), playable.argmax(axis=1))
+        seats = self.curr_player[games]
+        self.hands[games, seats, choice] = False
+        self.discard[games, choice] = True
+        self.top_card[games] = choice
+        self.current_suit[games] = CARD_SUIT[choice]
+        eights = IS_EIGHT[choice]
+        if eights.any():
+            self.current_suit[games[eights]] = self.select_crazy_eight_suits(games[eights])
+        out = ~self.hands[games, seats].any(axis=1)
+        self.winner[games[out]] = seats[out]
+        self.completed[games[out]] = True
+
+    def select_crazy_eight_suits(self, games):
+        # CrazyEights.select_crazy_eight_suit: the suit with the most non-eight cards in the
+        # hand, then the highest card, preferring clubs, diamonds, hearts, spades in that order
+        n = len(games)
+        hand = (self.hands[games, self.curr_player[games]] & ~IS_EIGHT).reshape(n, 4, 13)
+        counts = hand.sum(axis=2)
+        highest = np.where(hand, CARD_RANK[:13], 0).max(axis=2)
+        return (counts * 16 + highest).argmax(axis=1)
+
+    def recycle_discard_piles(self, games):
+        # Move every discard except the top card into the deck, in random order
+        n = len(games)
+        rest = self.discard[games].copy()
+        rest[np.arange(n), self.top_card[games]] = False
+        keys = np.where(rest, self.rng.random((n, 52)), 2.0)
+        self.deck[games] = np.argsort(keys, axis=1)
+        self.deck_top[games] = 0
+        self.deck_end[games] = rest.sum(axis=1)
+        self.discard[games] = False
+        self.discard[games, self.top_card[games]] = True
+
+    def results(self):
+        # One GameResult per game, as returned by simulation.simulate
+        capped = (self.winner < 0) & (self.recycles >= self.max_times_recycling_discard_pile)
+        return [GameResult(None if w < 0 else int(w), int(t), int(d), int(r), bool(c))
+                for w, t, d, r, c in zip(self.winner, self.turns, self.draws, self.recycles, capped)]
+
+    def stats(self):
+        stats = SimulationStats(self.num_players)
+        stats.games = self.num_games
+        stats.wins = np.bincount(self.winner[self.winner >= 0], minlength=self.num_players).tolist()
+        stats.turns = int(self.turns.sum())
+        stats.turns_sq = int((self.turns * self.turns).sum())
+        stats.draws = int(self.draws.sum())
+        stats.recycles = int(self.recycles.sum())
+        stats.capped = int(((self.winner < 0) & (self.recycles >= self.max_times_recycling_discard_pile)).sum())
+        return stats
+
+
+def test_VectorCrazyEights():
+    n_games = 4000
+    for num_players, num_cards in [(2, 7), (4, 5)]:
+        start = time.perf_counter()
+        vec = VectorCrazyEights(n_games, num_players, num_cards, seed=5)
+        vec.play_games()
+        vec_time = time.perf_counter() - start
+        start = time.perf_counter()
+        scalar = SimulationStats(num_players)
+        for r in simulate(n_games, num_players, num_cards, seed=5):
+            scalar.add(r)
+        scalar_time = time.perf_counter() - start
+        vstats = vec.stats()
+        print(str(num_players) + ' players, ' + str(num_cards) + ' cards:')
+        print('  vector: ' + str(round(n_games / vec_time)) + ' games/sec, mean turns '
+              + str(round(vstats.mean_turns, 2)) + ', wins ' + str(vstats.wins))
+        print('  scalar: ' + str(round(n_games / scalar_time)) + ' games/sec, mean turns '
+              + str(round(scalar.mean_turns, 2)) + ', wins ' + str(scalar.wins))
+        # Mean game length and win rates agree within sampling error (4 standard errors)
+        se_turns = math.sqrt(vstats.stdev_turns ** 2 / n_games + scalar.stdev_turns ** 2 / n_games)
+        assert abs(vstats.mean_turns - scalar.mean_turns) < 4 * se_turns
+        for seat in range(num_players):
+            p = (vstats.win_rate(seat) + scalar.win_rate(seat)) / 2
+            se_win = math.sqrt(2 * p * (1 - p) / n_games)
+            assert abs(vstats.win_rate(seat) - scalar.win_rate(seat)) < 4 * se_win
+        print('  statistics match')
+
+
+if __name__ == '__main__':
+    test_VectorCrazyEights()
@@ -0,0 +1,158 @@
+import sys
+
+
+# Event kinds.  Every event is emitted as (kind, player, detail):
+#   DRAW         player drew detail (a Card)
+#   PLAY         player played detail (a Card)
+#   SUIT         player called detail (a suit) with a crazy eight
+#   TURN         a turn finished; player moves next, detail is the top discard (a Card or None)
+#   WIN          player emptied their hand
+#   RECYCLE      the discard pile was shuffled into the empty deck for the detail-th time
+#   RECYCLE_CAP  the deck ran out after detail recycles of the discard pile
+#   NO_CARDS     the deck ran out and recycling left nothing to draw
+#   GAME_OVER    the game is complete
+DRAW = 'draw'
+PLAY = 'play'
+SUIT = 'suit'
+TURN = 'turn'
+WIN = 'win'
+RECYCLE = 'recycle'
+RECYCLE_CAP = 'recycle_cap'
+NO_CARDS = 'no_cards'
+GAME_OVER = 'game_over'
+
+
+class NullSink:
+    """ Event sink that ignores every event
+
+    Games only build and emit events when sink.active is true, so a game
+    with a NullSink does no work for output at all.
+
+    Attributes:
+        active: bool
+            if false, games skip emitting events to this sink
+    """
+    active = False
+
+    def emit(self, game, kind: str, player = None, detail = None):
+        pass
+
+    def flush(self):
+        pass
+
+
+NULL_SINK = NullSink()
+
+
+class ConsoleSink(NullSink):
+    """ Event sink that writes the human-readable game transcript
+
+    Produces the same text as the original print-based output (see samplegame.txt),
+    with one write per event.
+
+    Attributes:
+        stream:
+            text stream to write to (defaults to sys.stdout at the time of writing)
+    """
+    active = True
+
+    def __init__(self, stream = None):
+        self.stream = stream
+
+    def emit(self, game, kind: str, player = None, detail = None):
+        stream = self.stream or sys.stdout
+        stream.write(self.format_event(game, kind, player, detail))
+
+    def flush(self):
+        stream = self.stream or sys.stdout
+        stream.flush()
+
+    def format_event(self, game, kind: str, player, detail):
+        if kind == DRAW:
+            if game.is_interactive and player.isManual == False:
+                return player.name + ' draws a card\n'
+            return player.name + ' draws ' + detail.label + '\n'
+        if kind == PLAY:
+            return player.name + ' plays ' + detail.label + '\n'
+        if kind == SUIT:
+            return player.name + ' sets current suit to ' + detail + '\n'
+        if kind == TURN:
+            return '\n' + '\n'.join(game.describe_game()) + '\n'
+        if kind == WIN:
+            return player.name + ' has no cards left. ' + player.name + ' is the winner!\n'
+        if kind == RECYCLE:
+            # Not part of the transcript
+            return ''
+        if kind == RECYCLE_CAP:
+            return 'Recycled discard pile ' + str(detail) + ' times.  Game over.\n'
+        if kind == NO_CARDS:
+            return 'No cards left to draw.  Game over.\n'
+        if kind == GAME_OVER:
+            return 'Game over\n'
+        return kind + '\n'
+
+
+class BufferedSink(NullSink):
+    """ Event sink that collects structured events and hands them over in batches
+
+    Each event is stored as a tuple (kind, turn, player_name, detail), where turn
+    is the number of turns completed when the event happened.  When batch_size
+    events have been collected they are passed to callback as a list; flush()
+    passes on whatever is left.  Without a callback the events stay in events.
+
+    Attributes:
+        batch_size: int
+            number of events collected before calling callback
+        callback:
+            function called with each batch of events, or None
+        events: tuple[]
+            events collected since the last batch was handed over
+    """
+    active = True
+
+    def __init__(self, callback = None, batch_size: int = 1024):
+        self.callback = callback
+        self.batch_size = batch_size
+        self.events = []
+
+    def emit(self, game, kind: str, player = None, detail = None):
+        name = player.name if player is not None else None
+        self.events.append((kind, game.num_turns, name, detail))
+        if self.callback is not None and len(self.events) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.callback is not None and self.events:
+            events = self.events
+            self.events = []
+            self.callback(events)
+
+
+def test_sinks():
+    from cardgame import CardGame
+    from cardplayer import CardPlayer
+    import io
+    import random
+
+    random.seed(2)
+    batches = []
+    buffered = BufferedSink(callback=batches.append, batch_size=16)
+    game = CardGame([CardPlayer('p1'), CardPlayer('p2')], num_cards=5, sink=buffered)
+    game.setup_game()
+    game.play_game()
+    events = [e for batch in batches for e in batch]
+    print('buffered: ' + str(len(events)) + ' events in ' + str(len(batches)) + ' batches')
+    print('first events: ', events[:3])
+    print('last event: ', events[-1])
+
+    random.seed(2)
+    out = io.StringIO()
+    game = CardGame([CardPlayer('p1'), CardPlayer('p2')], num_cards=5, sink=ConsoleSink(out))
+    game.setup_game()
+    game.play_game()
+    print('console transcript ends with:')
+    print(out.getvalue()[-120:])
+
+
+if __name__ == '__main__':
+    test_sinks()
@@ -0,0 +1,404 @@
+from card import CARD_TABLE, SUITS, SUIT_INDEX
+from cardgame import CardGame
+from cardplayer import CardPlayer
+from crazyeights import CrazyEights
+from gameevents import NullSink, DRAW, PLAY, SUIT, RECYCLE, GAME_OVER
+from collections import namedtuple
+import glob
+import os
+import random
+
+
+# Record layout (one game).  Records are stored with a varint length prefix:
+#   u8 game code, u8 number of players, u8 cards per player, u8 number of decks
+#   u8 seed type (0 none, 1 int, 2 str, 3 bytes), u8 seed length, seed
+#   52 bytes per deck: deck order before dealing, top card first, as card ordinals
+#   moves, one byte each:
+#     0..51   play the card with this ordinal
+#     52      draw
+#     53      the deck was recycled: u16 count, then the new deck order
+#     56..59  suit called with the crazy eight just played (56 + suit index)
+MOVE_DRAW = 52
+MOVE_RECYCLE = 53
+MOVE_SUIT = 56
+
+# Game classes by code; subclasses are recorded as the nearest registered class
+GAME_CLASSES = [CardGame, CrazyEights]
+
+SHARD_MAGIC = b'CGREC\x02'
+SHARD_SUFFIX = '.rec'
+
+
+GameRecord = namedtuple('GameRecord', ['game_code', 'num_players', 'num_cards', 'num_decks', 'seed', 'deck', 'moves'])
+GameRecord.__doc__ = """ One recorded game, as read back from a shard
+
+    Attributes:
+        game_code: int
+            index of the game class in GAME_CLASSES
+        num_players: int
+            number of players
+        num_cards: int
+            number of cards dealt to each player
+        num_decks: int
+            number of standard decks in play
+        seed:
+            seed given to reset() (int, str, bytes or None)
+        deck: bytes
+            deck order before dealing, top card first, as card ordinals
+        moves: bytes
+            encoded moves
+"""
+
+
+def game_code(game: CardGame):
+    for cls in type(game).__mro__:
+        if cls in GAME_CLASSES:
+            return GAME_CLASSES.index(cls)
+    raise ValueError('No record code for ' + type(game).__name__)
+
+
+def encode_seed(seed):
+    if seed is None:
+        return bytes([0, 0])
+    if isinstance(seed, int):
+        data = seed.to_bytes((seed.bit_length() + 8) // 8, 'little', signed=True)
+        tag = 1
+    elif isinstance(seed, str):
+        data = seed.encode()
+        tag = 2
+    else:
+        data = bytes(seed)
+        tag = 3
+    if len(data) > 255:
+        raise ValueError('Seed too long to record')
+    return bytes([tag, len(data)]) + data
+
+
+def decode_seed(tag: int, data):
+    if tag == 0:
+        return None
+    if tag == 1:
+        return int.from_bytes(data, 'little', signed=True)
+    if tag == 2:
+        return bytes(data).decode()
+    return bytes(data)
+
+
+def initial_deck_order(game: CardGame):
+    # Deck order before dealing, worked out from a game that has just been reset:
+    # deal_cards hands out one card to each player in turn, then the top card is turned over
+    order = []
+    for r in range(game.num_cards):
+        for p in game.players:
+            order.append(p.hand.cards[r])
+    order.extend(game.discard_pile.cards)
+    order.extend(game.deck.cards)
+    return order
+
+
+def _varint(n: int):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+class GameRecorder(NullSink):
+    """ Event sink that encodes a game's moves as a compact binary record
+
+    Call begin(game, seed) right after the game is set up or reset, before any
+    move is made.  When the game is over the record is passed to writer (if
+    given) and is also available from record().
+
+    Attributes:
+        moves: bytearray
+            moves encoded so far
+        writer: RecordWriter
+            receives each finished record, or None
+    """
+    active = True
+
+    def __init__(self, writer = None):
+        self.writer = writer
+        self.header = b''
+        self.moves = bytearray()
+
+    def begin(self, game: CardGame, seed = None):
+        order = bytes([c.ordinal for c in initial_deck_order(game)])
+        self.header = (bytes([game_code(game), len(game.players), game.num_cards, game.num_decks])
+                       + encode_seed(seed) + order)
+        self.moves = bytearray()
+
+    def emit(self, game, kind: str, player = None, detail = None):
+        if kind == PLAY:
+            self.moves.append(detail.ordinal)
+        elif kind == DRAW:
+            self.moves.append(MOVE_DRAW)
+        elif kind == SUIT:
+            self.moves.append(MOVE_SUIT + SUIT_INDEX[detail])
+        elif kind == RECYCLE:
+            # The new deck order comes from the game's rng, which a replay cannot reproduce
+            self.moves.append(MOVE_RECYCLE)
+            self.moves.extend(len(game.deck).to_bytes(2, 'little'))
+            self.moves.extend([c.ordinal for c in game.deck.cards])
+        elif kind == GAME_OVER and self.writer is not None:
+            self.writer.write(self.record())
+
+    def record(self):
+        return self.header + self.moves
+
+
+class RecordWriter:
+    """ Appends game records to a series of shard files
+
+    Shards are named <prefix>-00000.rec, <prefix>-00001.rec, ...  A new shard
+    is started when the current one reaches max_shard_bytes.  Each writer
+    starts a new shard rather than appending to an old one, so a record cut
+    short by a crash never sits in front of good records.  A shard takes the
+    first number not already used, so writers can share a prefix.
+
+    Attributes:
+        max_shard_bytes: int
+            size at which a new shard is started
+        prefix: str
+            path prefix of the shard files
+        records: int
+            number of records written
+    """
+
+    def __init__(self, prefix: str, max_shard_bytes: int = 1 << 30, buffer_size: int = 1 << 20):
+        self.prefix = prefix
+        self.max_shard_bytes = max_shard_bytes
+        self.buffer_size = buffer_size
+        self.records = 0
+        self.shard = len(shard_paths(prefix))
+        self.file = None
+
+    def write(self, record: bytes):
+        if self.file is None:
+            self._open_shard()
+        self.file.write(_varint(len(record)))
+        self.file.write(record)
+        self.records += 1
+        if self.file.tell() >= self.max_shard_bytes:
+            self.file.close()
+            self.file = None
+            self.shard += 1
+
+    def _open_shard(self):
+        # 'xb' fails if another writer has taken the number (or it was there all along)
+        while True:
+            path = self.prefix + '-%05d' % self.shard + SHARD_SUFFIX
+            try:
+                self.file = open(path, 'xb', buffering=self.buffer_size)
+                break
+            except FileExistsError:
+                self.shard += 1
+        self.file.write(SHARD_MAGIC)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def shard_paths(prefix: str):
+    return sorted(glob.glob(glob.escape(prefix) + '-[0-9][0-9][0-9][0-9][0-9]' + SHARD_SUFFIX))
+
+
+def read_shard(path: str, chunk_size: int = 1 << 20):
+    # Stream the GameRecords in one shard.  A record cut short at the end of the
+    # file (an interrupted writer) is skipped.
+    with open(path, 'rb') as f:
+        if f.read(len(SHARD_MAGIC)) != SHARD_MAGIC:
+            raise ValueError(path + ' is not a game record shard')
+        buf = b''
+        pos = 0
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buf = buf[pos:] + chunk
+            pos = 0
+            end = len(buf)
+            while pos < end:
+                # Length prefix
+                n = 0
+                shift = 0
+                p = pos
+                while p < end:
+                    b = buf[p]
+                    p += 1
+                    n |= (b & 0x7F) << shift
+                    shift += 7
+                    if b < 0x80:
+                        break
+                else:
+                    break
+                if p + n > end:
+                    break
+                seed_len = buf[p + 5]
+                deck_start = p + 6 + seed_len
+                moves_start = deck_start + 52 * buf[p + 3]
+                yield GameRecord(buf[p], buf[p + 1], buf[p + 2], buf[p + 3],
+                                 decode_seed(buf[p + 4], buf[p + 6:deck_start]),
+                                 buf[deck_start:moves_start], buf[moves_start:p + n])
+                pos = p + n
+
+
+def read_records(prefix: str):
+    # Stream the GameRecords in every shard with this prefix, in order
+    for path in shard_paths(prefix):
+        yield from read_shard(path)
+
+
+class ReplayPlayer(CardPlayer):
+    """ Player that calls the suit recorded for the crazy eight being replayed
+
+    Attributes:
+        suit: str
+            suit to call with the next crazy eight
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.suit = None
+
+    def choose_suit(self, game):
+        return self.suit
+
+
+class Replayer:
+    """ Replays GameRecords through CardGame/CrazyEights
+
+    No strategy code runs: every move comes from the record, so replay is
+    deterministic and much faster than play.  One game object is kept for each
+    (game class, players, cards, decks) combination and reset for every record.
+    Without a seed check the deck is dealt from the recorded order; with
+    check_seed the game is reset from the recorded seed instead and must deal
+    the recorded deck.
+
+    Attributes:
+        check_seed: bool
+            if true, verify that the seed reproduces the recorded deck
+        games: dict
+            game objects by (game code, players, cards, decks)
+    """
+
+    def __init__(self, check_seed: bool = False):
+        self.check_seed = check_seed
+        self.games = {}
+
+    def game_for(self, record: GameRecord):
+        key = (record.game_code, record.num_players, record.num_cards, record.num_decks)
+        game = self.games.get(key)
+        if game is None:
+            players = [ReplayPlayer('p' + str(i + 1)) for i in range(record.num_players)]
+            game = GAME_CLASSES[record.game_code](players, record.num_cards, num_decks=record.num_decks)
+            game.rng = random.Random(0)
+            game.setup_game()
+            self.games[key] = game
+        return game
+
+    def replay(self, record: GameRecord):
+        # Play the record through to the end and return the finished game
+        game = self.game_for(record)
+        if self.check_seed and record.seed is not None:
+            game.reset(record.seed)
+            if bytes([c.ordinal for c in initial_deck_order(game)]) != record.deck:
+                raise ValueError('Seed ' + repr(record.seed) + ' does not deal the recorded deck')
+        else:
+            game.reset(deck_order=[CARD_TABLE[i] for i in record.deck])
+        moves = record.moves
+        n = len(moves)
+        i = 0
+        while i < n:
+            code = moves[i]
+            i += 1
+            player = game.curr_player
+            if code < MOVE_DRAW:
+                if i < n and MOVE_SUIT <= moves[i] < MOVE_SUIT + 4:
+                    player.suit = SUITS[moves[i] - MOVE_SUIT]
+                    i += 1
+                game.play_card(CARD_TABLE[code], player)
+            elif code == MOVE_DRAW:
+                game.draw_card(player)
+                if i < n and moves[i] == MOVE_RECYCLE:
+                    count = moves[i + 1] | moves[i + 2] << 8
+                    game.deck.cards = [CARD_TABLE[c] for c in moves[i + 3:i + 3 + count]]
+                    i += 3 + count
+            else:
+                raise ValueError('Bad move code ' + str(code))
+            game.end_turn()
+        return game
+
+
+def test_GameRecord():
+    from simulation import game_seed, make_players, play_silent_game
+    from tournament import RandomPlayer
+    import tempfile
+    import time
+
+    prefix = os.path.join(tempfile.mkdtemp(), 'games')
+    expected = []
+    n_games = 2000
+    start = time.perf_counter()
+    with RecordWriter(prefix, max_shard_bytes=64 * 1024) as writer:
+        recorder = GameRecorder(writer)
+        for game_class, players, num_decks in [(CrazyEights, make_players(3), 1),
+                                               (CrazyEights, [RandomPlayer('r1'), RandomPlayer('r2')], 1),
+                                               (CardGame, make_players(2), 1),
+                                               (CrazyEights, make_players(12), 2)]:
+            game = game_class(players, 5, sink=recorder, num_decks=num_decks)
+            game.rng = random.Random()
+            game.setup_game()
+            for i in range(n_games):
+                seed = game_seed(7, i)
+                game.reset(seed)
+                recorder.begin(game, seed)
+                game.play_game()
+                expected.append(game.snapshot())
+    record_time = time.perf_counter() - start
+    sizes = [os.path.getsize(p) for p in shard_paths(prefix)]
+    moves = sum([s.num_turns for s in expected])
+    print(str(len(expected)) + ' games, ' + str(moves) + ' moves in ' + str(len(sizes)) + ' shards, '
+          + str(round(sum(sizes) / len(expected), 1)) + ' bytes/game')
+
+    start = time.perf_counter()
+    replayer = Replayer()
+    replayed = [replayer.replay(r).snapshot() for r in read_records(prefix)]
+    replay_time = time.perf_counter() - start
+    print('recorded play: ' + str(round(len(expected) / record_time)) + ' games/sec, replay: '
+          + str(round(len(replayed) / replay_time)) + ' games/sec')
+    print('replay matches play: ' + str(replayed == expected))
+    checked = Replayer(check_seed=True)
+    print('seeds deal the recorded decks: '
+          + str(all(checked.replay(r).snapshot() == s for r, s in zip(read_records(prefix), expected))))
+
+    # Two writers on one prefix with a missing shard both find free shard numbers
+    shared = os.path.join(os.path.dirname(prefix), 'shared')
+    with RecordWriter(shared) as w:
+        w.write(b'first')
+    os.rename(shard_paths(shared)[0], shared + '-00001' + SHARD_SUFFIX)
+    writers = [RecordWriter(shared) for i in range(2)]
+    for i, w in enumerate(writers):
+        w.write(b'writer ' + str(i).encode())
+    for w in writers:
+        w.close()
+    kept = []
+    for path in shard_paths(shared):
+        with open(path, 'rb') as f:
+            kept.append(f.read()[len(SHARD_MAGIC) + 1:])
+    print('shared prefix: ', [os.path.basename(p) for p in shard_paths(shared)], kept)
+
+
+if __name__ == '__main__':
+    test_GameRecord()
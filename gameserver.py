@@ -0,0 +1,424 @@
+from cardgame import CardGame
+from cardplayer import CardPlayer
+from crazyeights import CrazyEights
+from card import Card
+from gameevents import BufferedSink
+from suspend import SuspensionManager
+import argparse
+import asyncio
+import itertools
+import random
+import statistics
+import time
+
+
+GAME_CLASSES = {'basic': CardGame, 'eights': CrazyEights}
+
+# Line protocol.  Client to server:
+#   NEW <game> <num_players> <num_cards> [name]   open a table; the client plays seat 0
+#   MOVE <table> <d|card>                          draw, or play a card such as Kc
+#   CLOSE <table>                                  leave a table
+# Server to client:
+#   OK <table>                                     table opened
+#   EVENT <table> <kind> <player> <detail>         game events, as from a BufferedSink
+#   YOURTURN <table> <hand> <top> <suit> <legal>   comma-separated hand and legal moves
+#   OVER <table> <winner>                          game finished ('-' if nobody won)
+#   ERR <table> <message>
+
+
+class Table:
+    """ One game hosted by the server
+
+    A table waiting for its human player holds only the game state and a timer;
+    there is no task per table.
+
+    Attributes:
+        game: CardGame
+            the game being played; seat 0 is the connected player.  None while
+            the server's suspension manager holds it
+        sink: BufferedSink
+            collects the events to send after each move
+        table_id: int
+            id used in the protocol
+        timer: asyncio.TimerHandle
+            plays the move for the human player when they time out
+        writer: asyncio.StreamWriter
+            connection of the human player
+    """
+    __slots__ = ('table_id', 'game', 'sink', 'timer', 'writer')
+
+    def __init__(self, table_id: int, game: CardGame, sink: BufferedSink, writer):
+        self.table_id = table_id
+        self.game = game
+        self.sink = sink
+        self.timer = None
+        self.writer = writer
+
+
+def _detail(value):
+    if value is None:
+        return '-'
+    if isinstance(value, Card):
+        return value.label
+    return str(value)
+
+
+def _move_text(move):
+    return move if move == 'd' else move.label
+
+
+async def read_line(reader):
+    # The next line from the stream, b'' at its end, or None for a line longer than the
+    # stream's limit, which is read and thrown away up to its newline
+    try:
+        return await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+    except asyncio.LimitOverrunError as e:
+        skip = e.consumed
+    while True:
+        await reader.readexactly(skip)
+        try:
+            await reader.readuntil(b'\n')
+            return None
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError as e:
+            skip = e.consumed
+
+
+class GameServer:
+    """ Hosts many concurrent CardGame/CrazyEights tables over a line protocol
+
+    Automated players take their turns inline as soon as the human player's
+    move arrives.  If the human player does not move within move_timeout
+    seconds, the game's own strategy moves for them.
+
+    Attributes:
+        move_timeout: float
+            seconds to wait for a human move
+        suspension: SuspensionManager
+            if set, games waiting for their human player are handed to it, so at
+            most its max_resident are kept in memory and the rest are on disk
+        tables: dict
+            open tables by id
+    """
+
+    def __init__(self, move_timeout: float = 60.0, seed = None, suspension: SuspensionManager = None):
+        self.move_timeout = move_timeout
+        self.suspension = suspension
+        self.tables = {}
+        self.rng = random.Random(seed)
+        self._ids = itertools.count(1)
+
+    async def start(self, host = '127.0.0.1', port = 0, path = None):
+        if path:
+            return await asyncio.start_unix_server(self.handle_connection, path=path)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def handle_connection(self, reader, writer):
+        owned = set()
+        try:
+            while True:
+                line = await read_line(reader)
+                if line is None:
+                    writer.write(b'ERR - line too long\n')
+                elif not line:
+                    break
+                else:
+                    self.handle_line(line.decode(errors='replace').split(), writer, owned)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for table_id in owned:
+                self.close_table(table_id)
+            writer.close()
+
+    def handle_line(self, words, writer, owned):
+        if not words:
+            return
+        command = words[0].upper()
+        try:
+            if command == 'NEW':
+                owned.add(self.open_table(words[1:], writer))
+            elif command == 'MOVE':
+                self.move(int(words[1]), words[2], writer)
+            elif command == 'CLOSE':
+                owned.discard(int(words[1]))
+                self.close_table(int(words[1]))
+            else:
+                writer.write(b'ERR - unknown command\n')
+        except (IndexError, ValueError, KeyError) as e:
+            writer.write(('ERR - ' + command + ' ' + str(e) + '\n').encode())
+        except Exception as e:
+            # Nothing a client sends may take the connection down
+            writer.write(('ERR - ' + command + ' failed: ' + type(e).__name__ + '\n').encode())
+
+    def open_table(self, args, writer):
+        game_class = GAME_CLASSES[args[0]]
+        num_players = int(args[1])
+        num_cards = int(args[2])
+        name = args[3] if len(args) > 3 else 'player'
+        if num_players < 1 or num_cards < 1:
+            raise ValueError('need at least one player and one card each')
+        # Every hand is dealt in full and one card is turned over
+        if num_players * num_cards >= 52:
+            raise ValueError('not enough cards for ' + str(num_players) + ' players with '
+                             + str(num_cards) + ' cards')
+        players = [CardPlayer(name, True)] + [CardPlayer('bot' + str(i)) for i in range(1, num_players)]
+        sink = BufferedSink()
+        game = game_class(players, num_cards, sink=sink)
+        game.rng = random.Random(self.rng.getrandbits(64))
+        game.setup_game()
+        table = Table(next(self._ids), game, sink, writer)
+        self.tables[table.table_id] = table
+        writer.write(('OK ' + str(table.table_id) + '\n').encode())
+        self.advance(table)
+        return table.table_id
+
+    def close_table(self, table_id: int):
+        table = self.tables.pop(table_id, None)
+        if table and table.timer:
+            table.timer.cancel()
+        if table and table.game is None:
+            self.suspension.discard(table_id)
+
+    def table_game(self, table: Table):
+        # The table's game, taken back from the suspension manager if it holds it
+        if table.game is None:
+            table.game = self.suspension.pop(table.table_id)
+            table.game.sink = table.sink
+        return table.game
+
+    def park_game(self, table: Table):
+        # Hand a waiting table's game back to the suspension manager, if there is one
+        if self.suspension is not None and table.game is not None:
+            self.suspension.add(table.table_id, table.game)
+            table.game = None
+
+    def move(self, table_id: int, text: str, writer):
+        table = self.tables.get(table_id)
+        if table is None or table.writer is not writer:
+            writer.write(('ERR ' + str(table_id) + ' no such table\n').encode())
+            return
+        # Parse before taking the game, and give it back on every error, so the suspension
+        # manager's count of resident games stays right
+        move = 'd' if text == 'd' else Card.from_label(text)
+        game = self.table_game(table)
+        if move != 'd' and move not in game.legal_moves(game.curr_player):
+            self.park_game(table)
+            writer.write(('ERR ' + str(table_id) + ' illegal move ' + text + '\n').encode())
+            return
+        table.timer.cancel()
+        table.timer = None
+        game.play_move(move)
+        game.end_turn()
+        self.advance(table)
+
+    def timed_out(self, table: Table):
+        # The human player took too long: let the game's strategy move for them
+        table.timer = None
+        game = self.table_game(table)
+        game.play_turn_auto()
+        game.end_turn()
+        self.advance(table)
+
+    def advance(self, table: Table):
+        # Play automated turns until the human player is up or the game is over,
+        # then send the events and the next prompt
+        game = table.game
+        while not game.completed and not game.curr_player.isManual:
+            game.play_turn()
+            game.end_turn()
+        tid = str(table.table_id)
+        lines = ['EVENT ' + tid + ' ' + kind + ' ' + _detail(name) + ' ' + _detail(detail)
+                 for kind, turn, name, detail in table.sink.events]
+        table.sink.events.clear()
+        if game.completed:
+            lines.append('OVER ' + tid + ' ' + (game.winner.name if game.winner else '-'))
+            self.tables.pop(table.table_id, None)
+        else:
+            player = game.curr_player
+            top = game.discard_pile.cards[-1].label if len(game.discard_pile) else '-'
+            legal = game.legal_moves(player)
+            if 'd' not in legal:
+                legal.append('d')
+            lines.append('YOURTURN ' + tid + ' ' + (','.join([c.label for c in player.hand.cards]) or '-')
+                         + ' ' + top + ' ' + _detail(getattr(game, 'current_suit', None))
+                         + ' ' + ','.join([_move_text(m) for m in legal]))
+            table.timer = asyncio.get_running_loop().call_later(self.move_timeout, self.timed_out, table)
+            self.park_game(table)
+        table.writer.write(('\n'.join(lines) + '\n').encode())
+
+
+async def run_load(tables: int, connections: int = 10, game = 'eights', num_players = 2, num_cards = 5,
+                   host = '127.0.0.1', port = None, path = None, seed = 0):
+    # Load generator: play `tables` games spread over `connections` connections, choosing
+    # random legal moves, and return the latency of every move in seconds
+    rng = random.Random(seed)
+    latencies = []
+
+    async def client(n_tables):
+        if path:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        sent = {}
+        for i in range(n_tables):
+            writer.write(('NEW ' + game + ' ' + str(num_players) + ' ' + str(num_cards) + ' load\n').encode())
+        await writer.drain()
+        finished = 0
+        while finished < n_tables:
+            words = (await reader.readline()).decode().split()
+            if not words:
+                break
+            kind = words[0]
+            if kind == 'YOURTURN' or kind == 'OVER':
+                table_id = words[1]
+                if table_id in sent:
+                    latencies.append(time.perf_counter() - sent.pop(table_id))
+                if kind == 'OVER':
+                    finished += 1
+                    continue
+                move = rng.choice(words[5].split(','))
+                sent[table_id] = time.perf_counter()
+                writer.write(('MOVE ' + table_id + ' ' + move + '\n').encode())
+                await writer.drain()
+            elif kind == 'ERR':
+                raise RuntimeError(' '.join(words))
+        writer.close()
+
+    per_client = [tables // connections + (1 if i < tables % connections else 0) for i in range(connections)]
+    await asyncio.gather(*[client(n) for n in per_client if n])
+    return latencies
+
+
+def latency_report(latencies):
+    # Percentiles of per-move latency in milliseconds
+    if len(latencies) < 2:
+        return {}
+    cuts = statistics.quantiles(latencies, n=100)
+    return {'moves': len(latencies),
+            'p50_ms': round(cuts[49] * 1000, 3),
+            'p90_ms': round(cuts[89] * 1000, 3),
+            'p99_ms': round(cuts[98] * 1000, 3),
+            'max_ms': round(max(latencies) * 1000, 3)}
+
+
+def test_GameServer():
+    async def run():
+        server = GameServer(seed=1)
+        tcp = await server.start()
+        port = tcp.sockets[0].getsockname()[1]
+        start = time.perf_counter()
+        latencies = await run_load(500, connections=20, port=port)
+        elapsed = time.perf_counter() - start
+        print('500 tables, ' + str(len(latencies)) + ' moves in ' + str(round(elapsed, 2)) + 's')
+        print('latency: ', latency_report(latencies))
+        print('tables still open: ' + str(len(server.tables)))
+        tcp.close()
+        await tcp.wait_closed()
+    asyncio.run(run())
+
+
+def test_bad_requests():
+    async def run():
+        server = GameServer(seed=1)
+        tcp = await server.start()
+        port = tcp.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for line in [b'NEW eights 20 5', b'NEW eights 0 5', b'NEW basic 2 0', b'\xff\xfe', b'MOVE x d',
+                     b'x' * 200000, b'NEW eights 2 5']:
+            writer.write(line + b'\n')
+            await writer.drain()
+            print(line[:20], '->', (await reader.readline()).decode().strip())
+        writer.close()
+        await writer.wait_closed()
+        # Let the server see the connection close before shutting down
+        await asyncio.sleep(0.05)
+        tcp.close()
+        await tcp.wait_closed()
+    asyncio.run(run())
+
+
+def test_suspension():
+    import tempfile
+
+    async def run(tmp):
+        suspension = SuspensionManager(tmp, max_resident=20)
+        server = GameServer(seed=1, suspension=suspension)
+        tcp = await server.start()
+        port = tcp.sockets[0].getsockname()[1]
+        latencies = await run_load(200, connections=20, port=port)
+        print('200 tables with at most 20 games resident, ' + str(len(latencies)) + ' moves')
+        print('latency: ', latency_report(latencies))
+        print('suspensions: ' + str(suspension.suspensions) + ', resumes: ' + str(suspension.resumes)
+              + ', games left with the manager: ' + str(len(suspension)))
+
+        # Rejected moves must leave every waiting game with the manager
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        ids = []
+        for i in range(30):
+            writer.write(b'NEW eights 2 5\n')
+            await writer.drain()
+            ids.append((await reader.readline()).split()[1])
+            await reader.readline()
+        for table_id in ids:
+            for move in [b'Zz', b'2c', b'Ah', b'9s']:
+                writer.write(b'MOVE ' + table_id + b' ' + move + b'\n')
+        writer.write(b'CLOSE 0\n')
+        await writer.drain()
+        await asyncio.sleep(0.1)
+        print('after rejected moves: ' + str(len(suspension.resident)) + ' resident (cap 20), '
+              + str(sum(t.game is not None for t in server.tables.values())) + ' games held by tables')
+        writer.close()
+        await writer.wait_closed()
+        await asyncio.sleep(0.05)
+        tcp.close()
+        await tcp.wait_closed()
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(tmp))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-table card game server')
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve', help='run the server')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=7777)
+    serve.add_argument('--unix', help='listen on a Unix socket instead of TCP')
+    serve.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for a move')
+    serve.add_argument('--store', help='suspend waiting games to this directory')
+    serve.add_argument('--max-resident', type=int, default=1000, help='most games kept in memory with --store')
+    load = sub.add_parser('load', help='run the load generator against a server')
+    load.add_argument('--host', default='127.0.0.1')
+    load.add_argument('--port', type=int, default=7777)
+    load.add_argument('--unix')
+    load.add_argument('--tables', type=int, default=1000)
+    load.add_argument('--connections', type=int, default=20)
+    load.add_argument('--game', choices=sorted(GAME_CLASSES), default='eights')
+    load.add_argument('--players', type=int, default=2)
+    load.add_argument('--cards', type=int, default=5)
+    sub.add_parser('test', help='run a server and load generator in this process')
+    args = parser.parse_args()
+
+    if args.command == 'test':
+        test_GameServer()
+        test_bad_requests()
+        test_suspension()
+    elif args.command == 'serve':
+        async def serve_forever():
+            suspension = SuspensionManager(args.store, args.max_resident) if args.store else None
+            server = await GameServer(args.timeout, suspension=suspension).start(args.host, args.port, args.unix)
+            async with server:
+                await server.serve_forever()
+        asyncio.run(serve_forever())
+    else:
+        latencies = asyncio.run(run_load(args.tables, args.connections, args.game, args.players, args.cards,
+                                         args.host, args.port, args.unix))
+        print(latency_report(latencies))
+
+
+if __name__ == '__main__':
+    main()
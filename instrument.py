@@ -0,0 +1,312 @@
+from cardgame import CardGame
+import sys
+import time
+import weakref
+
+
+# Methods instrumented by default, where the game has them.  find_playable_mask,
+# select_card_from_mask and select_suit_from_mask are the CrazyEights fast path
+# taken instead of find_playable_cards and select_card_to_play.
+HOOKS = ('play_game', 'play_turn', 'play_turn_auto', 'end_turn',
+         'find_playable_cards', 'find_playable_mask',
+         'select_card_to_play', 'select_card_from_mask',
+         'select_crazy_eight_suit', 'select_suit_from_mask',
+         'draw_card', 'play_card', 'recycle_discard_pile', 'update_status')
+
+# Timings go into power-of-two nanosecond buckets: bucket k holds durations d
+# with d.bit_length() == k, i.e. 2**(k-1) <= d < 2**k
+NUM_BUCKETS = 64
+
+
+class CallStats:
+    """ Counts and timings of one instrumented method
+
+    Attributes:
+        net_blocks: int
+            net change in allocated memory blocks over all calls
+            (sys.getallocatedblocks): blocks allocated minus blocks freed, so it
+            is negative for methods that free more than they allocate
+        buckets: int[]
+            number of calls in each power-of-two nanosecond bucket
+        count: int
+            number of calls
+        max_ns: int
+            longest call
+        total_ns: int
+            total time in the method, including nested instrumented calls
+    """
+    __slots__ = ('count', 'total_ns', 'max_ns', 'net_blocks', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.net_blocks = 0
+        self.buckets = [0] * NUM_BUCKETS
+
+    def percentile(self, q: float):
+        # Duration in ns below which a fraction q of the calls fall, interpolated in its bucket
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                low = 0 if k == 0 else 1 << (k - 1)
+                high = 1 << k
+                return min(low + (high - low) * (rank - seen) / n, self.max_ns)
+            seen += n
+        return float(self.max_ns)
+
+    def as_dict(self):
+        mean = self.total_ns / self.count if self.count else 0.0
+        return {'count': self.count,
+                'total_s': round(self.total_ns / 1e9, 6),
+                'mean_us': round(mean / 1e3, 3),
+                'p50_us': round(self.percentile(0.5) / 1e3, 3),
+                'p90_us': round(self.percentile(0.9) / 1e3, 3),
+                'p99_us': round(self.percentile(0.99) / 1e3, 3),
+                'max_us': round(self.max_ns / 1e3, 3),
+                'net_blocks': self.net_blocks}
+
+
+class InstrumentedSink:
+    """ Stands in for one game's event sink and times its emit calls
+
+    Attributes:
+        active: bool
+            the wrapped sink's active flag
+        emit: function
+            timed emit of the wrapped sink
+        sink: NullSink
+            the wrapped sink, shared with whatever else uses it
+    """
+
+    def __init__(self, sink, emit):
+        self.sink = sink
+        self.active = sink.active
+        self.emit = emit
+
+    def flush(self):
+        self.sink.flush()
+
+
+class Instrument:
+    """ Optional call counting, timing and allocation tracking for games
+
+    attach(game) shadows the game's hook methods with timing wrappers stored on
+    the game object itself; detach(game) puts back exactly what attach
+    replaced, so wrappers that other tools put on the game survive.  The class methods
+    are never touched, so games that are not attached (or have been detached)
+    run with no overhead at all, and CrazyEights.uses_mask_heuristics still
+    picks the fast path.  The game's sink is replaced by an InstrumentedSink
+    of its own, so a sink shared with other games is left alone.  Stats from
+    every attached game are added together.  Clones of an attached game are
+    not instrumented.
+
+    Attributes:
+        allocations: bool
+            if true, also record the net change in allocated blocks per call
+        block_overhead: int
+            blocks the allocation tracking itself leaves allocated per call,
+            measured once and subtracted from every call
+        hooks: str[]
+            names of the methods to instrument
+        stats: dict
+            CallStats by method name ('sink.emit' for the game's event sink)
+    """
+
+    def __init__(self, hooks = HOOKS, allocations: bool = True):
+        self.hooks = list(hooks)
+        self.allocations = allocations
+        self.stats = {}
+        # Game -> the attributes attach replaced, its wrappers and its InstrumentedSink
+        self.attached = weakref.WeakKeyDictionary()
+        self.block_overhead = 0
+        if allocations:
+            # Time a method that allocates nothing to see what the tracking itself leaves
+            noop = self.wrap('', lambda: None)
+            for i in range(1000):
+                noop()
+            probe = self.stats.pop('')
+            self.block_overhead = round(probe.net_blocks / probe.count)
+
+    def attach(self, game: CardGame):
+        if game in self.attached:
+            return game
+        wrappers = {}
+        for name in self.hooks:
+            method = getattr(game, name, None)
+            if method is not None:
+                wrappers[name] = self.wrap(name, method)
+        # Clones copy the game's attributes, so take the wrappers off them
+        clone = game.clone
+        names = list(wrappers)
+
+        def clone_without_wrappers(*args, **kwargs):
+            copy = clone(*args, **kwargs)
+            for name in names + ['clone']:
+                vars(copy).pop(name, None)
+            return copy
+        wrappers['clone'] = clone_without_wrappers
+        # What was on the game before, to put back on detach (None for the class method)
+        saved = {name: vars(game).get(name) for name in wrappers}
+        for name, wrapper in wrappers.items():
+            setattr(game, name, wrapper)
+        sink = None
+        if game.sink.active:
+            sink = game.sink = InstrumentedSink(game.sink, self.wrap('sink.emit', game.sink.emit))
+        self.attached[game] = (saved, wrappers, sink)
+        return game
+
+    def detach(self, game: CardGame):
+        # Put back what attach replaced, leaving alone anything attached on top since
+        saved, wrappers, sink = self.attached.pop(game, ({}, {}, None))
+        for name, wrapper in wrappers.items():
+            if vars(game).get(name) is wrapper:
+                if saved[name] is None:
+                    del vars(game)[name]
+                else:
+                    setattr(game, name, saved[name])
+        if sink is not None and game.sink is sink:
+            game.sink = sink.sink
+        return game
+
+    def wrap(self, name: str, method):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = CallStats()
+        buckets = stats.buckets
+        clock = time.perf_counter_ns
+        if not self.allocations:
+            def timed(*args, **kwargs):
+                start = clock()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    ns = clock() - start
+                    stats.count += 1
+                    stats.total_ns += ns
+                    buckets[ns.bit_length()] += 1
+                    if ns > stats.max_ns:
+                        stats.max_ns = ns
+            return timed
+        blocks = sys.getallocatedblocks
+
+        def timed_with_allocations(*args, **kwargs):
+            start = clock()
+            before = blocks()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stats.net_blocks += blocks() - before - self.block_overhead
+                ns = clock() - start
+                stats.count += 1
+                stats.total_ns += ns
+                buckets[ns.bit_length()] += 1
+                if ns > stats.max_ns:
+                    stats.max_ns = ns
+        return timed_with_allocations
+
+    def reset(self):
+        for stats in self.stats.values():
+            stats.__init__()
+
+    def snapshot(self):
+        # Stats of every method that has been called, as plain dicts
+        return {name: s.as_dict() for name, s in self.stats.items() if s.count}
+
+    def prometheus(self, prefix: str = 'cardgame'):
+        # Stats in the Prometheus text exposition format
+        lines = ['# HELP ' + prefix + '_calls_total Calls of each instrumented method',
+                 '# TYPE ' + prefix + '_calls_total counter']
+        used = [(name, s) for name, s in self.stats.items() if s.count]
+        for name, s in used:
+            lines.append(prefix + '_calls_total{method="' + name + '"} ' + str(s.count))
+        lines.append('# HELP ' + prefix + '_call_seconds Time per call, including nested instrumented calls')
+        lines.append('# TYPE ' + prefix + '_call_seconds histogram')
+        for name, s in used:
+            label = 'method="' + name + '"'
+            top = max(k for k, n in enumerate(s.buckets) if n)
+            cumulative = 0
+            for k in range(top + 1):
+                cumulative += s.buckets[k]
+                lines.append(prefix + '_call_seconds_bucket{' + label + ',le="' + repr((1 << k) / 1e9) + '"} '
+                             + str(cumulative))
+            lines.append(prefix + '_call_seconds_bucket{' + label + ',le="+Inf"} ' + str(s.count))
+            lines.append(prefix + '_call_seconds_sum{' + label + '} ' + repr(s.total_ns / 1e9))
+            lines.append(prefix + '_call_seconds_count{' + label + '} ' + str(s.count))
+        if self.allocations:
+            lines.append('# HELP ' + prefix + '_net_allocated_blocks Blocks allocated minus blocks freed by each method')
+            lines.append('# TYPE ' + prefix + '_net_allocated_blocks gauge')
+            for name, s in used:
+                lines.append(prefix + '_net_allocated_blocks{method="' + name + '"} ' + str(s.net_blocks))
+        return '\n'.join(lines) + '\n'
+
+
+def test_Instrument():
+    from crazyeights import CrazyEights
+    from simulation import make_players
+    from tournament import HighCardEights
+
+    def play(game, n_games):
+        start = time.perf_counter()
+        for i in range(n_games):
+            game.reset(i)
+            game.play_game()
+        return n_games / (time.perf_counter() - start)
+
+    instrument = Instrument()
+    game = CrazyEights(make_players(3), 5)
+    game.setup_game()
+    plain = play(game, 2000)
+    instrument.attach(game)
+    timed = play(game, 2000)
+    instrument.detach(game)
+    detached = play(game, 2000)
+    print('games/sec: plain ' + str(round(plain)) + ', instrumented ' + str(round(timed))
+          + ', detached ' + str(round(detached)))
+    print('still takes the mask fast path: ' + str(game.uses_mask_heuristics()))
+    for name, s in sorted(instrument.snapshot().items(), key=lambda item: -item[1]['total_s']):
+        print('  %-24s %8d calls  %8.3fs  p50 %7.2fus  p99 %7.2fus  net blocks %+d'
+              % (name, s['count'], s['total_s'], s['p50_us'], s['p99_us'], s['net_blocks']))
+
+    # A strategy that overrides the heuristics goes through find_playable_cards and select_card_to_play
+    instrument.reset()
+    game = instrument.attach(HighCardEights(make_players(2), 5))
+    game.setup_game()
+    play(game, 200)
+    print('overridden heuristics: ', {name: s['count'] for name, s in instrument.snapshot().items()
+                                      if name.startswith('find') or name.startswith('select')})
+    print('clone is not instrumented: ' + str('play_card' not in vars(game.clone())))
+
+    # Detaching leaves a DecisionRecorder attached before it in place
+    from selfplay import DecisionRecorder, ShardWriter, row_dtype
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        recorder = DecisionRecorder(ShardWriter(os.path.join(tmp, 'rows'), row_dtype(), shard_rows=100))
+        game = recorder.attach(CrazyEights(make_players(2), 5))
+        recorded = game.play_game
+        instrument.detach(instrument.attach(game))
+        print('recorder still attached after detach: ' + str(vars(game).get('play_game') is recorded))
+
+    # Two games sharing a sink each get their own wrapper, and detaching one leaves the other timed
+    from gameevents import BufferedSink
+    instrument.reset()
+    shared = BufferedSink()
+    games = [instrument.attach(CrazyEights(make_players(2), 5, sink=shared)) for i in range(2)]
+    instrument.detach(games[0])
+    games[0].setup_game()
+    games[0].play_game()
+    untimed = len(shared.events)
+    games[1].setup_game()
+    games[1].play_game()
+    print('shared sink untouched: ' + str('emit' not in vars(shared) and games[0].sink is shared)
+          + ', other game timed once per event: '
+          + str(instrument.stats['sink.emit'].count == len(shared.events) - untimed > 0))
+    print('\n'.join(instrument.prometheus().splitlines()[:4]))
+
+
+if __name__ == '__main__':
+    test_Instrument()
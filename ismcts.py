@@ -0,0 +1,254 @@
+from cardplayer import CardPlayer
+from crazyeights import CrazyEights
+import math
+import random
+import struct
+import time
+
+
+# Tree key for the draw move; card moves use the card ordinal
+DRAW_KEY = -1
+
+# Search settings as saved by suspend_state: max_rollouts and time_limit (-1 for None),
+# exploration and max_rollout_turns
+SETTINGS = struct.Struct('<qddq')
+
+
+def move_key(move):
+    return DRAW_KEY if move == 'd' else move.ordinal
+
+
+class SearchNode:
+    """ Node of an information-set search tree
+
+    Attributes:
+        avail: int
+            number of visits to the parent in which this move was legal
+        children: dict
+            child nodes by move key
+        move:
+            move leading to this node ('d' or a Card), None for the root
+        seat: int
+            seat of the player who made the move
+        visits: int
+            number of times this node was visited
+        wins: float
+            number of those visits that ended in a win for seat
+    """
+    __slots__ = ('move', 'seat', 'children', 'visits', 'wins', 'avail')
+
+    def __init__(self, move = None, seat = None):
+        self.move = move
+        self.seat = seat
+        self.children = {}
+        self.visits = 0
+        self.wins = 0.0
+        self.avail = 0
+
+
+class ISMCTSPlayer(CardPlayer):
+    """ Automated Crazy Eights player using information-set Monte Carlo tree search
+
+    Every iteration deals the unseen cards (opponents' hands and the deck) at
+    random, consistent with the hand sizes, then walks a shared tree of moves
+    with UCB selection, adds one new move and plays the rest of the game with
+    the CrazyEights heuristic.  Search for a move stops after max_rollouts
+    iterations or time_limit seconds, whichever comes first, but always runs
+    at least one iteration.  Crazy eight suit calls are left to the heuristic.
+
+    Attributes:
+        exploration: float
+            UCB exploration constant
+        max_rollout_turns: int
+            rollouts longer than this count as a game with no winner
+        max_rollouts: int
+            iteration budget per move, None for no limit
+        rng: random.Random
+            source of randomness for determinizing and tree expansion
+        rollouts: int
+            total number of iterations run
+        search_time: float
+            total seconds spent searching
+        time_limit: float
+            wall-clock budget per move in seconds, None for no limit
+    """
+
+    def __init__(self, name: str, max_rollouts = 1000, time_limit = None, exploration = 0.7,
+                 max_rollout_turns = 500, seed = None):
+        super().__init__(name)
+        if max_rollouts is None and time_limit is None:
+            raise ValueError('ISMCTSPlayer needs max_rollouts or time_limit')
+        self.max_rollouts = max_rollouts
+        self.time_limit = time_limit
+        self.exploration = exploration
+        self.max_rollout_turns = max_rollout_turns
+        self.rng = random.Random(seed)
+        self.rollouts = 0
+        self.search_time = 0.0
+        self.last_rollouts = 0
+
+    @property
+    def rollouts_per_second(self):
+        if self.search_time == 0:
+            return 0.0
+        return self.rollouts / self.search_time
+
+    def suspend_state(self):
+        # Settings for suspend.encode_game; the rng is not saved
+        return SETTINGS.pack(-1 if self.max_rollouts is None else self.max_rollouts,
+                             -1 if self.time_limit is None else self.time_limit,
+                             self.exploration, self.max_rollout_turns)
+
+    @classmethod
+    def resume_player(cls, name: str, isManual: bool, state: bytes):
+        max_rollouts, time_limit, exploration, max_rollout_turns = SETTINGS.unpack(state)
+        player = cls(name, None if max_rollouts < 0 else max_rollouts, None if time_limit < 0 else time_limit,
+                     exploration, max_rollout_turns)
+        player.isManual = isManual
+        return player
+
+    def choose_move(self, game: CrazyEights):
+        moves = game.legal_moves(self)
+        if len(moves) == 1:
+            return moves[0]
+        start = time.perf_counter()
+        deadline = None if self.time_limit is None else start + self.time_limit
+        scratch = self.make_scratch_game(game)
+        state = game.snapshot()
+        seat = state.curr_player
+        root = SearchNode()
+        n = 0
+        # Always run one iteration, so the root has a move to pick even with no budget left
+        while True:
+            scratch.restore(self.determinize(state, seat))
+            self.iterate(scratch, root)
+            n += 1
+            if self.max_rollouts is not None and n >= self.max_rollouts:
+                break
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+        self.last_rollouts = n
+        self.rollouts += n
+        self.search_time += time.perf_counter() - start
+        best = max(root.children.values(), key=lambda c: c.visits)
+        return best.move
+
+    def make_scratch_game(self, game: CrazyEights):
+        # Copy of the game whose players all follow the game's own heuristic
+        scratch = game.clone(rng=self.rng)
+        for i, p in enumerate(scratch.players):
+            plain = CardPlayer(p.name)
+            plain.hand = p.hand
+            scratch.players[i] = plain
+        return scratch
+
+    def determinize(self, state, seat: int):
+        # Deal the cards this player cannot see at random: opponents' hands and the deck
+        unseen = bytearray(state.deck)
+        for i, hand in enumerate(state.hands):
+            if i != seat:
+                unseen += hand
+        self.rng.shuffle(unseen)
+        hands = []
+        pos = 0
+        for i, hand in enumerate(state.hands):
+            if i == seat:
+                hands.append(hand)
+            else:
+                hands.append(bytes(unseen[pos:pos + len(hand)]))
+                pos += len(hand)
+        return state._replace(hands=tuple(hands), deck=bytes(unseen[pos:]))
+
+    def iterate(self, game: CrazyEights, root: SearchNode):
+        # Selection and expansion
+        path = [root]
+        node = root
+        while not game.completed:
+            moves = game.legal_moves(game.curr_player)
+            untried = []
+            for m in moves:
+                child = node.children.get(move_key(m))
+                if child is None:
+                    untried.append(m)
+                else:
+                    child.avail += 1
+            seat = game.players.index(game.curr_player)
+            if untried:
+                move = untried[self.rng.randrange(len(untried))]
+                child = SearchNode(move, seat)
+                child.avail = 1
+                node.children[move_key(move)] = child
+                game.play_move(move)
+                game.end_turn()
+                path.append(child)
+                break
+            best = None
+            best_score = -1.0
+            for m in moves:
+                child = node.children[move_key(m)]
+                score = (child.wins / child.visits
+                         + self.exploration * math.sqrt(math.log(child.avail) / child.visits))
+                if score > best_score:
+                    best_score = score
+                    best = child
+            game.play_move(best.move)
+            game.end_turn()
+            path.append(best)
+            node = best
+        # Rollout with the heuristic
+        limit = game.num_turns + self.max_rollout_turns
+        while not game.completed and game.num_turns < limit:
+            game.play_turn_auto()
+            game.end_turn()
+        # Backpropagation
+        winner = None
+        if game.winner is not None:
+            winner = game.players.index(game.winner)
+        for node in path:
+            node.visits += 1
+            if node.seat is not None and node.seat == winner:
+                node.wins += 1
+
+
+def test_ISMCTSPlayer():
+    wins = [0, 0]
+    searcher = None
+    for i in range(20):
+        # Alternate seats so the searcher does not always move first
+        searcher = ISMCTSPlayer('mcts', max_rollouts=200, seed=i)
+        players = [searcher, CardPlayer('greedy')] if i % 2 == 0 else [CardPlayer('greedy'), searcher]
+        game = CrazyEights(players, num_cards=7)
+        game.rng = random.Random(i)
+        game.setup_game()
+        game.play_game()
+        if game.winner is searcher:
+            wins[0] += 1
+        elif game.winner is not None:
+            wins[1] += 1
+        print('game ' + str(i) + ': winner ' + (game.winner.name if game.winner else 'none')
+              + ', rollouts/sec ' + str(round(searcher.rollouts_per_second)))
+    print('mcts vs greedy wins: ', wins)
+
+    timed = ISMCTSPlayer('timed', max_rollouts=None, time_limit=0.05, seed=1)
+    game = CrazyEights([timed, CardPlayer('greedy')], num_cards=7)
+    game.rng = random.Random(1)
+    game.setup_game()
+    # Let the heuristic play until the searcher has a real choice to make
+    while not (game.curr_player is timed and len(game.legal_moves(timed)) > 1):
+        game.play_turn_auto()
+        game.end_turn()
+    start = time.perf_counter()
+    move = timed.choose_move(game)
+    print('timed move: ' + str(move) + ' after ' + str(timed.last_rollouts) + ' rollouts in '
+          + str(round(time.perf_counter() - start, 3)) + 's')
+
+    # No budget at all still gives a legal move
+    for max_rollouts, time_limit in [(0, None), (None, 0)]:
+        timed.max_rollouts = max_rollouts
+        timed.time_limit = time_limit
+        move = timed.choose_move(game)
+        print('max_rollouts=' + str(max_rollouts) + ', time_limit=' + str(time_limit) + ': ' + str(move)
+              + ' after ' + str(timed.last_rollouts) + ' rollout, legal: ' + str(move in game.legal_moves(timed)))
+
+if __name__ == '__main__':
+    test_ISMCTSPlayer()
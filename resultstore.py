@@ -0,0 +1,401 @@
+from crazyeights import CrazyEights
+from simulation import simulate
+from multiprocessing import Pool
+import json
+import numpy as np
+import os
+import random
+import time
+
+
+# Most seats a stored game can have
+MAX_SEATS = 8
+
+# Column name -> (dtype, shape of one row's value).  seed and game give the game's
+# seed as simulation.game_seed(seed, game), so only integer seeds 0 .. 2**64 - 1 can
+# be stored; strategies holds the strategy id of each seat (-1 past the last seat);
+# winner is the winning seat or -1.
+COLUMNS = {'seed': ('<u8', ()),
+           'game': ('<i8', ()),
+           'num_seats': ('u1', ()),
+           'strategies': ('<i2', (MAX_SEATS,)),
+           'winner': ('i1', ()),
+           'turns': ('<u4', ()),
+           'draws': ('<u4', ()),
+           'recycles': ('<u2', ()),
+           'capped': ('?', ())}
+
+FORMAT = 1
+COLUMN_SUFFIX = '.col'
+
+# Rows handled at a time by the queries, which bounds their temporary memory
+CHUNK_ROWS = 1 << 22
+
+
+def check_seed(seed):
+    # The seed column holds unsigned 64-bit ints, so string, negative and larger seeds
+    # (which simulate accepts) cannot be stored
+    if not isinstance(seed, (int, np.integer)) or isinstance(seed, bool) or not 0 <= seed < 1 << 64:
+        raise ValueError('Only integer seeds 0 .. 2**64 - 1 can be stored, not ' + repr(seed))
+    return int(seed)
+
+
+def _write_json(path: str, value):
+    # Write a JSON file under a temporary name and rename it, so readers never see half of it
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp, path)
+
+
+def _meta():
+    return {'format': FORMAT, 'max_seats': MAX_SEATS,
+            'columns': {name: [dtype, list(shape)] for name, (dtype, shape) in COLUMNS.items()}}
+
+
+def open_store(path: str):
+    # Create the store directory and its meta.json if needed, and check the format
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        _write_json(meta_path, _meta())
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta != _meta():
+        raise ValueError(path + ' is not a results store of format ' + str(FORMAT))
+    return path
+
+
+class ResultWriter:
+    """ Appends game results to its own segment of a results store
+
+    A store is a directory with a meta.json describing the columns and one
+    segment directory per writer, named seg-<time_ns>-<pid> with the creation
+    time zero-padded so that names sort oldest first.  A segment holds one file per column, the
+    raw little-endian values appended row after row, and a segment.json
+    naming the strategy ids used in it.  Writers never share a file, so any
+    number of processes can write to one store at once.  Rows are buffered
+    and appended together; a row only counts once every column has it, so
+    readers skip a row cut short by a crash.
+
+    Attributes:
+        path: str
+            directory of this writer's segment
+        rows: int
+            number of rows added (including those still buffered)
+        strategies: str[]
+            strategy names, indexed by the ids stored in this segment
+    """
+
+    def __init__(self, store: str, buffer_rows: int = 1 << 16):
+        open_store(store)
+        # mkdir fails if the name is taken, so every writer gets a segment of its own
+        while True:
+            self.path = os.path.join(store, 'seg-%020d-%d' % (time.time_ns(), os.getpid()))
+            try:
+                os.mkdir(self.path)
+                break
+            except FileExistsError:
+                pass
+        self.buffer = np.zeros(buffer_rows, dtype=[(name, dtype, shape) for name, (dtype, shape) in COLUMNS.items()])
+        self.filled = 0
+        self.rows = 0
+        self.strategies = []
+        self.strategy_ids = {}
+        self.saved_strategies = 0
+        self.files = {name: open(os.path.join(self.path, name + COLUMN_SUFFIX), 'ab') for name in COLUMNS}
+
+    def strategy_id(self, name: str):
+        sid = self.strategy_ids.get(name)
+        if sid is None:
+            sid = self.strategy_ids[name] = len(self.strategies)
+            self.strategies.append(name)
+        return sid
+
+    def add(self, seed: int, game: int, strategies, winner, turns: int, draws: int = 0,
+            recycles: int = 0, capped: bool = False):
+        # One game; strategies names the strategy in each seat, winner is a seat or None
+        ids = [self.strategy_id(s) for s in strategies]
+        self.add_rows(seed, [game], [len(ids)], [ids], [-1 if winner is None else winner],
+                      [turns], [draws], [recycles], [capped])
+
+    def add_results(self, results, seed: int, start: int, strategies):
+        # simulation.GameResults of games start, start + 1, ... all played by the same seating
+        ids = [self.strategy_id(s) for s in strategies]
+        n = len(results)
+        if n == 0:
+            return
+        winner, turns, draws, recycles, capped = zip(*results)
+        self.add_rows(seed, np.arange(start, start + n), [len(ids)] * n, [ids] * n,
+                      [-1 if w is None else w for w in winner], turns, draws, recycles, capped)
+
+    def add_rows(self, seed, game, num_seats, strategies, winner, turns, draws, recycles, capped):
+        # Columns of several games at once; strategies holds lists of strategy ids
+        check_seed(seed)
+        n = len(game)
+        strategy_rows = np.full((n, MAX_SEATS), -1, dtype=np.int16)
+        for i, ids in enumerate(strategies):
+            if len(ids) > MAX_SEATS:
+                raise ValueError('A stored game has at most ' + str(MAX_SEATS) + ' seats')
+            strategy_rows[i, :len(ids)] = ids
+        columns = {'seed': np.full(n, seed, dtype=np.uint64), 'game': game, 'num_seats': num_seats,
+                   'strategies': strategy_rows, 'winner': winner, 'turns': turns, 'draws': draws,
+                   'recycles': recycles, 'capped': capped}
+        start = 0
+        while start < n:
+            k = min(n - start, len(self.buffer) - self.filled)
+            block = self.buffer[self.filled:self.filled + k]
+            for name, values in columns.items():
+                block[name] = values[start:start + k]
+            self.filled += k
+            self.rows += k
+            start += k
+            if self.filled == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        # Name any new strategies before rows that use them are written
+        if len(self.strategies) > self.saved_strategies:
+            _write_json(os.path.join(self.path, 'segment.json'), {'strategies': self.strategies})
+            self.saved_strategies = len(self.strategies)
+        if self.filled:
+            rows = self.buffer[:self.filled]
+            for name, f in self.files.items():
+                f.write(np.ascontiguousarray(rows[name]).tobytes())
+                f.flush()
+            self.filled = 0
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Segment:
+    """ Read-only, memory-mapped view of one writer's segment
+
+    Attributes:
+        columns: dict
+            np.memmap of each column, by name
+        path: str
+            directory of the segment
+        rows: int
+            number of complete rows
+        strategies: str[]
+            strategy names, indexed by the ids stored in this segment
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        dtypes = {name: np.dtype((dtype, shape)) for name, (dtype, shape) in COLUMNS.items()}
+        self.rows = None
+        for name in COLUMNS:
+            try:
+                size = os.path.getsize(os.path.join(path, name + COLUMN_SUFFIX))
+            except FileNotFoundError:
+                # A writer that has only just made the segment
+                size = 0
+            rows = size // dtypes[name].itemsize
+            if self.rows is None or rows < self.rows:
+                self.rows = rows
+        # The writer names new strategies before writing rows that use them, so reading the
+        # names after the sizes covers every id in the rows counted
+        try:
+            with open(os.path.join(path, 'segment.json')) as f:
+                self.strategies = json.load(f)['strategies']
+        except FileNotFoundError:
+            self.strategies = []
+        self.columns = {}
+        for name, (dtype, shape) in COLUMNS.items():
+            if self.rows == 0:
+                self.columns[name] = np.zeros((0,) + shape, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(os.path.join(path, name + COLUMN_SUFFIX), dtype=dtype,
+                                               mode='r', shape=(self.rows,) + shape)
+
+
+class ResultStore:
+    """ Queries over every segment of a results store
+
+    Columns are memory-mapped, and the queries run over them in chunks of
+    CHUNK_ROWS rows, so a store far larger than memory can be summarised.
+    Strategy ids are local to each segment; queries translate them to names.
+    refresh() picks up segments and rows written since the store was opened.
+
+    Attributes:
+        path: str
+            directory of the store
+        segments: Segment[]
+            the segments, oldest first
+    """
+
+    def __init__(self, path: str):
+        self.path = open_store(path)
+        self.refresh()
+
+    def refresh(self):
+        names = sorted(n for n in os.listdir(self.path) if n.startswith('seg-'))
+        self.segments = [Segment(os.path.join(self.path, n)) for n in names]
+
+    def __len__(self):
+        return sum(s.rows for s in self.segments)
+
+    @property
+    def strategies(self):
+        # Every strategy name in the store, in order of first appearance
+        names = {}
+        for s in self.segments:
+            for name in s.strategies:
+                names.setdefault(name, len(names))
+        return list(names)
+
+    def chunks(self, names):
+        # (segment, dict of column slices) covering every row, CHUNK_ROWS rows at a time
+        for segment in self.segments:
+            for start in range(0, segment.rows, CHUNK_ROWS):
+                yield segment, {name: segment.columns[name][start:start + CHUNK_ROWS] for name in names}
+
+    def win_rate_by_seat(self):
+        # Fraction of the games with a seat that the seat won
+        wins = np.zeros(MAX_SEATS, dtype=np.int64)
+        games = np.zeros(MAX_SEATS + 1, dtype=np.int64)
+        for segment, c in self.chunks(['winner', 'num_seats']):
+            won = c['winner'][c['winner'] >= 0]
+            wins += np.bincount(won, minlength=MAX_SEATS)
+            games += np.bincount(c['num_seats'], minlength=MAX_SEATS + 1)
+        # Games with at least k + 1 seats have a seat k
+        seated = np.cumsum(games[::-1])[::-1][1:]
+        return [float(w / n) if n else 0.0 for w, n in zip(wins, seated)]
+
+    def length_histogram(self, bin_width: int = 1, max_turns: int = 1000):
+        # Number of games by length in turns: element i counts games of
+        # i * bin_width .. (i + 1) * bin_width - 1 turns; the last bin takes all longer games
+        num_bins = max_turns // bin_width + 1
+        counts = np.zeros(num_bins, dtype=np.int64)
+        for segment, c in self.chunks(['turns']):
+            bins = np.minimum(c['turns'] // bin_width, num_bins - 1)
+            counts += np.bincount(bins, minlength=num_bins)
+        return counts
+
+    def group_by_strategies(self, seats = (0, 1)):
+        # Games grouped by the strategies in the given seats, as
+        # {(name, ...): {'games', 'wins' (one per seat), 'no_winner', 'mean_turns'}}
+        names = self.strategies
+        base = len(names) + 1
+        totals = {}
+        for segment, c in self.chunks(['strategies', 'winner', 'turns']):
+            # Segment ids -> store-wide ids, with -1 (no seat) mapped to 0
+            to_global = np.array([0] + [names.index(s) + 1 for s in segment.strategies], dtype=np.int64)
+            key = np.zeros(len(c['winner']), dtype=np.int64)
+            for seat in seats:
+                key = key * base + to_global[c['strategies'][:, seat] + 1]
+            groups, inverse = np.unique(key, return_inverse=True)
+            games = np.bincount(inverse)
+            turns = np.bincount(inverse, weights=c['turns'])
+            no_winner = np.bincount(inverse, weights=c['winner'] < 0)
+            wins = [np.bincount(inverse, weights=c['winner'] == seat) for seat in seats]
+            for g, k in enumerate(groups):
+                ids = []
+                for seat in seats:
+                    ids.append(int(k % base))
+                    k //= base
+                label = tuple(names[i - 1] if i else None for i in reversed(ids))
+                t = totals.setdefault(label, [0, [0] * len(seats), 0, 0])
+                t[0] += int(games[g])
+                for i in range(len(seats)):
+                    t[1][i] += int(wins[i][g])
+                t[2] += int(no_winner[g])
+                t[3] += float(turns[g])
+        return {label: {'games': t[0], 'wins': t[1], 'no_winner': t[2], 'mean_turns': t[3] / t[0]}
+                for label, t in totals.items()}
+
+
+def store_simulation(path: str, n_games: int, players, num_cards: int, seed: int = 0, start: int = 0,
+                     game_class = CrazyEights):
+    # Simulate games start .. start + n_games - 1 and append them to the store in a new segment.
+    # seed must be storable (see check_seed); None picks a random one.
+    if seed is None:
+        seed = random.getrandbits(64)
+    check_seed(seed)
+    num_seats = players if isinstance(players, int) else len(players)
+    with ResultWriter(path) as writer:
+        for chunk in range(start, start + n_games, 10000):
+            n = min(10000, start + n_games - chunk)
+            writer.add_results(simulate(n, players, num_cards, seed, game_class, chunk), seed, chunk,
+                               [game_class.__name__] * num_seats)
+    return writer.rows
+
+
+def _store_range(args):
+    return store_simulation(*args)
+
+
+def test_ResultStore():
+    import tempfile
+    from simulation import run_parallel
+    from tournament import play_match, GreedyPlayer, HighCardEights
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'results')
+        # Four processes writing to the same store at once
+        start = time.perf_counter()
+        with Pool(4) as pool:
+            rows = pool.map(_store_range, [(path, 5000, 3, 5, 9, k * 5000) for k in range(4)])
+        print('rows written: ' + str(sum(rows)) + ' in ' + str(round(time.perf_counter() - start, 2)) + 's')
+        store = ResultStore(path)
+        print('segments: ' + str(len(store.segments)) + ', rows: ' + str(len(store)))
+        rates = store.win_rate_by_seat()
+        expected = run_parallel(20000, 3, 5, seed=9, workers=4)
+        print('win rate by seat: ', [round(r, 4) for r in rates[:3]])
+        print('matches run_parallel: ' + str(all(abs(rates[i] - expected.win_rate(i)) < 1e-12 for i in range(3))))
+        hist = store.length_histogram(bin_width=10, max_turns=100)
+        print('length histogram (10-turn bins): ', hist.tolist())
+        mean = sum(c['turns'].sum(dtype=np.int64) for s, c in store.chunks(['turns'])) / len(store)
+        print('mean turns matches: ' + str(abs(mean - expected.mean_turns) < 1e-9))
+
+        # Head-to-head games with the seats swapped every other game
+        entrants = [GreedyPlayer, HighCardEights]
+        with ResultWriter(path) as writer:
+            for i in range(2000):
+                seating = (0, 1) if i % 2 == 0 else (1, 0)
+                result = play_match((i, seating, entrants, 5, 10))
+                writer.add(10, i, [entrants[e].__name__ for e in seating], result['winner'], result['turns'])
+        store.refresh()
+        for label, g in sorted(store.group_by_strategies().items(), key=lambda item: str(item[0])):
+            print('  ', label, g)
+
+        # A row cut short by a crash is not read
+        segment = store.segments[0]
+        with open(os.path.join(segment.path, 'turns' + COLUMN_SUFFIX), 'ab') as f:
+            f.write(b'\x01\x02')
+        print('truncated row skipped: ' + str(Segment(segment.path).rows == segment.rows))
+
+        # Segments are read oldest first whatever the writers' pids, and unstorable seeds are refused
+        created = [int(os.path.basename(s.path).split('-')[1]) for s in store.segments]
+        print('segments oldest first: ' + str(created == sorted(created) and store.segments[-1].path == writer.path))
+        rejected = []
+        with ResultWriter(path) as writer:
+            for seed in ['a', -1, 1 << 64, 2.5]:
+                try:
+                    writer.add(seed, 0, ['x'], None, 1)
+                except ValueError:
+                    rejected.append(seed)
+        print('seeds rejected: ', rejected)
+
+        # Query speed over the memory-mapped columns
+        start = time.perf_counter()
+        for i in range(20):
+            store.win_rate_by_seat()
+            store.length_histogram()
+        elapsed = time.perf_counter() - start
+        print('rows/sec per query: ' + str(round(len(store) * 40 / elapsed)))
+
+
+if __name__ == '__main__':
+    test_ResultStore()
@@ -0,0 +1,331 @@
+from card import SUIT_INDEX
+from crazyeights import CrazyEights, PLAYABLE_MASKS
+from simulation import make_players, play_silent_game, game_seed
+from multiprocessing import Pool
+import glob
+import numpy as np
+import os
+import random
+import tempfile
+import time
+import weakref
+
+
+# Action taken when no card is played, and the matching bit of the legal-move mask
+DRAW = 52
+DRAW_BIT = 1 << DRAW
+
+SHARD_SUFFIX = '.npz'
+
+
+def row_dtype(max_opponents: int = 7):
+    # One decision: the seat deciding, what it could see and what it did.
+    # hand and legal are 52-bit card masks (legal also has DRAW_BIT when drawing is the
+    # only move); opponents holds the other hand sizes in turn order starting with the
+    # next player, padded with zeros; called is the suit index called with an eight or
+    # -1; outcome is 1 if the seat went on to win, -1 if someone else did, 0 if no one.
+    return np.dtype([('game', np.int64), ('seat', np.uint8), ('turn', np.uint16),
+                     ('hand', np.uint64), ('top', np.uint8), ('suit', np.uint8),
+                     ('opponents', np.uint16, (max_opponents,)), ('deck', np.uint16),
+                     ('legal', np.uint64), ('action', np.uint8), ('called', np.int8),
+                     ('outcome', np.int8)])
+
+
+def unpack_masks(masks):
+    # 52-bit card masks as a bool array with one column per card ordinal
+    masks = np.asarray(masks, dtype=np.uint64)
+    return ((masks[:, None] >> np.arange(52, dtype=np.uint64)) & np.uint64(1)).astype(bool)
+
+
+class ShardWriter:
+    """ Streams rows into fixed-size .npz shards
+
+    Rows are copied into a buffer preallocated for one shard, and each full
+    buffer is saved as <prefix>-00000.npz, <prefix>-00001.npz, ... with one
+    array per field, so memory use does not grow with the number of rows.
+    Every shard holds shard_rows rows except the last one, written by close().
+    Shards are written under a temporary name and linked to the first free
+    shard number when complete, so writers sharing a prefix (or a prefix
+    with gaps in its numbering) never replace each other's shards.
+
+    Attributes:
+        prefix: str
+            path prefix of the shard files
+        rows: int
+            number of rows written (including those still buffered)
+        shard_rows: int
+            rows per shard
+    """
+
+    def __init__(self, prefix: str, dtype, shard_rows: int = 1 << 20):
+        self.prefix = prefix
+        self.shard_rows = shard_rows
+        self.buffer = np.zeros(shard_rows, dtype=dtype)
+        self.filled = 0
+        self.rows = 0
+        self.shard = len(shard_paths(prefix))
+        self.paths = []
+
+    def add(self, rows):
+        # rows: a structured array of the writer's dtype
+        start = 0
+        while start < len(rows):
+            n = min(len(rows) - start, self.shard_rows - self.filled)
+            self.buffer[self.filled:self.filled + n] = rows[start:start + n]
+            self.filled += n
+            self.rows += n
+            start += n
+            if self.filled == self.shard_rows:
+                self.flush()
+
+    def flush(self):
+        if self.filled == 0:
+            return
+        rows = self.buffer[:self.filled]
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.prefix) + '-', suffix='.tmp',
+                                   dir=os.path.dirname(self.prefix) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **{name: rows[name] for name in rows.dtype.names})
+            # link fails if another writer has taken the number, where a rename would replace its shard
+            while True:
+                path = self.prefix + '-%05d' % self.shard + SHARD_SUFFIX
+                try:
+                    os.link(tmp, path)
+                    break
+                except FileExistsError:
+                    self.shard += 1
+        finally:
+            os.remove(tmp)
+        self.paths.append(path)
+        self.shard += 1
+        self.filled = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def shard_paths(prefix: str):
+    return sorted(glob.glob(glob.escape(prefix) + '-[0-9][0-9][0-9][0-9][0-9]' + SHARD_SUFFIX))
+
+
+def load_shard(path: str):
+    # The arrays of one shard, by field name
+    with np.load(path) as shard:
+        return {name: shard[name] for name in shard.files}
+
+
+class DecisionRecorder:
+    """ Records every automated CrazyEights decision as a training example
+
+    attach(game) shadows the game's play_turn_auto and play_game with
+    recording wrappers stored on the game object, like instrument.Instrument,
+    so the class and other games are untouched; clones of the game (such as a
+    searching player's scratch games) are not recorded.  Each decision made in
+    play_turn_auto is staged with the state the player saw; when play_game
+    returns, the game's outcome is filled in for every staged row and the
+    rows go to the writer.  Decisions made by players with their own
+    choose_move are not automated and are not recorded.
+
+    Attributes:
+        game_id: int
+            id stored with the rows of the current game; counts up from 0 by
+            default, or set it before each game
+        max_opponents: int
+            number of opponent hand sizes kept per row
+        writer: ShardWriter
+            where finished games go
+    """
+
+    def __init__(self, writer: ShardWriter, max_opponents: int = 7):
+        self.writer = writer
+        self.max_opponents = max_opponents
+        self.dtype = writer.buffer.dtype
+        self.game_id = 0
+        self.staged = []
+        # Game -> the attributes attach replaced, and the wrappers it put there
+        self.attached = weakref.WeakKeyDictionary()
+
+    def attach(self, game: CrazyEights):
+        if len(game.players) - 1 > self.max_opponents:
+            raise ValueError('Only ' + str(self.max_opponents) + ' opponent hand sizes fit in a row')
+        if game in self.attached:
+            return game
+        play_turn_auto = game.play_turn_auto
+        play_game = game.play_game
+        clone = game.clone
+        staged = self.staged
+        padding = (0,) * (self.max_opponents - len(game.players) + 1)
+
+        def recorded_turn():
+            player = game.curr_player
+            hand = player.hand.mask
+            top = game.discard_pile.cards[-1].ordinal
+            suit = SUIT_INDEX[game.current_suit]
+            legal = hand & PLAYABLE_MASKS[top][suit]
+            opponents = []
+            p = game.next_player[player]
+            while p is not player:
+                opponents.append(len(p.hand))
+                p = game.next_player[p]
+            draws = game.num_draws
+            deck = len(game.deck)
+            play_turn_auto()
+            if game.num_draws > draws:
+                action = DRAW
+                called = -1
+            else:
+                action = game.discard_pile.cards[-1].ordinal
+                called = SUIT_INDEX[game.current_suit] if game.discard_pile.cards[-1].rank == 8 else -1
+            staged.append((self.game_id, game.players.index(player), game.num_turns, hand, top, suit,
+                           tuple(opponents) + padding, deck, legal or DRAW_BIT, action, called, 0))
+
+        def recorded_game():
+            staged.clear()
+            play_game()
+            self.finish_game(game)
+
+        # Clones copy the game's attributes, so take the wrappers off them
+        def clone_without_recorder(*args, **kwargs):
+            copy = clone(*args, **kwargs)
+            for name in ('play_turn_auto', 'play_game', 'clone'):
+                vars(copy).pop(name, None)
+            return copy
+
+        wrappers = {'play_turn_auto': recorded_turn, 'play_game': recorded_game, 'clone': clone_without_recorder}
+        self.attached[game] = ({name: vars(game).get(name) for name in wrappers}, wrappers)
+        for name, wrapper in wrappers.items():
+            setattr(game, name, wrapper)
+        return game
+
+    def detach(self, game: CrazyEights):
+        # Put back what attach replaced, leaving alone anything attached on top since
+        saved, wrappers = self.attached.pop(game, ({}, {}))
+        for name, wrapper in wrappers.items():
+            if vars(game).get(name) is wrapper:
+                if saved[name] is None:
+                    del vars(game)[name]
+                else:
+                    setattr(game, name, saved[name])
+        return game
+
+    def finish_game(self, game: CrazyEights):
+        # Fill in the outcome of the staged rows and hand them to the writer.  Called when
+        # play_game returns; call it yourself when driving a game turn by turn.
+        if self.staged:
+            rows = np.array(self.staged, dtype=self.dtype)
+            if game.winner is not None:
+                won = rows['seat'] == game.players.index(game.winner)
+                rows['outcome'] = np.where(won, 1, -1)
+            self.writer.add(rows)
+            self.staged.clear()
+        self.game_id += 1
+
+
+def generate(prefix: str, n_games: int, players, num_cards: int, seed = 0, start = 0,
+             shard_rows: int = 1 << 20, max_opponents: int = 7, game_class = CrazyEights):
+    # Play games start .. start + n_games - 1 (seeded as in simulation.simulate) and write
+    # every automated decision to <prefix>-NNNNN.npz shards.  Returns the shard paths.
+    game = game_class(make_players(players), num_cards)
+    game.rng = random.Random()
+    game.setup_game()
+    with ShardWriter(prefix, row_dtype(max_opponents), shard_rows) as writer:
+        recorder = DecisionRecorder(writer, max_opponents)
+        recorder.attach(game)
+        for i in range(start, start + n_games):
+            game.reset(game_seed(seed, i))
+            recorder.game_id = i
+            play_silent_game(game)
+    return writer.paths
+
+
+def _generate_range(args):
+    return generate(*args)
+
+
+def run_selfplay(prefix: str, n_games: int, players, num_cards: int, seed = 0, workers = None,
+                 shard_rows: int = 1 << 20, max_opponents: int = 7, game_class = CrazyEights):
+    # generate on a process pool: worker k plays one contiguous range of games into
+    # <prefix>-wKK-NNNNN.npz, so each worker leaves at most one short shard
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, n_games))
+    bounds = [n_games * k // workers for k in range(workers + 1)]
+    tasks = [(prefix + '-w%02d' % k, bounds[k + 1] - bounds[k], players, num_cards, seed, bounds[k],
+              shard_rows, max_opponents, game_class) for k in range(workers)]
+    if workers == 1:
+        return _generate_range(tasks[0])
+    with Pool(workers) as pool:
+        return [path for paths in pool.map(_generate_range, tasks) for path in paths]
+
+
+def test_selfplay():
+    from simulation import simulate
+
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = os.path.join(tmp, 'eights')
+        start = time.perf_counter()
+        paths = generate(prefix, 500, 3, 5, seed=4, shard_rows=4000)
+        elapsed = time.perf_counter() - start
+        shards = [load_shard(p) for p in paths]
+        sizes = [len(s['action']) for s in shards]
+        print('shards: ' + str(len(paths)) + ', rows: ', sizes)
+        print('all but the last are full: ' + str(all(n == 4000 for n in sizes[:-1])))
+        rows = {name: np.concatenate([s[name] for s in shards]) for name in shards[0]}
+        print('examples/sec: ' + str(round(len(rows['action']) / elapsed)))
+        hands = unpack_masks(rows['hand'])
+        legal = unpack_masks(rows['legal'])
+        drew = rows['action'] == DRAW
+        print('hand features: ' + str(hands.shape) + ', played card was in hand and legal: '
+              + str(bool(np.all(hands[~drew, rows['action'][~drew]]) and np.all(legal[~drew, rows['action'][~drew]]))))
+        print('draws only when nothing is playable: '
+              + str(bool(np.all((rows['legal'][drew] == DRAW_BIT)) and not np.any(rows['legal'][~drew] & DRAW_BIT))))
+        print('suit called exactly for eights: ' + str(bool(np.all((rows['called'] >= 0) == (~drew & (rows['action'] % 13 == 6))))))
+
+        # Recording must not change the games, and outcomes must match the winners
+        results = simulate(500, 3, 5, seed=4)
+        winners = np.array([-1 if r.winner is None else r.winner for r in results])
+        expected = np.where(winners[rows['game']] < 0, 0, np.where(winners[rows['game']] == rows['seat'], 1, -1))
+        print('outcomes match simulate: ' + str(bool(np.array_equal(expected, rows['outcome']))))
+        print('turns match simulate: ' + str(all(rows['turn'][rows['game'] == i].max() <= r.turns
+                                                 for i, r in enumerate(results))))
+
+        paths = run_selfplay(os.path.join(tmp, 'pool'), 400, 4, 5, seed=4, workers=2, shard_rows=5000)
+        print('parallel shards: ', [os.path.basename(p) for p in paths])
+
+        # Writers sharing a prefix, which has a gap in its numbering, keep every row
+        shared = os.path.join(tmp, 'shared')
+        rows = np.zeros(10, dtype=row_dtype())
+        with ShardWriter(shared, row_dtype(), shard_rows=10) as w:
+            w.add(rows)
+        os.rename(w.paths[0], shared + '-00001' + SHARD_SUFFIX)
+        writers = [ShardWriter(shared, row_dtype(), shard_rows=10) for i in range(2)]
+        for w in writers:
+            w.add(rows)
+        print('shared prefix shards: ', [os.path.basename(p) for p in shard_paths(shared)],
+              ', rows kept: ' + str(sum(len(load_shard(p)['action']) for p in shard_paths(shared))))
+
+        # A searching player's scratch games are clones, and must neither be recorded nor touch the game
+        from cardplayer import CardPlayer
+        from ismcts import ISMCTSPlayer
+        with ShardWriter(os.path.join(tmp, 'search'), row_dtype(), shard_rows=1000) as writer:
+            recorder = DecisionRecorder(writer)
+            game = recorder.attach(CrazyEights([ISMCTSPlayer('mcts', max_rollouts=5, seed=1), CardPlayer('cpu')], 7))
+            game.rng = random.Random(3)
+            game.setup_game()
+            game.play_game()
+            automated = writer.rows
+            recorder.detach(game)
+        print('with a searching player: ' + str(automated) + ' rows, all from the automated seat: '
+              + str(bool(np.all(load_shard(writer.paths[0])['seat'] == 1)))
+              + ', detached: ' + str(not {'play_turn_auto', 'play_game', 'clone'} & set(vars(game))))
+
+
+if __name__ == '__main__':
+    test_selfplay()
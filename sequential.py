@@ -0,0 +1,207 @@
+from tournament import play_match, GreedyPlayer, HighCardEights, RandomPlayer
+import math
+
+
+class RunningStats:
+    """ Online mean and variance (Welford's method)
+
+    Attributes:
+        count: int
+            number of values seen
+        mean: float
+            mean of the values
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, x: float):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        # Combine with stats gathered separately (e.g. by another worker)
+        n = self.count + other.count
+        if n == 0:
+            return self
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta * delta * self.count * other.count / n
+        self.mean += delta * other.count / n
+        self.count = n
+        return self
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    @property
+    def stderr(self):
+        if self.count < 2:
+            return math.inf
+        return math.sqrt(self.variance / self.count)
+
+
+class SPRT:
+    """ Sequential probability ratio test on a win rate
+
+    Tests H0: p = p0 against H1: p = p1 one game at a time, with error rates
+    alpha (accepting H1 when H0 holds) and beta (accepting H0 when H1 holds).
+
+    Attributes:
+        decision: str
+            None while undecided, then 'H0' or 'H1'
+        llr: float
+            log-likelihood ratio of H1 to H0 so far
+    """
+
+    def __init__(self, p0: float = 0.5, p1: float = 0.55, alpha: float = 0.05, beta: float = 0.05):
+        self.win_step = math.log(p1 / p0)
+        self.loss_step = math.log((1 - p1) / (1 - p0))
+        self.upper = math.log((1 - beta) / alpha)
+        self.lower = math.log(beta / (1 - alpha))
+        self.llr = 0.0
+        self.decision = None
+
+    def update(self, win: bool):
+        # Add one decisive game; returns the decision (None while undecided)
+        if self.decision is None:
+            self.llr += self.win_step if win else self.loss_step
+            if self.llr >= self.upper:
+                self.decision = 'H1'
+            elif self.llr <= self.lower:
+                self.decision = 'H0'
+        return self.decision
+
+
+class ConfidenceStop:
+    """ Confidence-interval stopping rule for a mean
+
+    Stops with 'different' once the interval mean +/- z * stderr excludes
+    null, or with 'negligible' once it lies inside null +/- margin.  Looking
+    after every sample makes the interval optimistic, so z should be larger
+    than for a single fixed-size test (the default 3.0 is conservative).
+
+    Attributes:
+        decision: str
+            None while undecided, then 'different' or 'negligible'
+        stats: RunningStats
+            the samples seen so far
+    """
+
+    def __init__(self, null: float = 0.5, margin: float = 0.02, z: float = 3.0, min_samples: int = 100):
+        self.null = null
+        self.margin = margin
+        self.z = z
+        self.min_samples = min_samples
+        self.stats = RunningStats()
+        self.decision = None
+
+    def interval(self):
+        half = self.z * self.stats.stderr
+        return (self.stats.mean - half, self.stats.mean + half)
+
+    def update(self, x: float):
+        self.stats.add(x)
+        if self.decision is None and self.stats.count >= self.min_samples:
+            low, high = self.interval()
+            if low > self.null or high < self.null:
+                self.decision = 'different'
+            elif low >= self.null - self.margin and high <= self.null + self.margin:
+                self.decision = 'negligible'
+        return self.decision
+
+
+class ComparisonStats:
+    """ Streaming statistics of a head-to-head comparison between strategies A and B
+
+    Attributes:
+        decisive: int
+            games with a winner
+        games: int
+            games played
+        length: RunningStats
+            game length in turns
+        score: RunningStats
+            A's result per game: 1 win, 0 loss, 0.5 no winner
+        wins_a, wins_b: int
+            games won by each strategy
+    """
+
+    def __init__(self):
+        self.games = 0
+        self.decisive = 0
+        self.wins_a = 0
+        self.wins_b = 0
+        self.score = RunningStats()
+        self.length = RunningStats()
+
+    def add(self, a_won):
+        # a_won: True, False, or None when nobody won
+        self.games += 1
+        if a_won is None:
+            self.score.add(0.5)
+        else:
+            self.decisive += 1
+            if a_won:
+                self.wins_a += 1
+            else:
+                self.wins_b += 1
+            self.score.add(1.0 if a_won else 0.0)
+
+    def as_dict(self):
+        return {'games': self.games, 'wins_a': self.wins_a, 'wins_b': self.wins_b,
+                'score_a': round(self.score.mean, 4), 'score_stderr': round(self.score.stderr, 4),
+                'mean_turns': round(self.length.mean, 2), 'turns_variance': round(self.length.variance, 2)}
+
+
+def compare_strategies(a, b, max_games: int = 100000, rule = None, num_cards: int = 5, seed = 0):
+    # Play A against B in 2-player Crazy Eights, alternating seats, until the stopping
+    # rule decides or max_games is reached.  a and b are tournament entrants
+    # (CardPlayer or CrazyEights subclasses).  rule is an SPRT (fed decisive games)
+    # or a ConfidenceStop on A's score (the default).  Returns (decision, stats).
+    if rule is None:
+        rule = ConfidenceStop()
+    stats = ComparisonStats()
+    entrants = [a, b]
+    decision = None
+    for i in range(max_games):
+        seating = (0, 1) if i % 2 == 0 else (1, 0)
+        result = play_match((i, seating, entrants, num_cards, seed))
+        winner = result['winner']
+        a_won = None if winner is None else seating[winner] == 0
+        stats.add(a_won)
+        stats.length.add(result['turns'])
+        if isinstance(rule, SPRT):
+            if a_won is not None:
+                decision = rule.update(a_won)
+        else:
+            decision = rule.update(0.5 if a_won is None else float(a_won))
+        if decision is not None:
+            break
+    return decision, stats
+
+
+def test_sequential():
+    decision, stats = compare_strategies(GreedyPlayer, RandomPlayer, seed=1)
+    print('greedy vs random (CI rule): ' + str(decision) + ', ', stats.as_dict())
+    decision, stats = compare_strategies(GreedyPlayer, RandomPlayer, rule=SPRT(0.5, 0.55), seed=1)
+    print('greedy vs random (SPRT):    ' + str(decision) + ', ', stats.as_dict())
+    decision, stats = compare_strategies(GreedyPlayer, HighCardEights, max_games=20000,
+                                         rule=ConfidenceStop(margin=0.03), seed=1)
+    print('greedy vs high card (CI):   ' + str(decision) + ', ', stats.as_dict())
+    merged = RunningStats()
+    half = RunningStats()
+    for x in range(10):
+        (merged if x < 5 else half).add(x)
+    merged.merge(half)
+    print('merged mean/variance: ', merged.mean, round(merged.variance, 4))
+
+
+if __name__ == '__main__':
+    test_sequential()
@@ -0,0 +1,241 @@
+from cardgame import CardGame
+from cardplayer import CardPlayer
+from crazyeights import CrazyEights, DecisionCache
+from cardpile import DrawPile, LazyDrawPile
+from gameevents import NULL_SINK
+from collections import namedtuple
+from multiprocessing import Pool
+import math
+import os
+import random
+import time
+
+
+GameResult = namedtuple('GameResult', ['winner', 'turns', 'draws', 'recycles', 'hit_recycle_cap'])
+GameResult.__doc__ = """ Compact result of one simulated game
+
+    Attributes:
+        winner: int
+            seat index of the winning player, None if nobody emptied their hand
+        turns: int
+            number of turns played
+        draws: int
+            number of cards drawn from the deck
+        recycles: int
+            number of times the discard pile was recycled into the deck
+        hit_recycle_cap: bool
+            if true, the game ended because the discard pile could not be recycled again
+"""
+
+
+def make_players(players):
+    # Accept either a number of players or a list of player names
+    if isinstance(players, int):
+        names = ['p' + str(i + 1) for i in range(players)]
+    else:
+        names = list(players)
+    return [CardPlayer(name) for name in names]
+
+
+def play_silent_game(game: CardGame):
+    # Play a game that has been set up (or reset) without any output, and summarise it
+    game.sink = NULL_SINK
+    game.play_game()
+    winner = None
+    if game.winner is not None:
+        winner = game.players.index(game.winner)
+    recycles = game.times_recycling_discard_pile
+    hit_cap = winner is None and recycles >= game.max_times_recycling_discard_pile
+    return GameResult(winner, game.num_turns, game.num_draws, recycles, hit_cap)
+
+
+def game_seed(seed, index: int):
+    # Seed for one game, derived from the master seed and the game index.
+    # String seeds are hashed with SHA-512 by random.Random, so the derived
+    # streams are the same in every process and on every platform.
+    return str(seed) + ':' + str(index)
+
+
+def simulate(n_games: int, players, num_cards: int, seed = None, game_class = CrazyEights, start = 0,
+             deck_class = None, cache_size: int = 0):
+    # Play n_games complete games headlessly and return a list of GameResults
+    # players: number of players, or a list of player names (all automated)
+    # Game i uses its own random.Random seeded from (seed, start + i)
+    # deck_class: LazyDrawPile to shuffle the deck as cards are drawn (other games, same statistics)
+    # cache_size: if not 0, CrazyEights decisions go through a DecisionCache of this size (same games)
+    # On one core this plays about 6x the games per second of the original printing loop
+    # (3 players, 5 cards: ~6500 against ~1100 writing to a file), short of the 10x aimed
+    # for.  What is left is the turn logic itself, which goes through the overridable
+    # game methods that strategies, instrument.Instrument and selfplay.DecisionRecorder
+    # hook into; run_parallel spreads games over cores instead.
+    if seed is None:
+        seed = random.getrandbits(64)
+    # One game object is reset for every deal
+    game = game_class(make_players(players), num_cards)
+    if deck_class is not None:
+        game.deck_class = deck_class
+    if cache_size:
+        game.decision_cache = DecisionCache(cache_size)
+    game.rng = random.Random()
+    game.setup_game()
+    results = []
+    for i in range(start, start + n_games):
+        game.reset(game_seed(seed, i))
+        results.append(play_silent_game(game))
+    return results
+
+
+class SimulationStats:
+    """ Running totals over a batch of GameResults
+
+    Totals are plain sums, so stats from separate batches can be merged in any
+    order and give the same answer.
+
+    Attributes:
+        games: int
+            number of games played
+        wins: int[]
+            number of games won by each seat
+        turns: int
+            total number of turns
+        turns_sq: int
+            total of the squared number of turns (for the variance of game length)
+        draws: int
+            total number of cards drawn
+        recycles: int
+            total number of discard pile recycles
+        capped: int
+            number of games that ended at the recycle cap
+    """
+
+    def __init__(self, num_seats: int):
+        self.games = 0
+        self.wins = [0] * num_seats
+        self.turns = 0
+        self.turns_sq = 0
+        self.draws = 0
+        self.recycles = 0
+        self.capped = 0
+
+    def add(self, result: GameResult):
+        self.games += 1
+        if result.winner is not None:
+            self.wins[result.winner] += 1
+        self.turns += result.turns
+        self.turns_sq += result.turns * result.turns
+        self.draws += result.draws
+        self.recycles += result.recycles
+        if result.hit_recycle_cap:
+            self.capped += 1
+
+    def merge(self, other):
+        self.games += other.games
+        self.wins = [a + b for a, b in zip(self.wins, other.wins)]
+        self.turns += other.turns
+        self.turns_sq += other.turns_sq
+        self.draws += other.draws
+        self.recycles += other.recycles
+        self.capped += other.capped
+        return self
+
+    @property
+    def mean_turns(self):
+        if self.games == 0:
+            return 0.0
+        return self.turns / self.games
+
+    @property
+    def stdev_turns(self):
+        if self.games < 2:
+            return 0.0
+        var = (self.turns_sq - self.turns * self.turns / self.games) / (self.games - 1)
+        return math.sqrt(max(var, 0.0))
+
+    def win_rate(self, seat: int):
+        if self.games == 0:
+            return 0.0
+        return self.wins[seat] / self.games
+
+    def as_dict(self):
+        return dict(games=self.games, wins=list(self.wins), turns=self.turns, turns_sq=self.turns_sq,
+                    draws=self.draws, recycles=self.recycles, capped=self.capped)
+
+
+def _simulate_chunk(args):
+    # Worker: play one chunk of games and send back only the totals
+    start, n_games, players, num_cards, seed, game_class, deck_class, cache_size = args
+    num_seats = players if isinstance(players, int) else len(players)
+    stats = SimulationStats(num_seats)
+    for r in simulate(n_games, players, num_cards, seed, game_class, start, deck_class, cache_size):
+        stats.add(r)
+    return stats
+
+
+def run_parallel(n_games: int, players, num_cards: int, seed = 0, game_class = CrazyEights,
+                 workers = None, chunk_size = 500, deck_class = None, cache_size: int = 0):
+    # Shard n_games across a process pool and merge the per-chunk totals as they arrive.
+    # Each game is seeded from (seed, game index), so the result does not depend on
+    # the number of workers or the chunk size.
+    num_seats = players if isinstance(players, int) else len(players)
+    chunks = [(start, min(chunk_size, n_games - start), players, num_cards, seed, game_class,
+               deck_class, cache_size) for start in range(0, n_games, chunk_size)]
+    stats = SimulationStats(num_seats)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for chunk in chunks:
+            stats.merge(_simulate_chunk(chunk))
+        return stats
+    with Pool(workers) as pool:
+        for chunk_stats in pool.imap_unordered(_simulate_chunk, chunks):
+            stats.merge(chunk_stats)
+    return stats
+
+
+def test_simulate():
+    for game_class in [CardGame, CrazyEights]:
+        start = time.perf_counter()
+        results = simulate(2000, 3, 5, seed=1, game_class=game_class)
+        elapsed = time.perf_counter() - start
+        wins = [0, 0, 0]
+        for r in results:
+            if r.winner is not None:
+                wins[r.winner] += 1
+        print(game_class.name + ': ' + str(len(results)) + ' games in ' + str(round(elapsed, 3)) + 's')
+        print('  games/sec: ' + str(round(len(results) / elapsed)))
+        print('  wins by seat: ', wins)
+        print('  recycle cap hit: ' + str(sum(r.hit_recycle_cap for r in results)))
+        print('  first result: ', results[0])
+    # The same seed replays the same games
+    print('repeatable: ' + str(simulate(50, 2, 5, seed=7) == simulate(50, 2, 5, seed=7)))
+
+
+def test_run_parallel():
+    serial = run_parallel(4000, 3, 5, seed=11, workers=1)
+    start = time.perf_counter()
+    parallel = run_parallel(4000, 3, 5, seed=11, workers=4, chunk_size=250)
+    elapsed = time.perf_counter() - start
+    print('parallel: ' + str(parallel.games) + ' games in ' + str(round(elapsed, 3)) + 's')
+    print('  wins by seat: ', parallel.wins)
+    print('  mean turns: ' + str(round(parallel.mean_turns, 2)) + ' stdev: ' + str(round(parallel.stdev_turns, 2)))
+    print('  same as serial: ' + str(serial.as_dict() == parallel.as_dict()))
+
+
+def test_lazy_deck():
+    # A lazily shuffled deck plays different games with the same statistics
+    n_games = 20000
+    stats = []
+    for deck_class in (DrawPile, LazyDrawPile):
+        start = time.perf_counter()
+        stats.append(run_parallel(n_games, 2, 5, seed=3, workers=1, deck_class=deck_class))
+        elapsed = time.perf_counter() - start
+        print(deck_class.__name__ + ': ' + str(round(n_games / elapsed)) + ' games/sec, mean turns '
+              + str(round(stats[-1].mean_turns, 2)) + ', seat 0 win rate ' + str(round(stats[-1].win_rate(0), 4)))
+    se = math.sqrt((stats[0].stdev_turns ** 2 + stats[1].stdev_turns ** 2) / n_games)
+    print('  mean turns within 4 standard errors: ' + str(abs(stats[0].mean_turns - stats[1].mean_turns) < 4 * se))
+
+
+if __name__ == '__main__':
+    test_simulate()
+    test_run_parallel()
+    test_lazy_deck()
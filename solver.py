@@ -0,0 +1,289 @@
+from card import CARD_TABLE, SUITS, SUIT_INDEX, SUIT_BITS
+from crazyeights import CrazyEights, PLAYABLE_MASKS, EIGHTS_MASK
+from collections import namedtuple
+import random
+import time
+
+
+# Transposition table entry flags: the stored value is exact, a lower bound or an upper bound
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# Rough size of one table slot (list slot, entry tuple and 64-bit key)
+ENTRY_BYTES = 128
+
+# Moves are encoded as ordinal * 4 + suit index of the new current suit; drawing is DRAW
+DRAW = -1
+
+# Zobrist keys: a card in either player's hand, the top card, the current suit,
+# the number of cards left in the deck, and the player to move
+_rng = random.Random(0x5EED)
+Z_HAND = [[_rng.getrandbits(64) for o in range(52)] for side in range(2)]
+Z_TOP = [_rng.getrandbits(64) for o in range(52)]
+Z_SUIT = [_rng.getrandbits(64) for s in range(4)]
+Z_DECK = [_rng.getrandbits(64) for n in range(53)]
+Z_SIDE = _rng.getrandbits(64)
+del _rng
+
+
+Solution = namedtuple('Solution', ['value', 'move', 'suit'])
+Solution.__doc__ = """ Outcome of a solved position
+
+    Attributes:
+        value: int
+            1 if the player to move wins with best play, -1 if they lose, 0 if
+            the deck runs out first
+        move:
+            best move, 'd' or a Card
+        suit: str
+            suit to call when the best move is an eight, otherwise None
+"""
+
+
+def _ordinals(mask: int):
+    # Card ordinals in a mask, lowest first
+    out = []
+    while mask:
+        low = mask & -mask
+        out.append(low.bit_length() - 1)
+        mask ^= low
+    return out
+
+
+class EndgameSolver:
+    """ Exact solver for fully known 2-player Crazy Eights positions
+
+    Negamax with alpha-beta pruning over every legal move (a playable card,
+    with each of the four suit calls for an eight, or a draw when nothing can
+    be played).  Positions are hashed with Zobrist keys into a fixed-size,
+    always-replace transposition table sized from memory_limit.
+
+    Once the deck runs out the discard pile would be shuffled back in, which
+    no one can foresee, so a draw that empties the deck scores 0 (no winner).
+    A position's hash leaves out the deck order, so the table is cleared
+    whenever a position comes from a different deck; later positions of the
+    same game share it.
+
+    Attributes:
+        hits: int
+            table probes that found the position
+        nodes: int
+            positions searched
+        probes: int
+            table lookups
+        search_time: float
+            seconds spent searching
+        size: int
+            number of table slots (a power of two)
+    """
+
+    def __init__(self, memory_limit: int = 64 << 20):
+        size = 1
+        while size * 2 * ENTRY_BYTES <= memory_limit:
+            size *= 2
+        self.size = size
+        self.mask = size - 1
+        self.table = [None] * size
+        self.history = [0] * 208
+        self.deck = b''
+        self.nodes = 0
+        self.probes = 0
+        self.hits = 0
+        self.search_time = 0.0
+
+    @property
+    def nodes_per_second(self):
+        if self.search_time == 0:
+            return 0.0
+        return self.nodes / self.search_time
+
+    @property
+    def hit_rate(self):
+        if self.probes == 0:
+            return 0.0
+        return self.hits / self.probes
+
+    def clear(self):
+        self.table = [None] * self.size
+        self.deck = b''
+
+    def position(self, game: CrazyEights):
+        # (me, opp, cards left in deck, top ordinal, suit index, side, key) for the player to move
+        if len(game.players) != 2:
+            raise ValueError('EndgameSolver needs a 2-player game')
+        if game.completed:
+            raise ValueError('The game is already over')
+        state = game.snapshot()
+        # Deck bottom card first, so the cards left are always a prefix
+        deck = state.deck[::-1]
+        if not self.deck.startswith(deck):
+            self.clear()
+            self.deck = deck
+        side = state.curr_player
+        hands = [0, 0]
+        key = 0
+        for s in range(2):
+            for o in state.hands[s]:
+                hands[s] |= 1 << o
+                key ^= Z_HAND[s][o]
+        top = state.discard[-1]
+        suit = SUIT_INDEX[state.current_suit]
+        key ^= Z_TOP[top] ^ Z_SUIT[suit] ^ Z_DECK[len(deck)]
+        if side:
+            key ^= Z_SIDE
+        return hands[side], hands[1 - side], len(deck), top, suit, side, key
+
+    def solve(self, game: CrazyEights):
+        # Game-theoretic value and best move for the player to move
+        values = self.move_values(game, first_win=True)
+        best = max(values, key=lambda mv: mv[1])
+        move, value = best
+        if move == DRAW:
+            return Solution(value, 'd', None)
+        return Solution(value, CARD_TABLE[move >> 2], SUITS[move & 3] if move >> 2 in _EIGHTS else None)
+
+    def move_values(self, game: CrazyEights, first_win: bool = False):
+        # Exact value of every legal move for the player to move, as (move, value) with
+        # move encoded as in this module.  first_win stops at the first winning move.
+        me, opp, left, top, suit, side, key = self.position(game)
+        start = time.perf_counter()
+        values = []
+        for move in self.ordered_moves(me, opp, top, suit, None):
+            values.append((move, self.value_after(me, opp, left, top, suit, side, key, move, -1, 1)))
+            if first_win and values[-1][1] == 1:
+                break
+        self.search_time += time.perf_counter() - start
+        return values
+
+    def ordered_moves(self, me: int, opp: int, top: int, suit: int, first):
+        # Legal moves: the table's best move first, then by the history heuristic (moves
+        # that have caused cutoffs before), then plain cards highest first and eights last
+        playable = me & PLAYABLE_MASKS[top][suit]
+        if playable == 0:
+            return [DRAW]
+        history = self.history
+        scored = []
+        for o in _ordinals(playable):
+            if o in _EIGHTS:
+                for s in range(4):
+                    m = o * 4 + s
+                    scored.append((history[m], -1, m))
+            else:
+                m = o * 4 + o // 13
+                scored.append((history[m], o % 13, m))
+        scored.sort(reverse=True)
+        moves = [m for h, r, m in scored]
+        if first is not None and first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+        return moves
+
+    def value_after(self, me, opp, left, top, suit, side, key, move, alpha, beta):
+        # Value for the player to move of making move, searched in the window (alpha, beta)
+        if move == DRAW:
+            card = self.deck[left - 1]
+            if left == 1:
+                return 0
+            return -self.search(opp, me | (1 << card), left - 1, top, suit, 1 - side,
+                                key ^ Z_HAND[side][card] ^ Z_DECK[left] ^ Z_DECK[left - 1] ^ Z_SIDE,
+                                -beta, -alpha)
+        o = move >> 2
+        s = move & 3
+        rest = me ^ (1 << o)
+        if rest == 0:
+            return 1
+        return -self.search(opp, rest, left, o, s, 1 - side,
+                            key ^ Z_HAND[side][o] ^ Z_TOP[top] ^ Z_TOP[o] ^ Z_SUIT[suit] ^ Z_SUIT[s] ^ Z_SIDE,
+                            -beta, -alpha)
+
+    def search(self, me, opp, left, top, suit, side, key, alpha, beta):
+        self.nodes += 1
+        self.probes += 1
+        slot = key & self.mask
+        entry = self.table[slot]
+        tt_move = None
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            value, flag, tt_move = entry[1], entry[2], entry[3]
+            if flag == EXACT:
+                return value
+            if flag == LOWER:
+                if value > alpha:
+                    alpha = value
+            elif value < beta:
+                beta = value
+            if alpha >= beta:
+                return value
+        playable = me & PLAYABLE_MASKS[top][suit]
+        # Playing the last card wins at once
+        if playable and me & (me - 1) == 0:
+            return 1
+        original_alpha = alpha
+        best = -2
+        best_move = None
+        for move in self.ordered_moves(me, opp, top, suit, tt_move):
+            value = self.value_after(me, opp, left, top, suit, side, key, move, alpha, beta)
+            if value > best:
+                best = value
+                best_move = move
+                if value > alpha:
+                    alpha = value
+                    if alpha >= beta:
+                        if move != DRAW:
+                            self.history[move] += 1
+                        break
+        if best <= original_alpha:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table[slot] = (key, best, flag, best_move)
+        return best
+
+
+_EIGHTS = frozenset(_ordinals(EIGHTS_MASK))
+
+
+def test_EndgameSolver():
+    from cardplayer import CardPlayer
+    from simulation import game_seed
+
+    solver = EndgameSolver()
+    for num_cards in (5, 7, 8):
+        game = CrazyEights([CardPlayer('p1'), CardPlayer('p2')], num_cards)
+        game.rng = random.Random(game_seed(1, num_cards))
+        game.setup_game()
+        nodes = solver.nodes
+        elapsed = solver.search_time
+        solution = solver.solve(game)
+        print(str(num_cards) + ' cards each: value ' + str(solution.value) + ', best move '
+              + str(solution.move) + (' calling ' + solution.suit if solution.suit else '') + ', '
+              + str(solver.nodes - nodes) + ' nodes in ' + str(round(solver.search_time - elapsed, 2)) + 's')
+    print('nodes/sec: ' + str(round(solver.nodes_per_second)) + ', table hit rate: '
+          + str(round(solver.hit_rate, 3)) + ', table slots: ' + str(solver.size))
+
+    # Audit the heuristic: how often does its move throw away a win (or a no-winner result)?
+    decisions = 0
+    mistakes = 0
+    for i in range(10):
+        game = CrazyEights([CardPlayer('p1'), CardPlayer('p2')], 7)
+        game.rng = random.Random(game_seed(2, i))
+        game.setup_game()
+        while not game.completed:
+            if len(game.legal_moves(game.curr_player)) > 1:
+                values = dict(solver.move_values(game))
+                card = game.select_card_to_play(game.curr_player, game.find_playable_cards(game.curr_player))
+                suit = game.select_crazy_eight_suit(game.curr_player) if card.rank == 8 else card.suit
+                decisions += 1
+                if values[card.ordinal * 4 + SUIT_INDEX[suit]] < max(values.values()):
+                    mistakes += 1
+            game.play_turn()
+            game.end_turn()
+    print('heuristic decisions: ' + str(decisions) + ', worse than best play: ' + str(mistakes))
+    print('nodes/sec: ' + str(round(solver.nodes_per_second)) + ', table hit rate: ' + str(round(solver.hit_rate, 3)))
+
+
+if __name__ == '__main__':
+    test_EndgameSolver()
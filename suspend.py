@@ -0,0 +1,489 @@
+from cardgame import CardGame, GameState
+from cardplayer import CardPlayer
+from cardpile import LazyDrawPile
+from crazyeights import CrazyEights, DecisionCache
+from card import SUITS, SUIT_INDEX
+from gameevents import ConsoleSink
+from array import array
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+import hashlib
+import inspect
+import os
+import random
+import time
+
+
+FORMAT = 2
+
+# Classes by code.  A game is stored with the code of its exact class and its
+# players with theirs, so every process reading a store must register the same
+# classes in the same order.
+GAME_CLASSES = [CardGame, CrazyEights]
+PLAYER_CLASSES = [CardPlayer]
+
+# Flag bits of an encoded game
+COMPLETED = 1
+HAS_WINNER = 2
+HAS_SUIT = 4
+LAZY_DECK = 8
+SUIT_SHIFT = 4
+INTERACTIVE = 64
+HAS_CACHE = 128
+
+# Player bytes: class code in the low 7 bits, isManual in the top bit
+MANUAL = 0x80
+
+SUSPENDED_SUFFIX = '.game'
+
+
+def register_game_class(cls):
+    if cls not in GAME_CLASSES:
+        GAME_CLASSES.append(cls)
+    return cls
+
+
+def register_player_class(cls):
+    # A player class is rebuilt as cls(name, isManual), which only works if those are its
+    # only constructor arguments.  A class with other settings must save and restore them
+    # itself: suspend_state(self) returns bytes, and the classmethod
+    # resume_player(cls, name, isManual, state) builds the player from them.
+    if cls in PLAYER_CLASSES:
+        return cls
+    if not (hasattr(cls, 'suspend_state') and hasattr(cls, 'resume_player')):
+        params = list(inspect.signature(cls).parameters)
+        if params != ['name', 'isManual']:
+            raise ValueError(cls.__name__ + '(' + ', '.join(params) + ') is not built from (name, isManual); '
+                             'give it suspend_state and resume_player')
+    if len(PLAYER_CLASSES) == MANUAL:
+        raise ValueError('Too many player classes')
+    PLAYER_CLASSES.append(cls)
+    return cls
+
+
+def _varint(n: int):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def _read_varint(data, pos: int):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+        if b < 0x80:
+            return n, pos
+
+
+def _rng_seed(rng):
+    # 64-bit seed worked out from the rng's state without drawing from it, so encoding a
+    # game leaves the way it plays on unchanged
+    state = rng.getstate()
+    digest = hashlib.blake2b(array('L', state[1]).tobytes() + repr(state[2]).encode(), digest_size=8)
+    return digest.digest()
+
+
+def encode_game(game: CardGame):
+    # The full state of a game in a few dozen bytes: every card as a 6-bit ordinal (deck
+    # top first, then each hand in seat order, then the discard pile bottom first), the
+    # counters, current suit and players.  The random state is replaced by a 64-bit seed
+    # worked out from it, which seeds the rng of the decoded game.  A decision cache set
+    # on the game is not saved, only its size; see decode_game.
+    if type(game) not in GAME_CLASSES:
+        raise ValueError('Unregistered game class ' + type(game).__name__)
+    state = game.snapshot()
+    flags = 0
+    if state.completed:
+        flags |= COMPLETED
+    if state.winner is not None:
+        flags |= HAS_WINNER
+    if state.current_suit is not None:
+        flags |= HAS_SUIT | (SUIT_INDEX[state.current_suit] << SUIT_SHIFT)
+    if isinstance(game.deck, LazyDrawPile):
+        flags |= LAZY_DECK
+    if game.is_interactive:
+        flags |= INTERACTIVE
+    cache = vars(game).get('decision_cache')
+    if cache is not None:
+        flags |= HAS_CACHE
+    out = bytearray([FORMAT, GAME_CLASSES.index(type(game)), len(game.players), game.num_cards,
+                     game.num_decks, flags, state.curr_player, state.winner or 0, state.recycles,
+                     game.max_times_recycling_discard_pile])
+    out += _varint(state.num_turns)
+    out += _varint(state.num_draws)
+    if cache is not None:
+        out += _varint(cache.maxsize)
+    out += _rng_seed(game.rng)
+    out += _varint(len(state.deck))
+    out += _varint(len(state.discard))
+    for hand in state.hands:
+        out += _varint(len(hand))
+    ordinals = state.deck + b''.join(state.hands) + state.discard
+    packed = 0
+    for i, o in enumerate(ordinals):
+        packed |= o << (6 * i)
+    out += packed.to_bytes((6 * len(ordinals) + 7) // 8, 'little')
+    for p in game.players:
+        if type(p) not in PLAYER_CLASSES:
+            raise ValueError('Unregistered player class ' + type(p).__name__)
+        name = p.name.encode()
+        if len(name) > 255:
+            raise ValueError('Player name too long to encode')
+        out.append(PLAYER_CLASSES.index(type(p)) | (MANUAL if p.isManual else 0))
+        out.append(len(name))
+        out += name
+        extra = p.suspend_state() if hasattr(p, 'suspend_state') else b''
+        out += _varint(len(extra))
+        out += extra
+    return bytes(out)
+
+
+def decode_game(data: bytes, sink = None, decision_cache = None):
+    # A live game from encode_game's bytes, sending its events to sink.  A game that had a
+    # decision cache gets decision_cache, or a new cache of the same size if that is None.
+    # Bytes that are cut short or do not describe a valid game raise ValueError.
+    try:
+        return _decode_game(data, sink, decision_cache)
+    except (IndexError, UnicodeDecodeError) as e:
+        raise ValueError('Corrupt suspended game: ' + str(e))
+
+
+def _decode_game(data, sink, decision_cache):
+    def check(ok: bool, what: str):
+        if not ok:
+            raise ValueError('Corrupt suspended game: ' + what)
+
+    check(len(data) >= 12, 'only ' + str(len(data)) + ' bytes')
+    check(data[0] == FORMAT, 'unknown format ' + str(data[0]))
+    code, num_players, num_cards, num_decks, flags, curr_player, winner, recycles, max_recycles = data[1:10]
+    check(code < len(GAME_CLASSES), 'unregistered game class code ' + str(code))
+    check(num_players > 0 and num_decks > 0, 'no players or no decks')
+    check(curr_player < num_players and winner < num_players, 'seat out of range')
+    num_turns, pos = _read_varint(data, 10)
+    num_draws, pos = _read_varint(data, pos)
+    cache_size = 0
+    if flags & HAS_CACHE:
+        cache_size, pos = _read_varint(data, pos)
+    check(pos + 8 <= len(data), 'cut short')
+    seed = int.from_bytes(data[pos:pos + 8], 'little')
+    deck_len, pos = _read_varint(data, pos + 8)
+    discard_len, pos = _read_varint(data, pos)
+    hand_lens = []
+    for i in range(num_players):
+        n, pos = _read_varint(data, pos)
+        hand_lens.append(n)
+    total = deck_len + discard_len + sum(hand_lens)
+    check(total == 52 * num_decks, str(total) + ' cards for ' + str(num_decks) + ' deck(s)')
+    size = (6 * total + 7) // 8
+    check(pos + size <= len(data), 'cut short')
+    packed = int.from_bytes(data[pos:pos + size], 'little')
+    pos += size
+    ordinals = bytes([(packed >> (6 * i)) & 63 for i in range(total)])
+    check(max(ordinals) < 52, 'card ordinal out of range')
+    players = []
+    for i in range(num_players):
+        kind = data[pos]
+        n = data[pos + 1]
+        check(kind & ~MANUAL < len(PLAYER_CLASSES), 'unregistered player class code ' + str(kind & ~MANUAL))
+        check(pos + 2 + n <= len(data), 'cut short')
+        name = data[pos + 2:pos + 2 + n].decode()
+        extra_len, pos = _read_varint(data, pos + 2 + n)
+        check(pos + extra_len <= len(data), 'cut short')
+        cls = PLAYER_CLASSES[kind & ~MANUAL]
+        if hasattr(cls, 'resume_player'):
+            players.append(cls.resume_player(name, bool(kind & MANUAL), bytes(data[pos:pos + extra_len])))
+        else:
+            players.append(cls(name, bool(kind & MANUAL)))
+        pos += extra_len
+    check(pos == len(data), str(len(data) - pos) + ' bytes left over')
+    hands = []
+    start = deck_len
+    for n in hand_lens:
+        hands.append(ordinals[start:start + n])
+        start += n
+    state = GameState(ordinals[:deck_len], tuple(hands), ordinals[start:], curr_player, recycles,
+                      bool(flags & COMPLETED), winner if flags & HAS_WINNER else None, num_turns, num_draws,
+                      SUITS[(flags >> SUIT_SHIFT) & 3] if flags & HAS_SUIT else None)
+    # Build the piles directly, as clone does, rather than dealing a game only to overwrite it.
+    # is_interactive is set afterwards: passing it in would ask for a player name.
+    game = GAME_CLASSES[code](players, num_cards, sink=sink, num_decks=num_decks)
+    if flags & INTERACTIVE:
+        game.is_interactive = True
+        if sink is None:
+            game.sink = ConsoleSink()
+    if flags & HAS_CACHE:
+        game.decision_cache = decision_cache if decision_cache is not None else DecisionCache(cache_size)
+    if max_recycles != game.max_times_recycling_discard_pile:
+        game.max_times_recycling_discard_pile = max_recycles
+    if flags & LAZY_DECK:
+        game.deck_class = LazyDrawPile
+    game.rng = random.Random(seed)
+    game.deck = game.deck_class()
+    game.discard_pile = game.pile_class(visible = True)
+    for p in players:
+        p.hand = game.pile_class()
+    game.update_turn_order()
+    game.restore(state)
+    return game
+
+
+class SuspensionManager:
+    """ Keeps at most max_resident games in memory and suspends the rest to disk
+
+    Games are added under a key (a table id, say).  When more than
+    max_resident are in memory, the least recently used are encoded with
+    encode_game and written to <path>/<key>.game; suspend_idle does the same
+    for games not used for a while.  get() brings a suspended game back, and
+    pop() also hands it over, so the caller holds the only reference while it
+    is being played.  A resumed game sends its events to the sink given by
+    sink_factory(key), if there is one, and a resumed game that had a decision
+    cache shares decision_cache, if given.  Suspended games survive a restart
+    of the process as long as the same classes are registered.
+
+    Attributes:
+        decision_cache: DecisionCache
+            cache given to resumed games that had one, None for a new cache each
+        max_resident: int
+            most games kept in memory
+        path: str
+            directory of the suspended games
+        resident: OrderedDict
+            games in memory by key, least recently used first
+        resumes, suspensions: int
+            number of games read back and written out
+    """
+
+    def __init__(self, path: str, max_resident: int = 1000, sink_factory = None, decision_cache = None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_resident = max_resident
+        self.sink_factory = sink_factory
+        self.decision_cache = decision_cache
+        self.resident = OrderedDict()
+        self.last_used = {}
+        self.suspensions = 0
+        self.resumes = 0
+
+    def __len__(self):
+        return len(self.resident) + len(self.suspended_keys())
+
+    def __contains__(self, key):
+        return key in self.resident or os.path.exists(self.file_path(key))
+
+    def file_path(self, key):
+        return os.path.join(self.path, quote(str(key), safe='') + SUSPENDED_SUFFIX)
+
+    def suspended_keys(self):
+        # Keys of the games on disk, as strings
+        return [unquote(name[:-len(SUSPENDED_SUFFIX)]) for name in os.listdir(self.path)
+                if name.endswith(SUSPENDED_SUFFIX)]
+
+    def add(self, key, game: CardGame):
+        self.resident[key] = game
+        self.resident.move_to_end(key)
+        self.last_used[key] = time.monotonic()
+        while len(self.resident) > self.max_resident:
+            self.suspend(next(iter(self.resident)))
+
+    def get(self, key):
+        # The game, read back from disk if it was suspended; KeyError if there is none
+        game = self.resident.get(key)
+        if game is None:
+            game = self._resume(key)
+            self.add(key, game)
+        else:
+            self.resident.move_to_end(key)
+            self.last_used[key] = time.monotonic()
+        return game
+
+    def pop(self, key):
+        # The game, no longer held by the manager
+        game = self.resident.pop(key, None)
+        if game is None:
+            game = self._resume(key)
+        self.last_used.pop(key, None)
+        return game
+
+    def discard(self, key):
+        # Forget a game, in memory and on disk
+        self.resident.pop(key, None)
+        self.last_used.pop(key, None)
+        try:
+            os.remove(self.file_path(key))
+        except FileNotFoundError:
+            pass
+
+    def suspend(self, key):
+        game = self.resident.pop(key)
+        self.last_used.pop(key, None)
+        path = self.file_path(key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(encode_game(game))
+        os.replace(path + '.tmp', path)
+        self.suspensions += 1
+
+    def suspend_idle(self, max_idle: float):
+        # Suspend every resident game not used in the last max_idle seconds
+        cutoff = time.monotonic() - max_idle
+        idle = [key for key in self.resident if self.last_used[key] <= cutoff]
+        for key in idle:
+            self.suspend(key)
+        return len(idle)
+
+    def _resume(self, key):
+        path = self.file_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+        os.remove(path)
+        self.resumes += 1
+        sink = self.sink_factory(key) if self.sink_factory else None
+        return decode_game(data, sink, self.decision_cache)
+
+
+def test_encode_game():
+    from simulation import make_players
+    from tournament import HighCardEights, RandomPlayer
+    register_game_class(HighCardEights)
+    register_player_class(RandomPlayer)
+
+    cases = [('CrazyEights, 2 players', CrazyEights(make_players(2), 5)),
+             ('CrazyEights, 4 players, lazy deck', CrazyEights(make_players(4), 5)),
+             ('CardGame, 3 players', CardGame(make_players(3), 7)),
+             ('HighCardEights, 6 players, 2 decks', HighCardEights(make_players(6), 5, num_decks=2)),
+             ('CrazyEights, random player seat', CrazyEights([CardPlayer('you', True), RandomPlayer('bot')], 5))]
+    cases[1][1].deck_class = LazyDrawPile
+    for label, game in cases:
+        game.rng = random.Random(5)
+        game.setup_game()
+        sizes = []
+        same = True
+        for turn in range(40):
+            data = encode_game(game)
+            sizes.append(len(data))
+            copy = decode_game(data)
+            same = same and (copy.snapshot() == game.snapshot() and type(copy) is type(game)
+                             and [(type(p), p.name, p.isManual) for p in copy.players]
+                             == [(type(p), p.name, p.isManual) for p in game.players])
+            if game.completed:
+                break
+            game.play_turn_auto() if game.curr_player.isManual else game.play_turn()
+            game.end_turn()
+        print('%-36s %3d-%3d bytes, state restored exactly: %s' % (label, min(sizes), max(sizes), same))
+
+    # Two games decoded from the same bytes play out the same way
+    game = CrazyEights(make_players(3), 5)
+    game.rng = random.Random(8)
+    game.setup_game()
+    data = encode_game(game)
+    a = decode_game(data)
+    b = decode_game(data)
+    a.play_game()
+    b.play_game()
+    print('decoded copies play the same game: ' + str(a.snapshot() == b.snapshot()))
+
+    # Encoding leaves the game's random stream where it was
+    game = CrazyEights(make_players(3), 5)
+    game.rng = random.Random(8)
+    game.setup_game()
+    rng_state = game.rng.getstate()
+    same_bytes = encode_game(game) == encode_game(game)
+    print('encoding has no side effects: ' + str(same_bytes and game.rng.getstate() == rng_state))
+
+    # Settings beyond (name, isManual) come back through the player hooks, and a game's
+    # decision cache and interactive flag are kept
+    from ismcts import ISMCTSPlayer
+    from tournament import GameStrategyPlayer
+    register_player_class(ISMCTSPlayer)
+    try:
+        register_player_class(GameStrategyPlayer)
+        print('GameStrategyPlayer rejected: False')
+    except ValueError as e:
+        print('GameStrategyPlayer rejected: ' + str(e))
+    game = CrazyEights([ISMCTSPlayer('mcts', max_rollouts=None, time_limit=0.01, exploration=1.5), CardPlayer('cpu')], 5)
+    game.decision_cache = DecisionCache(100)
+    game.setup_game()
+    game.is_interactive = True
+    copy = decode_game(encode_game(game), sink=game.sink)
+    p = copy.players[0]
+    print('player settings restored: ' + str((type(p), p.max_rollouts, p.time_limit, p.exploration)
+                                              == (ISMCTSPlayer, None, 0.01, 1.5)))
+    print('cache and interactive flag restored: ' + str(copy.decision_cache.maxsize == 100 and copy.is_interactive))
+
+    # Truncated or corrupt data raises ValueError rather than IndexError
+    data = encode_game(game)
+    errors = []
+    for bad in [data[:5], data[:-1], data[:20], data + b'x', data[:1] + bytes([99]) + data[2:],
+                data[:6] + bytes([9]) + data[7:]]:
+        try:
+            decode_game(bad)
+            errors.append('decoded')
+        except ValueError as e:
+            errors.append('ValueError')
+    print('corrupt data rejected: ', errors)
+
+
+def test_SuspensionManager():
+    import tempfile
+    import tracemalloc
+    from simulation import make_players
+
+    def new_game(i):
+        game = CrazyEights([CardPlayer('human' + str(i), True)] + make_players(3)[1:], 5)
+        game.rng = random.Random(i)
+        game.setup_game()
+        return game
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    games = [new_game(i) for i in range(200)]
+    per_game = (tracemalloc.get_traced_memory()[0] - before) / 200
+    tracemalloc.stop()
+    print('memory per live game: ~' + str(round(per_game)) + ' bytes, encoded: '
+          + str(len(encode_game(games[0]))) + ' bytes')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = SuspensionManager(tmp, max_resident=50)
+        for i in range(2000):
+            manager.add(i, new_game(i))
+        print('tables: ' + str(len(manager)) + ', resident: ' + str(len(manager.resident))
+              + ', suspended: ' + str(manager.suspensions))
+        # Play one move at a time at random tables, as human players would
+        rng = random.Random(1)
+        expected = {}
+        latencies = []
+        for move in range(3000):
+            key = rng.randrange(2000)
+            start = time.perf_counter()
+            game = manager.get(key)
+            latencies.append(time.perf_counter() - start)
+            if not game.completed:
+                game.play_turn_auto()
+                game.end_turn()
+            expected[key] = game.snapshot()
+        latencies.sort()
+        print('get latency: p50 ' + str(round(latencies[len(latencies) // 2] * 1e6)) + 'us, p99 '
+              + str(round(latencies[len(latencies) * 99 // 100] * 1e6)) + 'us, resumes: ' + str(manager.resumes))
+        print('resident within the cap: ' + str(len(manager.resident) <= manager.max_resident))
+        print('state kept across suspensions: '
+              + str(all(manager.get(key).snapshot() == state for key, state in expected.items())))
+        time.sleep(0.01)
+        print('idle games suspended: ' + str(manager.suspend_idle(0.005)) + ', resident now: '
+              + str(len(manager.resident)))
+        game = manager.pop(7)
+        manager.discard(8)
+        print('after pop and discard: ' + str(len(manager)) + ' tables, 7 held: ' + str(7 not in manager))
+
+
+if __name__ == '__main__':
+    test_encode_game()
+    test_SuspensionManager()
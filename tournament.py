@@ -0,0 +1,342 @@
+from cardgame import CardGame
+from cardplayer import CardPlayer
+from crazyeights import CrazyEights
+from simulation import game_seed
+from multiprocessing import Pool
+import itertools
+import json
+import math
+import os
+import random
+
+
+class RandomPlayer(CardPlayer):
+    """ Player that follows the random policy of CardGame.play_turn_auto
+
+    Draws a card draw_rate of the time, otherwise plays a random legal card
+    (or draws when no card can be played).
+    """
+    draw_rate = 0.2
+
+    def choose_move(self, game):
+        moves = game.legal_moves(self)
+        cards = [m for m in moves if m != 'd']
+        if not cards or game.rng.random() < self.draw_rate:
+            return 'd'
+        return cards[game.rng.randrange(len(cards))]
+
+
+class GreedyPlayer(CardPlayer):
+    """ Player that uses the CrazyEights heuristics (the default automated player) """
+
+
+class HighCardEights(CrazyEights):
+    """ Example strategy: play the highest-ranked playable card, eights last """
+
+    def select_card_to_play(self, player, playable_cards):
+        eights, non_eights = playable_cards.extract_cards(['8'])
+        cards = non_eights.cards if len(non_eights) else eights.cards
+        return max(cards, key=lambda c: c.rank)
+
+
+class LongSuitEights(CrazyEights):
+    """ Example strategy: play from the suit with the most cards in hand when possible,
+    otherwise make the default choice """
+
+    def longest_suit(self, player):
+        counts = player.hand.count_by_suit(exclude_faces=['8'])
+        return max(counts, key=lambda s: counts[s])
+
+    def select_card_to_play(self, player, playable_cards):
+        suit = self.longest_suit(player)
+        cards = [c for c in playable_cards.cards if c.suit == suit and c.rank != 8]
+        if cards:
+            return max(cards, key=lambda c: c.rank)
+        return super().select_card_to_play(player, playable_cards)
+
+
+class GameStrategyPlayer(CardPlayer):
+    """ Player that uses the heuristics of a CrazyEights subclass
+
+    Lets strategies written as CrazyEights subclasses (overriding
+    find_playable_cards, select_card_to_play or select_crazy_eight_suit) sit at
+    the same table as other strategies.  The overriding methods are called on
+    a view of the tournament's game: an instance of the strategy class that
+    shares the game's attributes, so super() and the strategy's own methods
+    and class attributes work, and it always sees the current state.
+
+    Attributes:
+        strategy: type
+            CrazyEights subclass whose heuristics are used
+    """
+
+    def __init__(self, name: str, strategy):
+        super().__init__(name)
+        self.strategy = strategy
+        self._view = None
+
+    def view(self, game):
+        # The strategy's view of the game, made once per game
+        view = self._view
+        if view is None or view.__dict__ is not game.__dict__:
+            view = self.strategy.__new__(self.strategy)
+            view.__dict__ = game.__dict__
+            self._view = view
+        return view
+
+    def choose_move(self, game):
+        view = self.view(game)
+        playable_cards = view.find_playable_cards(self)
+        if len(playable_cards) == 0:
+            return 'd'
+        return view.select_card_to_play(self, playable_cards)
+
+    def choose_suit(self, game):
+        return self.view(game).select_crazy_eight_suit(self)
+
+
+def make_player(entrant, name: str):
+    # Entrants are CardPlayer subclasses or CrazyEights subclasses
+    if isinstance(entrant, type) and issubclass(entrant, CardGame):
+        return GameStrategyPlayer(name, entrant)
+    return entrant(name)
+
+
+def play_match(args):
+    # Worker: play one match and return only its result
+    match_id, seating, entrants, num_cards, seed = args
+    players = [make_player(entrants[e], 'seat' + str(i)) for i, e in enumerate(seating)]
+    game = CrazyEights(players, num_cards)
+    game.rng = random.Random(game_seed(seed, match_id))
+    game.setup_game()
+    game.play_game()
+    winner = None
+    if game.winner is not None:
+        winner = players.index(game.winner)
+    return {'match': match_id, 'seating': list(seating), 'winner': winner, 'turns': game.num_turns}
+
+
+class EloRatings:
+    """ Elo ratings with confidence intervals, updated one game at a time
+
+    A multi-player game counts as a win for the winner against every other
+    seat and as a draw between everyone when nobody wins.  The confidence
+    interval comes from each entrant's overall score against the field.
+
+    Attributes:
+        games: int[]
+            games played by each entrant
+        k: float
+            Elo K factor
+        ratings: float[]
+            current rating of each entrant
+        scores: float[]
+            points scored by each entrant (1 per pairwise win, 0.5 per pairwise draw)
+        pairings: int[]
+            pairwise comparisons taken part in by each entrant
+    """
+
+    def __init__(self, names, k: float = 16.0, initial: float = 1500.0):
+        self.names = list(names)
+        self.k = k
+        self.ratings = [initial] * len(self.names)
+        self.games = [0] * len(self.names)
+        self.scores = [0.0] * len(self.names)
+        self.pairings = [0] * len(self.names)
+
+    def update(self, seating, winner):
+        # seating: entrant index per seat, winner: winning seat or None
+        k = self.k / max(len(seating) - 1, 1)
+        deltas = [0.0] * len(self.ratings)
+        for a, b in itertools.combinations(range(len(seating)), 2):
+            ea, eb = seating[a], seating[b]
+            if winner == a:
+                result = 1.0
+            elif winner == b:
+                result = 0.0
+            elif winner is None:
+                result = 0.5
+            else:
+                continue
+            expected = 1.0 / (1.0 + 10 ** ((self.ratings[eb] - self.ratings[ea]) / 400.0))
+            deltas[ea] += k * (result - expected)
+            deltas[eb] -= k * (result - expected)
+            self.scores[ea] += result
+            self.scores[eb] += 1.0 - result
+            self.pairings[ea] += 1
+            self.pairings[eb] += 1
+        for e in set(seating):
+            self.ratings[e] += deltas[e]
+            self.games[e] += 1
+
+    def interval(self, entrant: int, z: float = 1.96):
+        # Half-width of the confidence interval on the rating, from the score's standard error
+        n = self.pairings[entrant]
+        if n == 0:
+            return math.inf
+        s = min(max(self.scores[entrant] / n, 0.5 / n), 1 - 0.5 / n)
+        return z * 400.0 / math.log(10) / math.sqrt(n * s * (1 - s))
+
+    def table(self):
+        # (name, rating, interval, games, score) for every entrant, best first
+        rows = []
+        for i, name in enumerate(self.names):
+            score = self.scores[i] / self.pairings[i] if self.pairings[i] else 0.0
+            rows.append((name, round(self.ratings[i], 1), round(self.interval(i), 1), self.games[i], round(score, 3)))
+        return sorted(rows, key=lambda r: -r[1])
+
+
+class Tournament:
+    """ Round-robin Crazy Eights tournament between strategies
+
+    Every group of players_per_game entrants plays every rotation of its
+    seating, rounds times over.  Matches run on a process pool and stream
+    back one at a time; each result is appended to the checkpoint file as it
+    arrives, so a restarted tournament skips the matches already played.
+
+    Attributes:
+        checkpoint: str
+            path of the JSON-lines checkpoint file, or None
+        entrants: type[]
+            CardPlayer or CrazyEights subclasses taking part
+        num_cards: int
+            number of cards dealt to each player
+        players_per_game: int
+            seats at each table
+        ratings: EloRatings
+            ratings of the entrants so far
+        rounds: int
+            number of times each seating is played
+        seed: int
+            master seed; match i is seeded from (seed, i)
+    """
+
+    def __init__(self, entrants, players_per_game: int = 2, rounds: int = 1, num_cards: int = 5,
+                 seed = 0, checkpoint = None, workers = None):
+        self.entrants = list(entrants)
+        self.names = [e.__name__ for e in self.entrants]
+        self.players_per_game = players_per_game
+        self.rounds = rounds
+        self.num_cards = num_cards
+        self.seed = seed
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.ratings = EloRatings(self.names)
+
+    def schedule(self):
+        # List of (match_id, seating) with every seat rotation of every group
+        matches = []
+        match_id = 0
+        for r in range(self.rounds):
+            for group in itertools.combinations(range(len(self.entrants)), self.players_per_game):
+                for shift in range(self.players_per_game):
+                    matches.append((match_id, group[shift:] + group[:shift]))
+                    match_id += 1
+        return matches
+
+    def header(self):
+        return {'entrants': self.names, 'players_per_game': self.players_per_game,
+                'rounds': self.rounds, 'num_cards': self.num_cards, 'seed': self.seed}
+
+    def load_checkpoint(self):
+        # Replay finished results from the checkpoint into the ratings; returns their match ids
+        done = set()
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return done
+        with open(self.checkpoint) as f:
+            text = f.read()
+        lines = text.splitlines()
+        good = 0
+        try:
+            header = json.loads(lines[0]) if lines else None
+        except ValueError:
+            # Partly written header: the interrupted run had not recorded anything yet
+            header = None
+        if header is not None:
+            if header != self.header():
+                raise ValueError('Checkpoint ' + self.checkpoint + ' belongs to a different tournament')
+            good = 1
+            for line in lines[1:]:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    break
+                done.add(result['match'])
+                self.ratings.update(result['seating'], result['winner'])
+                good += 1
+        kept = ''.join([l + '\n' for l in lines[:good]])
+        if kept != text:
+            # Drop a partly written last line and end the last good one with a newline, so
+            # the results appended next start on lines of their own
+            with open(self.checkpoint, 'w') as f:
+                f.write(kept)
+        return done
+
+    def run(self, on_result = None):
+        # Play every match not yet in the checkpoint, calling on_result(result, ratings) as each finishes
+        done = self.load_checkpoint()
+        pending = [(match_id, seating, self.entrants, self.num_cards, self.seed)
+                   for match_id, seating in self.schedule() if match_id not in done]
+        out = None
+        if self.checkpoint:
+            new_file = not os.path.exists(self.checkpoint) or os.path.getsize(self.checkpoint) == 0
+            out = open(self.checkpoint, 'a')
+            if new_file:
+                out.write(json.dumps(self.header()) + '\n')
+        try:
+            workers = self.workers or os.cpu_count() or 1
+            if workers <= 1:
+                results = map(play_match, pending)
+                self._collect(results, out, on_result)
+            else:
+                with Pool(workers) as pool:
+                    self._collect(pool.imap_unordered(play_match, pending, chunksize=8), out, on_result)
+        finally:
+            if out:
+                out.close()
+        return self.ratings
+
+    def _collect(self, results, out, on_result):
+        for result in results:
+            self.ratings.update(result['seating'], result['winner'])
+            if out:
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+            if on_result:
+                on_result(result, self.ratings)
+
+
+def test_Tournament():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'tournament.jsonl')
+    entrants = [GreedyPlayer, RandomPlayer, HighCardEights, LongSuitEights]
+    first = Tournament(entrants, rounds=50, seed=3, checkpoint=path, workers=2)
+    # Stop part way through to simulate an interrupted run
+    matches = first.schedule()
+    first.schedule = lambda: matches[:120]
+    first.run()
+    print('after interruption: ' + str(sum(first.ratings.games) // 2) + ' matches')
+    resumed = Tournament(entrants, rounds=50, seed=3, checkpoint=path, workers=2)
+    played = []
+    resumed.run(on_result=lambda result, ratings: played.append(result['match']))
+    print('resumed run played ' + str(len(played)) + ' more matches')
+
+    # Interrupted while writing: a result without its newline, or half a header
+    for cut, label in [(lambda text: text[:-1], 'last newline lost'),
+                       (lambda text: text[:text.index('\n') // 2], 'header cut short')]:
+        with open(path) as f:
+            text = f.read()
+        with open(path, 'w') as f:
+            f.write(cut(text))
+        again = Tournament(entrants, rounds=50, seed=3, checkpoint=path, workers=2)
+        again.run()
+        with open(path) as f:
+            results = [json.loads(line) for line in f.read().splitlines()[1:]]
+        print(label + ': ' + str(len(results)) + ' results, each match once: '
+              + str(sorted(r['match'] for r in results) == list(range(len(matches)))))
+    for row in resumed.ratings.table():
+        print('  %-16s %7.1f +/- %5.1f  games %4d  score %.3f' % row)
+
+
+if __name__ == '__main__':
+    test_Tournament()